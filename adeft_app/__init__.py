@@ -2,13 +2,15 @@ import os
 
 from flask import Flask, render_template
 
+from .locations import DATA_PATH
+
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY='dev',
-        DATA=os.path.join(app.instance_path, 'data'),
+        DATA=DATA_PATH,
     )
 
     if test_config is None:
@@ -23,7 +25,7 @@ def create_app(test_config=None):
         os.makedirs(app.instance_path)
     except OSError:
         pass
-    from . import ground, fix
+    from . import ground, fix, jobs, names
 
     @app.route('/')
     def main():
@@ -31,4 +33,22 @@ def create_app(test_config=None):
 
     app.register_blueprint(ground.bp)
     app.register_blueprint(fix.bp)
+    app.register_blueprint(names.bp)
+    jobs.init_app(app)
+
+    if app.config.get('WARM_UP'):
+        # pay for importing heavy dependencies at boot instead of during
+        # the first request that needs them
+        from . import trips
+        trips.preload()
+        fix.preload()
+
+    if app.config.get('INSTRUMENT'):
+        from . import instrument
+        instrument.init_app(app)
+
+    if app.config.get('PRELOAD'):
+        # build read-only data once so forked workers share it
+        from . import preload
+        preload.init_app(app)
     return app
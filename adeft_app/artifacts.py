@@ -0,0 +1,384 @@
+"""Read and write model artifacts in adeft's format and a compact format
+
+adeft stores a model as {name}_model.gz, gzipped JSON containing the full
+vocabulary and dense coefficient matrix. Parsing this is slow for large
+vocabularies. The compact format, {name}_model.compact, stores the same
+model as a small JSON header followed by aligned NumPy buffers that are
+memory mapped when loaded:
+
+    8 bytes    magic, b'ADEFTCMP'
+    4 bytes    format version, little endian uint32
+    4 bytes    header length in bytes, little endian uint32
+    header     JSON with model metadata and the dtype, shape and offset of
+               each buffer relative to the start of the data section
+    padding    up to a multiple of ALIGNMENT bytes
+    data       buffers, each starting at a multiple of ALIGNMENT bytes
+
+By default coefficients and idf weights are stored as float32, with the
+coefficients in a sparse matrix since L1 regularized models are mostly
+zeros, and features with zero weight for every class are pruned from the
+vocabulary. This makes the compact file several times smaller than the
+.gz file it replaces. Pruning changes predictions slightly because TF-IDF
+vectors are normalized over all of the features in the vocabulary. Storing
+float64 without pruning is lossless, and such a file converts back to
+exactly the model it was made from.
+
+Models trained out of core hash their features instead of keeping a
+vocabulary (see adeft_app.hashing) and may use SGDClassifier in place of
+LogisticRegression. They can only be stored in the compact format, with
+format version 2. Their header describes the vectorizer and classifier, and
+the terms buffer only names the columns listed in a term_indices buffer.
+
+NumPy, SciPy, scikit-learn and adeft are only imported when a model is read
+or written.
+"""
+import os
+import json
+import gzip
+import struct
+
+
+MAGIC = b'ADEFTCMP'
+VERSION = 1
+HASHING_VERSION = 2
+ALIGNMENT = 64
+GZ_SUFFIX = '_model.gz'
+COMPACT_SUFFIX = '_model.compact'
+# terms are joined with this, it cannot appear in a TF-IDF token
+_TERM_SEPARATOR = '\n'
+_PREFIX = struct.Struct('<8sII')
+
+
+def model_paths(models_path, model_name):
+    """Paths to each existing artifact for a model, preferred first
+
+    The compact artifact is preferred when it exists. If neither exists the
+    path of the adeft artifact is returned so that errors name it.
+    """
+    model_dir = os.path.join(models_path, model_name)
+    paths = [os.path.join(model_dir, f'{model_name}{suffix}')
+             for suffix in (COMPACT_SUFFIX, GZ_SUFFIX)]
+    existing = [path for path in paths if os.path.exists(path)]
+    return existing if existing else paths[1:]
+
+
+def model_path(models_path, model_name):
+    """Path to the preferred artifact for a model"""
+    return model_paths(models_path, model_name)[0]
+
+
+def read_gz(filepath):
+    """Read the contents of an adeft model file as a dict"""
+    with gzip.GzipFile(filepath, 'r') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def write_gz(model_info, filepath):
+    """Write a dict of model contents in adeft's format"""
+    with gzip.GzipFile(filepath, 'w') as f:
+        f.write(json.dumps(model_info).encode('utf-8'))
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_compact(model_info, filepath, dtype='float32', sparse=True,
+                  prune=True):
+    """Write a dict of model contents in the compact format
+
+    Parameters
+    ----------
+    model_info : dict
+        Model contents as produced by read_gz or read_compact
+
+    filepath : str
+        Path of output file
+
+    dtype : Optional[str]
+        Either float64 or float32. Type in which to store coefficients and
+        idf weights. Default: float32
+
+    sparse : Optional[bool]
+        Store coefficients as a CSR matrix rather than a dense array.
+        Default: True
+
+    prune : Optional[bool]
+        Drop features whose coefficient is zero for every class. Ignored
+        for hashed features, whose columns are fixed by the hash.
+        Default: True
+    """
+    import numpy as np
+    import scipy.sparse
+
+    if dtype not in ('float64', 'float32'):
+        raise ValueError(f'unsupported dtype {dtype}')
+    logit, tfidf = model_info['logit'], model_info['tfidf']
+    hashing = tfidf.get('kind') == 'hashing'
+    if hashing:
+        prune = False
+    coef = logit['coef_']
+    if scipy.sparse.issparse(coef):
+        coef = coef.toarray()
+    coef = np.asarray(coef, dtype=np.float64)
+    idf = np.asarray(tfidf['idf_'], dtype=np.float64)
+    if hashing:
+        # only some columns are named
+        named = sorted((index, term) for term, index
+                       in tfidf['vocabulary_'].items())
+        term_indices = [index for index, _ in named]
+        terms = [term for _, term in named]
+    else:
+        terms = [None]*len(tfidf['vocabulary_'])
+        for term, index in tfidf['vocabulary_'].items():
+            terms[index] = term
+    if prune:
+        keep = np.flatnonzero(np.any(coef != 0, axis=0))
+        coef, idf = coef[:, keep], idf[keep]
+        terms = [terms[index] for index in keep]
+    joined = _TERM_SEPARATOR.join(terms)
+    if terms and len(joined.split(_TERM_SEPARATOR)) != len(terms):
+        raise ValueError('vocabulary contains a term with a newline')
+
+    arrays = {'terms': np.frombuffer(joined.encode('utf-8'), dtype=np.uint8),
+              'idf': idf.astype(dtype),
+              'intercept': np.asarray(logit['intercept_'],
+                                      dtype=np.float64)}
+    if hashing:
+        arrays['term_indices'] = np.asarray(term_indices, dtype=np.int32)
+    if sparse:
+        csr = scipy.sparse.csr_matrix(coef.astype(dtype))
+        arrays['coef_data'] = csr.data
+        arrays['coef_indices'] = csr.indices.astype(np.int32)
+        arrays['coef_indptr'] = csr.indptr.astype(np.int64)
+    else:
+        arrays['coef'] = np.ascontiguousarray(coef.astype(dtype))
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = {'shortforms': model_info['shortforms'],
+              'pos_labels': model_info['pos_labels'],
+              'classes': [str(label) for label in logit['classes_']],
+              'ngram_range': list(tfidf['ngram_range']),
+              'coef_shape': list(coef.shape),
+              'options': {'dtype': dtype, 'sparse': sparse, 'prune': prune},
+              'arrays': layout}
+    if hashing:
+        header['vectorizer'] = {'kind': 'hashing',
+                                'n_features': tfidf['n_features'],
+                                'stop_words': tfidf['stop_words']}
+    if logit.get('kind') == 'sgd':
+        header['classifier'] = 'sgd'
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header_bytes))
+    temp_path = f'{filepath}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, HASHING_VERSION if hashing else VERSION,
+                             len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        # pad so the last buffer can always be mapped
+        f.truncate(data_start + max(offset, 1))
+    os.replace(temp_path, filepath)
+
+
+def read_header(filepath):
+    """Read the header of a compact artifact
+
+    Returns
+    -------
+    header : dict
+        Model metadata, with the start of the data section under
+        data_start
+    """
+    with open(filepath, 'rb') as f:
+        magic, version, length = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f'{filepath} is not a compact model artifact')
+        if version not in (VERSION, HASHING_VERSION):
+            raise ValueError(f'{filepath} has unsupported format version'
+                             f' {version}')
+        header = json.loads(f.read(length).decode('utf-8'))
+    header['data_start'] = _align(_PREFIX.size + length)
+    return header
+
+
+def read_compact(filepath):
+    """Read a compact artifact as a dict of model contents
+
+    Buffers are memory mapped rather than read. The coefficients are a
+    scipy.sparse CSR matrix if they were stored sparse, otherwise an array.
+    """
+    import numpy as np
+    import scipy.sparse
+
+    header = read_header(filepath)
+
+    def buffer(name):
+        spec = header['arrays'][name]
+        return np.memmap(filepath, dtype=np.dtype(spec['dtype']), mode='r',
+                         offset=header['data_start'] + spec['offset'],
+                         shape=tuple(spec['shape']))
+
+    terms = bytes(buffer('terms')).decode('utf-8')
+    terms = terms.split(_TERM_SEPARATOR) if terms else []
+    if header['options']['sparse']:
+        coef = scipy.sparse.csr_matrix((buffer('coef_data'),
+                                        buffer('coef_indices'),
+                                        buffer('coef_indptr')),
+                                       shape=tuple(header['coef_shape']))
+    else:
+        coef = buffer('coef')
+    model_info = {'logit': {'classes_': header['classes'],
+                            'intercept_': buffer('intercept'),
+                            'coef_': coef},
+                  'tfidf': {'vocabulary_': dict(zip(terms,
+                                                    range(len(terms)))),
+                            'idf_': buffer('idf'),
+                            'ngram_range': header['ngram_range']},
+                  'shortforms': header['shortforms'],
+                  'pos_labels': header['pos_labels']}
+    if 'vectorizer' in header:
+        model_info['tfidf'].update(header['vectorizer'])
+        model_info['tfidf']['vocabulary_'] = \
+            dict(zip(terms, buffer('term_indices').tolist()))
+    if 'classifier' in header:
+        model_info['logit']['kind'] = header['classifier']
+    return model_info
+
+
+def to_json_info(model_info):
+    """Convert model contents from read_compact to plain JSON types"""
+    import scipy.sparse
+
+    logit, tfidf = model_info['logit'], model_info['tfidf']
+    if tfidf.get('kind') == 'hashing':
+        raise ValueError('models with hashed features can only be stored as'
+                         ' compact artifacts')
+    coef = logit['coef_']
+    if scipy.sparse.issparse(coef):
+        coef = coef.toarray()
+    return {'logit': {'classes_': list(logit['classes_']),
+                      'intercept_': [float(value)
+                                     for value in logit['intercept_']],
+                      'coef_': [[float(value) for value in row]
+                                for row in coef]},
+            'tfidf': {'vocabulary_': {term: int(index) for term, index
+                                      in tfidf['vocabulary_'].items()},
+                      'idf_': [float(value) for value in tfidf['idf_']],
+                      'ngram_range': list(tfidf['ngram_range'])},
+            'shortforms': model_info['shortforms'],
+            'pos_labels': model_info['pos_labels']}
+
+
+def model_info_from_classifier(model):
+    """Get the contents of a DeftClassifier as a dict"""
+    from sklearn.linear_model import SGDClassifier
+    from .hashing import HashingTfidfVectorizer
+
+    logit = model.estimator.named_steps['logit']
+    tfidf = model.estimator.named_steps['tfidf']
+    model_info = {'logit': {'classes_': [str(label)
+                                         for label in logit.classes_],
+                            'intercept_': logit.intercept_,
+                            'coef_': logit.coef_},
+                  'tfidf': {'vocabulary_': tfidf.vocabulary_,
+                            'idf_': tfidf.idf_,
+                            'ngram_range': tfidf.ngram_range},
+                  'shortforms': model.shortforms,
+                  'pos_labels': model.pos_labels}
+    if isinstance(tfidf, HashingTfidfVectorizer):
+        model_info['tfidf'].update(kind='hashing',
+                                   n_features=tfidf.n_features,
+                                   stop_words=tfidf.stop_words)
+    if isinstance(logit, SGDClassifier):
+        model_info['logit']['kind'] = 'sgd'
+    return model_info
+
+
+def classifier_from_model_info(model_info):
+    """Build a DeftClassifier from a dict of model contents
+
+    This mirrors adeft.modeling.classify.load_model.
+    """
+    import numpy as np
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from adeft.modeling.classify import DeftClassifier
+
+    model = DeftClassifier(shortforms=model_info['shortforms'],
+                           pos_labels=model_info['pos_labels'])
+    ngram_range = tuple(model_info['tfidf']['ngram_range'])
+    if model_info['tfidf'].get('kind') == 'hashing':
+        from .hashing import HashingTfidfVectorizer
+        tfidf = HashingTfidfVectorizer(
+            ngram_range=ngram_range,
+            n_features=model_info['tfidf']['n_features'],
+            stop_words=model_info['tfidf']['stop_words'])
+    else:
+        tfidf = TfidfVectorizer(ngram_range=ngram_range)
+    if model_info['logit'].get('kind') == 'sgd':
+        logit = SGDClassifier(loss='log_loss')
+    else:
+        logit = LogisticRegression()
+    tfidf.vocabulary_ = model_info['tfidf']['vocabulary_']
+    tfidf.idf_ = model_info['tfidf']['idf_']
+    logit.classes_ = np.array(model_info['logit']['classes_'],
+                              dtype='<U32')
+    logit.intercept_ = np.asarray(model_info['logit']['intercept_'])
+    coef = model_info['logit']['coef_']
+    # scikit-learn needs coefficients of the same type as the features
+    if coef.dtype != np.float64:
+        coef = coef.astype(np.float64)
+    logit.coef_ = coef
+    model.estimator = Pipeline([('tfidf', tfidf), ('logit', logit)])
+    return model
+
+
+def load_model(filepath):
+    """Load a DeftClassifier from an artifact in either format"""
+    if filepath.endswith(COMPACT_SUFFIX):
+        return classifier_from_model_info(read_compact(filepath))
+    from adeft.modeling.classify import load_model
+    return load_model(filepath)
+
+
+def dump_model(model, filepath, **options):
+    """Write a DeftClassifier to an artifact in the format given by filepath
+
+    Options are passed to write_compact. If none are given when overwriting
+    a compact artifact, the options it was written with are kept.
+    """
+    if filepath.endswith(COMPACT_SUFFIX):
+        if not options and os.path.exists(filepath):
+            options = read_header(filepath)['options']
+        write_compact(model_info_from_classifier(model), filepath, **options)
+    elif hasattr(model.estimator.named_steps['logit'].coef_, 'toarray') or \
+            hasattr(model.estimator.named_steps.get('tfidf'), 'n_features'):
+        # adeft can only write dense coefficients and a full vocabulary
+        write_gz(to_json_info(model_info_from_classifier(model)), filepath)
+    else:
+        model.dump_model(filepath)
+
+
+def convert(filepath, out_path, **options):
+    """Convert an artifact between formats without building a classifier
+
+    The format of each file is given by its suffix. Options are passed to
+    write_compact when writing a compact artifact.
+    """
+    if filepath.endswith(COMPACT_SUFFIX):
+        model_info = read_compact(filepath)
+    else:
+        model_info = read_gz(filepath)
+    if out_path.endswith(COMPACT_SUFFIX):
+        write_compact(model_info, out_path, **options)
+    else:
+        write_gz(to_json_info(model_info), out_path)
@@ -0,0 +1,116 @@
+"""Find the most important features of trained logistic regression models
+
+Only the k largest and smallest coefficients for each class are needed, so
+they are found with a partial selection (numpy.argpartition) over the whole
+coefficient matrix at once, and only these k are sorted.
+"""
+import numpy as np
+
+
+def feature_names_from_vocabulary(vocabulary, n_features=None):
+    """Array of terms ordered by column from a vectorizer's vocabulary_
+
+    Vocabularies of hashed features may name only some of n_features
+    columns. Unnamed columns are given empty names.
+    """
+    if n_features is None:
+        n_features = len(vocabulary)
+    names = np.full(n_features, '', dtype=object)
+    for term, index in vocabulary.items():
+        names[index] = term
+    return names
+
+
+def top_bottom_indices(coef, k=20):
+    """Get columns of the k largest and k smallest coefficients in each row
+
+    Parameters
+    ----------
+    coef : numpy.ndarray
+        Coefficient matrix with a row for each class
+
+    k : Optional[int]
+        Number of features to select from each end. Default: 20
+
+    Returns
+    -------
+    top : numpy.ndarray
+        Indices of the k largest coefficients in each row, in descending
+        order of coefficient
+
+    bottom : numpy.ndarray
+        Indices of the k smallest coefficients in each row, also in
+        descending order of coefficient so the smallest is last
+    """
+    coef = np.atleast_2d(coef)
+    k = min(k, coef.shape[1])
+    if k == 0:
+        empty = np.empty((coef.shape[0], 0), dtype=int)
+        return empty, empty
+    top = np.argpartition(-coef, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(coef, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    bottom = np.argpartition(coef, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(coef, bottom, axis=1), axis=1)
+    bottom = np.take_along_axis(bottom, order, axis=1)
+    return top, bottom
+
+
+def _terms(coef_row, indices, feature_names):
+    return [(feature_names[index], float(coef_row[index]))
+            for index in indices]
+
+
+def important_terms(coef, classes, feature_names, k=20):
+    """Important terms in the format stored in model stats files
+
+    Parameters
+    ----------
+    coef : numpy.ndarray
+        Coefficients of a fitted LogisticRegression
+
+    classes : list of str
+        Class labels of the LogisticRegression
+
+    feature_names : sequence of str
+        Feature name for each column of coef
+
+    k : Optional[int]
+        Number of terms to return from each end. Default: 20
+
+    Returns
+    -------
+    important_terms : dict
+        When there are more than two classes, maps each class to a dict
+        with lists of (term, coefficient) pairs for the top and bottom
+        terms. For binary models, whose single row of coefficients
+        corresponds to classes[1], maps classes[1] to the top terms and
+        classes[0] to the bottom terms.
+    """
+    coef = np.atleast_2d(coef)
+    top, bottom = top_bottom_indices(coef, k)
+    if len(classes) > 2:
+        return {label: {'top': _terms(coef[index], top[index],
+                                      feature_names),
+                        'bottom': _terms(coef[index], bottom[index],
+                                         feature_names)}
+                for index, label in enumerate(classes)}
+    return {classes[1]: _terms(coef[0], top[0], feature_names),
+            classes[0]: _terms(coef[0], bottom[0], feature_names)}
+
+
+def label_terms(coef, classes, feature_names, k=20):
+    """Top and bottom terms for every label, including both binary labels
+
+    Like important_terms for more than two classes. For binary models the
+    coefficients of classes[0] are taken to be the negation of those of
+    classes[1], so both labels get top and bottom terms.
+    """
+    coef = np.atleast_2d(coef)
+    if len(classes) == 2 and coef.shape[0] == 1:
+        coef = np.vstack([-coef[0], coef[0]])
+    top, bottom = top_bottom_indices(coef, k)
+    return {label: {'top': _terms(coef[index], top[index], feature_names),
+                    'bottom': _terms(coef[index], bottom[index],
+                                     feature_names)}
+            for index, label in enumerate(classes)}
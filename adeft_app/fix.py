@@ -2,14 +2,16 @@ import os
 import json
 import logging
 from copy import deepcopy
-from collections import defaultdict
+from functools import lru_cache
 
-from flask import Blueprint, request, render_template, session
+from flask import (Blueprint, current_app, jsonify, redirect, request,
+                   render_template, session, url_for)
 
-from adeft.modeling.classify import load_model
-
-from .locations import DATA_PATH
+from .artifacts import COMPACT_SUFFIX, model_path, model_paths, read_header
 from .filenames import escape_filename
+from .jobs import background_enabled, get_queue
+from .instrument import span
+from .summary import get_summary, write_summary
 from .scripts.consistency import (check_grounding_dict,
                                   check_model_consistency,
                                   check_names_consistency)
@@ -19,6 +21,9 @@ logger = logging.getLogger(__file__)
 
 bp = Blueprint('fix', __name__)
 
+# largest number of important terms that can be requested for each label
+MAX_TERMS = 200
+
 
 @bp.route('/fix_init', methods=['POST'])
 def initialize():
@@ -26,34 +31,12 @@ def initialize():
     if not model_name:
         return render_template('index.jinja2')
     model_name = escape_filename(model_name)
-    models_path = os.path.join(DATA_PATH, 'models', model_name)
-    with open(os.path.join(models_path,
-                           model_name + '_grounding_dict.json')) as f:
-        grounding_dict = json.load(f)
-    with open(os.path.join(models_path, model_name + '_names.json')) as f:
-        names = json.load(f)
-    longforms = defaultdict(list)
-    longform_scores = defaultdict(int)
-    for shortform, grounding_map in grounding_dict.items():
-        cased_shortform = escape_filename(shortform)
-        with open(os.path.join(DATA_PATH, 'longforms',
-                               f'{cased_shortform}_longforms.json'), 'r') as f:
-            lf_scores = json.load(f)
-            for lf, score in lf_scores:
-                longform_scores[lf] += score
-        for longform, grounding in grounding_map.items():
-            if grounding != 'ungrounded':
-                longforms[grounding].append(longform)
-    top_longforms = {grounding: max(longform_list,
-                                    key=lambda x: longform_scores[x])
-                     for grounding, longform_list in longforms.items()}
-    longforms = [[grounding, '\n'.join(longform)] for grounding, longform
-                 in longforms.items()]
-
-    model = load_model(os.path.join(models_path, f'{model_name}_model.gz'))
-    labels = model.estimator.named_steps['logit'].classes_.tolist()
-    labels = [label for label in labels if label != 'ungrounded']
-    pos_labels = model.pos_labels
+    with span('read_summary'):
+        summary = get_summary(current_app.config['DATA'], model_name,
+                              load_model)
+    longforms, names = summary['longforms'], summary['names']
+    top_longforms = summary['top_longforms']
+    labels, pos_labels = summary['labels'], summary['pos_labels']
 
     original_longforms = deepcopy(longforms)
     transition = {grounding: grounding for grounding, _ in longforms}
@@ -66,9 +49,7 @@ def initialize():
     session['original_longforms'] = original_longforms
     session['labels'] = labels
     session['pos_labels'] = pos_labels
-    return render_template('fix.jinja2', longforms=longforms, names=names,
-                           top_longforms=top_longforms, labels=labels,
-                           pos_labels=pos_labels)
+    return _render_fix()
 
 
 @bp.route('/fix_change_grounding', methods=['POST'])
@@ -78,60 +59,165 @@ def change_grounding():
             index = key.partition('.')[-1]
     new_name = request.form[f'new-name.{index}'].strip()
     new_ground = request.form[f'new-ground.{index}'].strip()
-    names = session['names']
-    longforms = session['longforms']
-    original_longforms = session['original_longforms']
-    old_ground = longforms[int(index)-1][0]
-    origin_ground = original_longforms[int(index)-1][0]
-    if new_name:
-        names[old_ground] = new_name
-    if new_ground:
-        longforms[int(index)-1][0] = new_ground
-        names[new_ground] = names.pop(old_ground)
-        transition = session['transition']
-        transition[origin_ground] = new_ground
-        top_longforms = session['top_longforms']
-        top_longforms[new_ground] = top_longforms.pop(old_ground)
-        session['top_longforms'] = top_longforms
-        session['longforms'], session['names'] = longforms, names
-        labels = session['labels']
-        labels = [new_ground if label == old_ground else label
-                  for label in labels]
-        pos_labels = session['pos_labels']
-        pos_labels = [new_ground if label == old_ground else label
-                      for label in pos_labels]
-        session['labels'] = labels
-        session['pos_labels'] = pos_labels
-    return render_template('fix.jinja2', longforms=session['longforms'],
-                           names=session['names'],
-                           top_longforms=session['top_longforms'],
-                           labels=session['labels'],
-                           pos_labels=session['pos_labels'])
+    _change_grounding(int(index)-1, new_name, new_ground)
+    return _render_fix()
 
 
 @bp.route('/fix_toggle_positive', methods=['POST'])
 def toggle_positive():
-    pos_labels = session['pos_labels']
     for key in request.form:
         if key.startswith('pos-label.'):
             label = key.partition('.')[-1]
-            pos_labels = list(set(pos_labels) ^ set([label]))
-            session['pos_labels'] = pos_labels
-    return render_template('fix.jinja2', longforms=session['longforms'],
-                           names=session['names'],
-                           top_longforms=session['top_longforms'],
-                           labels=session['labels'],
-                           pos_labels=session['pos_labels'])
+            _toggle_positive(label)
+    return _render_fix()
+
+
+@bp.route('/fix_edits', methods=['POST'])
+def edit():
+    """Apply a batch of grounding fixes sent as JSON
+
+    The body is an object with a list of edits, applied in order::
+
+        {"edits": [{"action": "change_grounding", "row": 1,
+                    "name": "Insulin receptor", "grounding": "HGNC:6091"},
+                   {"action": "toggle_positive", "label": "HGNC:6091"}]}
+
+    Rows are referred to by their 1-based index in the table of groundings.
+    Either name or grounding may be omitted or empty to leave it unchanged.
+    Either every edit is applied or, if any is invalid, none are and an
+    error is returned with status 400. On success the rows that changed are
+    returned along with the current labels and positive labels.
+    """
+    if 'longforms' not in session:
+        return jsonify(error='no model is being fixed'), 400
+    body = request.get_json(silent=True)
+    edits = body.get('edits') if isinstance(body, dict) else None
+    if not isinstance(edits, list):
+        return jsonify(error='expected an object with a list of edits'), 400
+    num_rows = len(session['longforms'])
+    for edit in edits:
+        error = _check_edit(edit, num_rows)
+        if error is not None:
+            return jsonify(error=error, edit=edit), 400
+    changed = set()
+    for edit in edits:
+        if edit['action'] == 'change_grounding':
+            _change_grounding(edit['row'] - 1,
+                              edit.get('name', '').strip(),
+                              edit.get('grounding', '').strip())
+            changed.add(edit['row'] - 1)
+        else:
+            _toggle_positive(edit['label'])
+    longforms, names = session['longforms'], session['names']
+    top_longforms = session['top_longforms']
+    rows = [{'index': index + 1,
+             'grounding': longforms[index][0],
+             'name': names.get(longforms[index][0], ''),
+             'top_longform': top_longforms.get(longforms[index][0], ''),
+             'longforms': longforms[index][1]}
+            for index in sorted(changed)]
+    return jsonify(rows=rows, labels=session['labels'],
+                   pos_labels=session['pos_labels'])
+
+
+@bp.route('/fix_terms', methods=['GET'])
+def important_terms():
+    """Show the most important terms of the model for one or all labels
+
+    Takes optional label and k query parameters. label is a current
+    grounding and selects the model classes that have been fixed to it.
+    Responds with JSON if it is preferred to HTML.
+    """
+    if 'model_name' not in session:
+        return render_template('error.jinja2',
+                               message='No model is being fixed.')
+    label = request.args.get('label')
+    try:
+        k = min(max(int(request.args.get('k', 20)), 1), MAX_TERMS)
+    except ValueError:
+        k = 20
+    model_name = session['model_name']
+    path = model_path(os.path.join(current_app.config['DATA'], 'models'),
+                      model_name)
+    coef, classes, feature_names = _model_features(path,
+                                                   os.path.getmtime(path))
+    from .features import label_terms
+    transition, names = session['transition'], session['names']
+    terms = [{'label': original,
+              'grounding': transition.get(original, original),
+              'name': names.get(transition.get(original, original), ''),
+              'top': value['top'], 'bottom': value['bottom']}
+             for original, value in label_terms(coef, classes, feature_names,
+                                                k).items()
+             if label is None or transition.get(original, original) == label]
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'text/html'])
+    if best == 'application/json':
+        return jsonify(k=k, terms=terms)
+    return render_template('terms.jinja2', terms=terms, k=k)
+
+
+@bp.route('/fix_preview', methods=['GET'])
+def preview_fixes():
+    """Counts of texts and statements for each grounding after the fixes
+
+    Computed from the predictions cached when the model was trained. Returns
+    JSON with preds_on_unlabeled and groundings in the form of the model
+    stats, or an error with status 404 if there are no cached predictions.
+    """
+    if 'model_name' not in session:
+        return jsonify(error='no model is being fixed'), 400
+    counts = _preview()
+    if counts is None:
+        return jsonify(error='no cached predictions for this model, retrain'
+                       ' it to preview fixes'), 404
+    return jsonify(counts)
 
 
 @bp.route('/fix_submit', methods=['POST'])
 def submit():
-    model_name = session['model_name']
+    args = (current_app.config['DATA'], session['model_name'],
+            session['transition'], session['pos_labels'], session['names'])
+    if background_enabled():
+        job_id = get_queue().submit(_submit_job, *args,
+                                    name=f'Updating model {args[1]}')
+        session.clear()
+        return redirect(url_for('jobs.wait', job_id=job_id,
+                                next=url_for('main')))
+    message = _apply_fixes(*args)
+    if message is not None:
+        logger.error(message)
+        return render_template('error.jinja2', message=message)
+    session.clear()
+    return render_template('index.jinja2')
+
+
+@bp.route('/fix_retrain', methods=['POST'])
+def retrain():
+    """Apply fixes and retrain the model in a background job"""
+    args = (current_app.config['DATA'], session['model_name'],
+            session['transition'], session['pos_labels'], session['names'])
+    job_id = get_queue().submit(_retrain_job, *args,
+                                name=f'Retraining model {args[1]}')
+    session.clear()
+    return redirect(url_for('jobs.wait', job_id=job_id,
+                            next=url_for('main')))
+
+
+def _apply_fixes(data_path, model_name, transition, new_pos_labels,
+                 new_names):
+    """Update model and grounding files with fixed groundings and names
+
+    Returns
+    -------
+    message : str|None
+        Description of the problem if the new files would be inconsistent,
+        in which case nothing is written. None on success.
+    """
     # load existing model files
-    model, grounding_dict, _ = _load_model_files(model_name)
+    model, grounding_dict, _ = _load_model_files(model_name, data_path)
 
     # transition maps old groundings to new groundings
-    transition = session['transition']
     new_grounding_dict = {shortform: {longform: transition[grounding]
                                       for longform, grounding in
                                       grounding_map.items()}
@@ -139,26 +225,19 @@ def submit():
                           in grounding_dict.items()}
 
     if not check_grounding_dict(new_grounding_dict):
-        message = ('grounding_dict has become inconsistent.\n'
-                   'This should not happen if the program is working'
-                   ' as expected.')
-        logger.error(message)
-        return render_template('error.jinja2', message=message)
+        return ('grounding_dict has become inconsistent.\n'
+                'This should not happen if the program is working'
+                ' as expected.')
 
     for index, label in enumerate(model.estimator.classes_):
         model.estimator.classes_[index] = transition[label]
 
-    new_pos_labels = session['pos_labels']
-    new_names = session['names']
-
     # check consistency of newly generated files
     if not check_model_consistency(model, new_grounding_dict, new_pos_labels):
-        message = 'Model state has become inconsistent'
-        logger.error(message)
-        return render_template('error.jinja2', message=message)
+        return 'Model state has become inconsistent'
 
     # update groundings files created before training model
-    groundings_path = os.path.join(DATA_PATH, 'groundings')
+    groundings_path = os.path.join(data_path, 'groundings')
     names_dict = {}
     pos_labels_dict = {}
     for shortform, grounding_map in new_grounding_dict.items():
@@ -175,47 +254,233 @@ def submit():
                                           set(new_pos_labels))
 
     if not check_names_consistency(names_dict.values()):
-        message = 'Inconsistent names for equivalent shortforms.'
-        logger.error(message)
-        return render_template('error.jinja2', message=message)
+        return 'Inconsistent names for equivalent shortforms.'
 
     _update_model_files(model_name, model, new_grounding_dict, new_names,
-                        new_pos_labels)
+                        new_pos_labels, data_path)
+    from .predictions import predictions_path, relabel_predictions
+    relabel_predictions(predictions_path(data_path, model_name), transition)
+    write_summary(data_path, model_name, model=model)
 
     # update groundings files used for training model
-    for shortform, grounding_map in new_grounding_dict.items():
-        cased_shortform = escape_filename(shortform)
-        with open(os.path.join(groundings_path, cased_shortform,
-                               f'{cased_shortform}_grounding_map.json'),
-                  'w') as f:
-            json.dump(grounding_map, f)
-        with open(os.path.join(groundings_path, cased_shortform,
-                               f'{cased_shortform}_names.json'),
-                  'w') as f:
-            json.dump(names_dict[shortform], f)
-        with open(os.path.join(groundings_path, cased_shortform,
-                               f'{cased_shortform}_pos_labels.json'),
-                  'w') as f:
-            json.dump(pos_labels_dict[shortform], f)
-    session.clear()
-    return render_template('index.jinja2')
+    with span('write_groundings'):
+        for shortform, grounding_map in new_grounding_dict.items():
+            cased_shortform = escape_filename(shortform)
+            for end, content in (('grounding_map', grounding_map),
+                                 ('names', names_dict[shortform]),
+                                 ('pos_labels', pos_labels_dict[shortform])):
+                with open(os.path.join(groundings_path, cased_shortform,
+                                       f'{cased_shortform}_{end}.json'),
+                          'w') as f:
+                    json.dump(content, f)
+    return None
+
+
+def _submit_job(data_path, model_name, transition, new_pos_labels,
+                new_names, progress=None):
+    message = _apply_fixes(data_path, model_name, transition, new_pos_labels,
+                           new_names)
+    if message is not None:
+        raise RuntimeError(message)
+
+
+def _retrain_job(data_path, model_name, transition, new_pos_labels,
+                 new_names, progress=None):
+    from .scripts.model import load_training_options, train
+
+    if progress is not None:
+        progress(0.0, 'Applying fixes')
+    _submit_job(data_path, model_name, transition, new_pos_labels, new_names)
+    with open(os.path.join(data_path, 'models', model_name,
+                           f'{model_name}_grounding_dict.json')) as f:
+        shortforms = list(json.load(f))
+    # retrain with the options the model was trained with
+    options = load_training_options(model_name, data_path)
+    if options.get('additional'):
+        # additional texts are labeled with the fixed groundings
+        options['additional'] = [
+            (transition.get(grounding, grounding),
+             new_names.get(transition.get(grounding, grounding), name),
+             agent_text)
+            for grounding, name, agent_text in options['additional']]
+    path = model_path(os.path.join(data_path, 'models'), model_name)
+    if not options and path.endswith(COMPACT_SUFFIX):
+        # saved by a version that did not record options
+        vectorizer = read_header(path).get('vectorizer')
+        if vectorizer is not None:
+            options = {'streaming': True,
+                       'n_features': vectorizer['n_features']}
+    if progress is not None:
+        progress(0.1, 'Training model')
+    train(shortforms, data_path=data_path, **options)
+
+
+def _change_grounding(index, new_name, new_ground):
+    """Rename and/or reground the row at the given 0-based index
+
+    Empty strings leave the name or grounding unchanged.
+    """
+    names = session['names']
+    longforms = session['longforms']
+    original_longforms = session['original_longforms']
+    old_ground = longforms[index][0]
+    origin_ground = original_longforms[index][0]
+    if new_name:
+        names[old_ground] = new_name
+        session['names'] = names
+    if new_ground:
+        longforms[index][0] = new_ground
+        names[new_ground] = names.pop(old_ground)
+        transition = session['transition']
+        transition[origin_ground] = new_ground
+        session['transition'] = transition
+        top_longforms = session['top_longforms']
+        top_longforms[new_ground] = top_longforms.pop(old_ground)
+        session['top_longforms'] = top_longforms
+        session['longforms'], session['names'] = longforms, names
+        labels = session['labels']
+        labels = [new_ground if label == old_ground else label
+                  for label in labels]
+        pos_labels = session['pos_labels']
+        pos_labels = [new_ground if label == old_ground else label
+                      for label in pos_labels]
+        session['labels'] = labels
+        session['pos_labels'] = pos_labels
+
+
+def _toggle_positive(label):
+    session['pos_labels'] = list(set(session['pos_labels']) ^ set([label]))
+
+
+def _check_edit(edit, num_rows):
+    """Return a message describing what is wrong with an edit or None"""
+    if not isinstance(edit, dict):
+        return 'edits must be objects'
+    action = edit.get('action')
+    if action == 'change_grounding':
+        row = edit.get('row')
+        if not isinstance(row, int) or not 1 <= row <= num_rows:
+            return f'row must be an integer from 1 to {num_rows}'
+        for key in ('name', 'grounding'):
+            if not isinstance(edit.get(key, ''), str):
+                return f'{key} must be a string'
+    elif action == 'toggle_positive':
+        if not isinstance(edit.get('label'), str):
+            return 'label must be a string'
+    else:
+        return f'unknown action {action}'
+    return None
+
+
+def _preview():
+    """Counts after the fixes so far from cached predictions, or None"""
+    from .predictions import load_predictions, predictions_path, preview
+    with span('preview'):
+        predictions = load_predictions(
+            predictions_path(current_app.config['DATA'],
+                             session['model_name']))
+        if predictions is None:
+            return None
+        return preview(predictions, session['transition'])
+
+
+def _render_fix():
+    return render_template('fix.jinja2', longforms=session['longforms'],
+                           names=session['names'],
+                           top_longforms=session['top_longforms'],
+                           labels=session['labels'],
+                           pos_labels=session['pos_labels'],
+                           preview=_preview())
+
+
+def load_model(filepath):
+    """Load a serialized DeftClassifier from either artifact format
+
+    adeft and sklearn are imported on first use since importing them is slow.
+    """
+    from .artifacts import load_model
+    return load_model(filepath)
+
+
+@lru_cache(maxsize=8)
+def _cached_model(model_path, mtime):
+    """Model loaded from a file, cached per file modification time
+
+    The model is shared, so callers that change it must copy it first.
+    """
+    with span('load_model'):
+        return load_model(model_path)
+
+
+@lru_cache(maxsize=8)
+def _model_features(model_path, mtime):
+    """Coefficients, classes and feature names of a model file
+
+    Cached per file modification time so that they are only worked out
+    again after the model has been rewritten.
+    """
+    from .features import feature_names_from_vocabulary
+    model = _cached_model(model_path, mtime)
+    logit = model.estimator.named_steps['logit']
+    tfidf = model.estimator.named_steps['tfidf']
+    coef = logit.coef_
+    # compact artifacts may hold sparse coefficients
+    if hasattr(coef, 'toarray'):
+        coef = coef.toarray()
+    return (coef, [str(label) for label in logit.classes_],
+            feature_names_from_vocabulary(tfidf.vocabulary_,
+                                          coef.shape[1]))
+
+
+def dump_model(model, filepath):
+    """Write a DeftClassifier in the artifact format given by filepath"""
+    from .artifacts import dump_model
+    dump_model(model, filepath)
+
+
+def preload():
+    """Import adeft's classifier module ahead of the first model load"""
+    from adeft.modeling import classify  # noqa: F401
+
+
+def preload_model(model_name, data_path=None):
+    """Load what the fix pages read for a model into this process's caches
+
+    These are the summary read by /fix_init, the model changed by
+    /fix_submit, the coefficients shown by /fix_terms and the cached
+    predictions used to preview fixes. Up to eight models are kept.
+    """
+    from .predictions import load_predictions, predictions_path
+
+    if data_path is None:
+        data_path = current_app.config['DATA']
+    get_summary(data_path, model_name, load_model)
+    path = model_path(os.path.join(data_path, 'models'), model_name)
+    _model_features(path, os.path.getmtime(path))
+    load_predictions(predictions_path(data_path, model_name))
 
 
-def _load_model_files(model_name):
-    models_path = os.path.join(DATA_PATH, 'models', model_name)
+def _load_model_files(model_name, data_path=None):
+    if data_path is None:
+        data_path = current_app.config['DATA']
+    models_path = os.path.join(data_path, 'models', model_name)
     with open(os.path.join(models_path,
                            f'{model_name}_grounding_dict.json')) as f:
         grounding_dict = json.load(f)
     with open(os.path.join(models_path,
                            f'{model_name}_names.json')) as f:
         names = json.load(f)
-    model = load_model(os.path.join(models_path,
-                                    f'{model_name}_model.gz'))
+    path = model_path(os.path.join(data_path, 'models'), model_name)
+    # the caller relabels the model, so the cached one is copied
+    model = deepcopy(_cached_model(path, os.path.getmtime(path)))
     return model, grounding_dict, names
 
 
-def _update_model_files(model_name, model, grounding_dict, names, pos_labels):
-    models_path = os.path.join(DATA_PATH, 'models', model_name)
+def _update_model_files(model_name, model, grounding_dict, names, pos_labels,
+                        data_path=None):
+    if data_path is None:
+        data_path = current_app.config['DATA']
+    models_path = os.path.join(data_path, 'models', model_name)
     model.pos_labels = pos_labels
     with open(os.path.join(models_path,
                            f'{model_name}_grounding_dict.json'), 'w') as f:
@@ -226,4 +491,8 @@ def _update_model_files(model_name, model, grounding_dict, names, pos_labels):
     with open(os.path.join(models_path,
                            f'{model_name}_pos_labels.json'), 'w') as f:
         json.dump(pos_labels, f)
-    model.dump_model(os.path.join(models_path, f'{model_name}_model.gz'))
+    # keep every existing artifact for the model up to date
+    with span('dump_model'):
+        for path in model_paths(os.path.join(data_path, 'models'),
+                                model_name):
+            dump_model(model, path)
@@ -2,11 +2,14 @@ import os
 import json
 import logging
 
-from flask import Blueprint, request, render_template, session
+from flask import (Blueprint, current_app, jsonify, redirect, request,
+                   render_template, session, url_for)
 
 
+from .jobs import background_enabled, get_queue
 from .trips import trips_ground
-from .locations import DATA_PATH
+from .names import get_index
+from .instrument import span
 from .filenames import escape_filename
 
 logger = logging.getLogger(__file__)
@@ -14,6 +17,11 @@ logger = logging.getLogger(__file__)
 
 bp = Blueprint('ground', __name__)
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SORT_KEYS = {'score': 'scores', 'longform': 'longforms', 'name': 'names',
+             'grounding': 'groundings'}
+
 
 @bp.route('/ground_init', methods=['POST'])
 def initialize():
@@ -26,66 +34,125 @@ def initialize():
     try:
         data = _init_from_file(shortform)
     except ValueError:
+        local_first = current_app.config.get('LOCAL_GROUNDING', False)
         try:
-            data = _init_with_trips(shortform, cutoff)
+            if background_enabled():
+                # check that there are longforms to ground before queueing
+                _load(shortform, cutoff)
+                job_id = get_queue().submit(
+                    _init_with_trips, shortform, cutoff,
+                    data_path=current_app.config['DATA'],
+                    local_first=local_first,
+                    name=f'Grounding longforms for {shortform} with TRIPS')
+                return redirect(url_for('jobs.wait', job_id=job_id,
+                                        next=url_for('ground.resume',
+                                                     job_id=job_id)))
+            data = _init_with_trips(shortform, cutoff,
+                                    local_first=local_first)
         except ValueError:
             return render_template('index.jinja2')
     (session['longforms'], session['scores'], session['names'],
      session['groundings'], session['pos_labels']) = data
-    data, pos_labels = _process_data(*data)
-    return render_template('input.jinja2', data=data, pos_labels=pos_labels)
+    return _render_input(_view_args(request.form))
+
+
+@bp.route('/ground_resume/<job_id>', methods=['GET'])
+def resume(job_id):
+    """Show the grounding table once TRIPS grounding job has finished"""
+    state = get_queue().status(job_id)
+    if state is None or state['status'] != 'finished':
+        return render_template('error.jinja2',
+                               message='TRIPS grounding has not finished.')
+    (session['longforms'], session['scores'], session['names'],
+     session['groundings'], session['pos_labels']) = state['result']
+    return _render_input(_view_args(request.args))
+
+
+@bp.route('/ground_view', methods=['GET'])
+def view():
+    return _render_input(_view_args(request.args))
+
+
+@bp.route('/ground_rows', methods=['GET'])
+def rows():
+    view = _view_args(request.args)
+    rows, total = _select_rows(**view)
+    return jsonify(rows=rows, total=total, labels=_labels(),
+                   pos_labels=session['pos_labels'], **view)
 
 
 @bp.route('/ground_add', methods=['POST'])
 def add_groundings():
     name = request.form['name'].strip()
     grounding = request.form['grounding'].strip()
-    names, groundings = session['names'], session['groundings']
+    changed = []
     if name and grounding:
-        selected = request.form.getlist('select')
-        for value in selected:
-            index = int(value)-1
-            names[index] = name
-            groundings[index] = grounding
-    session['names'], session['groundings'] = names, groundings
-    session['pos_labels'] = list(set(session['pos_labels']) & set(groundings))
-    data = (session['longforms'], session['scores'], session['names'],
-            session['groundings'], session['pos_labels'])
-    data, pos_labels = _process_data(*data)
-    return render_template('input.jinja2', data=data, pos_labels=pos_labels)
+        selected = [int(value) - 1 for value in request.form.getlist('select')]
+        changed = _add(selected, name, grounding)
+    return _edit_response(changed)
 
 
 @bp.route('/ground_delete', methods=['POST'])
 def delete_grounding():
-    names, groundings = session['names'], session['groundings']
+    changed = []
     for key in request.form:
         if key.startswith('delete.'):
             id_ = key.partition('.')[-1]
-            index = int(id_) - 1
-            names[index] = groundings[index] = ''
+            changed = _delete([int(id_) - 1])
             break
-    session['names'], session['groundings'] = names, groundings
-    session['pos_labels'] = list(set(session['pos_labels']) & set(groundings))
-    data = (session['longforms'], session['scores'], session['names'],
-            session['groundings'], session['pos_labels'])
-    data, pos_labels = _process_data(*data)
-    session['pos_labels'] = pos_labels
-    return render_template('input.jinja2', data=data, pos_labels=pos_labels)
+    return _edit_response(changed)
 
 
 @bp.route('/ground_pos_label', methods=['POST'])
 def add_positive():
-    pos_labels = session['pos_labels']
     for key in request.form:
         if key.startswith('pos-label.'):
             label = key.partition('.')[-1]
-            pos_labels = list(set(pos_labels) ^ set([label]))
-            session['pos_labels'] = pos_labels
+            _toggle_positive(label)
             break
-    data = (session['longforms'], session['scores'], session['names'],
-            session['groundings'], session['pos_labels'])
-    data, pos_labels = _process_data(*data)
-    return render_template('input.jinja2', data=data, pos_labels=pos_labels)
+    return _edit_response([])
+
+
+@bp.route('/ground_edits', methods=['POST'])
+def edit():
+    """Apply a batch of grounding edits sent as JSON
+
+    The body is an object with a list of edits, applied in order::
+
+        {"edits": [{"action": "add", "rows": [1, 2],
+                    "name": "Insulin receptor", "grounding": "HGNC:6091"},
+                   {"action": "delete", "rows": [3]},
+                   {"action": "toggle_positive", "label": "HGNC:6091"}]}
+
+    Rows are referred to by their 1-based index, as in the grounding table.
+    Either every edit is applied or, if any is invalid, none are and an
+    error is returned with status 400. On success the rows that changed are
+    returned along with the current labels and positive labels.
+    """
+    if 'groundings' not in session:
+        return jsonify(error='no shortform is being grounded'), 400
+    body = request.get_json(silent=True)
+    edits = body.get('edits') if isinstance(body, dict) else None
+    if not isinstance(edits, list):
+        return jsonify(error='expected an object with a list of edits'), 400
+    num_rows = len(session['groundings'])
+    for edit in edits:
+        error = _check_edit(edit, num_rows)
+        if error is not None:
+            return jsonify(error=error, edit=edit), 400
+    changed = []
+    for edit in edits:
+        indices = [row - 1 for row in edit.get('rows', [])]
+        if edit['action'] == 'add':
+            changed.extend(_add(indices, edit['name'].strip(),
+                                edit['grounding'].strip()))
+        elif edit['action'] == 'delete':
+            changed.extend(_delete(indices))
+        else:
+            _toggle_positive(edit['label'])
+    changed = sorted(set(changed))
+    return jsonify(rows=[_row(index) for index in changed], labels=_labels(),
+                   pos_labels=session['pos_labels'])
 
 
 @bp.route('/ground_generate', methods=['POST'])
@@ -101,28 +168,47 @@ def generate_grounding_map():
                                                             names)
                  if grounding and name}
     cased_shortform = escape_filename(shortform)
-    groundings_path = os.path.join(DATA_PATH, 'groundings', cased_shortform)
+    groundings_path = os.path.join(current_app.config['DATA'], 'groundings',
+                                   cased_shortform)
     try:
         os.mkdir(groundings_path)
     except FileExistsError:
         pass
-    with open(os.path.join(groundings_path,
-                           f'{cased_shortform}_grounding_map.json'), 'w') as f:
-        json.dump(grounding_map, f)
-    with open(os.path.join(groundings_path,
-                           f'{cased_shortform}_names.json'), 'w') as f:
-        json.dump(names_map, f)
-    with open(os.path.join(groundings_path,
-                           f'{cased_shortform}_pos_labels.json'), 'w') as f:
-        json.dump(pos_labels, f)
+    with span('write_groundings'):
+        for end, content in (('grounding_map', grounding_map),
+                             ('names', names_map),
+                             ('pos_labels', pos_labels)):
+            with open(os.path.join(groundings_path,
+                                   f'{cased_shortform}_{end}.json'),
+                      'w') as f:
+                json.dump(content, f)
     session.clear()
     return render_template('index.jinja2')
 
 
-def _init_with_trips(shortform, cutoff):
-    longforms, scores = _load(shortform, cutoff)
-    trips_groundings = [trips_ground(longform, cached=True)
-                        for longform in longforms]
+def _init_with_trips(shortform, cutoff, data_path=None, progress=None,
+                     local_first=False):
+    """Longforms of a shortform above cutoff with groundings from TRIPS
+
+    With local_first, longforms that are exactly the name of an entry in the
+    local name index are grounded to it without calling TRIPS.
+    """
+    longforms, scores = _load(shortform, cutoff, data_path)
+    if local_first:
+        name_index = get_index(data_path if data_path is not None
+                               else current_app.config['DATA'])
+    trips_groundings = []
+    report_every = max(len(longforms) // 100, 1)
+    for index, longform in enumerate(longforms):
+        if progress is not None and index % report_every == 0:
+            progress(index / len(longforms),
+                     f'{index}/{len(longforms)} longforms grounded')
+        local = name_index.exact(longform) if local_first else None
+        if local is not None:
+            trips_groundings.append(local)
+            continue
+        with span('trips_ground'):
+            trips_groundings.append(trips_ground(longform, cached=True))
     names, groundings = zip(*trips_groundings)
     names = [name if name is not None else '' for name in names]
     groundings = [grounding if grounding is not None
@@ -136,22 +222,22 @@ def _init_with_trips(shortform, cutoff):
 
 def _init_from_file(shortform):
     longforms, scores = _load(shortform, 0)
-    groundings_path = os.path.join(DATA_PATH, 'groundings', shortform)
     cased_shortform = escape_filename(shortform)
-    try:
-        with open(os.path.join(groundings_path,
-                               f'{cased_shortform}_grounding_map.json'),
-                  'r') as f:
-            grounding_map = json.load(f)
-        with open(os.path.join(groundings_path,
-                               f'{cased_shortform}_names.json'), 'r') as f:
-            names = json.load(f)
-        with open(os.path.join(groundings_path,
-                               f'{cased_shortform}_pos_labels.json'),
-                  'r') as f:
-            pos_labels = json.load(f)
-    except EnvironmentError:
-        raise ValueError
+    groundings_path = os.path.join(current_app.config['DATA'], 'groundings',
+                                   cased_shortform)
+    preloaded = current_app.extensions.get('adeft_preload')
+    saved = preloaded.groundings.get(shortform) if preloaded else None
+    if saved is not None:
+        grounding_map, names, pos_labels = saved
+    else:
+        try:
+            with span('read_groundings'):
+                grounding_map, names, pos_labels = \
+                    [_read_json(os.path.join(groundings_path,
+                                             f'{cased_shortform}_{end}.json'))
+                     for end in ('grounding_map', 'names', 'pos_labels')]
+        except EnvironmentError:
+            raise ValueError
     groundings = [grounding_map.get(longform) for longform in longforms]
     groundings = ['' if grounding == 'ungrounded' else grounding
                   for grounding in groundings
@@ -161,24 +247,181 @@ def _init_from_file(shortform):
     return longforms, scores, names, groundings, pos_labels
 
 
-def _load(shortform, cutoff):
-    cased_shortform = escape_filename(shortform)
-    longforms_path = os.path.join(DATA_PATH, 'longforms',
-                                  f'{cased_shortform}_longforms.json')
-    try:
-        with open(longforms_path, 'r') as f:
-            scored_longforms = json.load(f)
-    except EnvironmentError:
-        raise ValueError(f'data not currently available for shortform'
-                         '{shortform}')
+def _load(shortform, cutoff, data_path=None):
+    scored_longforms = None
+    if data_path is None:
+        data_path = current_app.config['DATA']
+        preloaded = current_app.extensions.get('adeft_preload')
+        if preloaded is not None:
+            scored_longforms = preloaded.longforms.get(shortform)
+    if scored_longforms is None:
+        cased_shortform = escape_filename(shortform)
+        longforms_path = os.path.join(data_path, 'longforms',
+                                      f'{cased_shortform}_longforms.json')
+        try:
+            with span('read_longforms'):
+                scored_longforms = _read_json(longforms_path)
+        except EnvironmentError:
+            raise ValueError(f'data not currently available for shortform'
+                             '{shortform}')
     longforms, scores = zip(*[(longform, round(score, 1))
                               for longform, score in scored_longforms
                               if score > cutoff])
     return longforms, scores
 
 
-def _process_data(longforms, scores, names, groundings, pos_labels):
-    labels = sorted(set(grounding for grounding in groundings if grounding))
-    labels.extend(['']*(len(longforms) - len(labels)))
-    data = list(zip(longforms, scores, names, groundings, labels))
-    return data, pos_labels
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _add(indices, name, grounding):
+    """Set name and grounding for rows at the given 0-based indices"""
+    names, groundings = session['names'], session['groundings']
+    for index in indices:
+        names[index] = name
+        groundings[index] = grounding
+    session['names'], session['groundings'] = names, groundings
+    session['pos_labels'] = list(set(session['pos_labels']) & set(groundings))
+    return indices
+
+
+def _delete(indices):
+    """Clear name and grounding for rows at the given 0-based indices"""
+    names, groundings = session['names'], session['groundings']
+    for index in indices:
+        names[index] = groundings[index] = ''
+    session['names'], session['groundings'] = names, groundings
+    session['pos_labels'] = list(set(session['pos_labels']) & set(groundings))
+    return indices
+
+
+def _toggle_positive(label):
+    session['pos_labels'] = list(set(session['pos_labels']) ^ set([label]))
+
+
+def _check_edit(edit, num_rows):
+    """Return a message describing what is wrong with an edit or None"""
+    if not isinstance(edit, dict):
+        return 'edits must be objects'
+    action = edit.get('action')
+    if action in ('add', 'delete'):
+        rows = edit.get('rows')
+        if not isinstance(rows, list) or \
+           not all(isinstance(row, int) and 1 <= row <= num_rows
+                   for row in rows):
+            return f'rows must be a list of integers from 1 to {num_rows}'
+        if action == 'add':
+            for key in ('name', 'grounding'):
+                if not isinstance(edit.get(key), str) or \
+                   not edit[key].strip():
+                    return f'{key} must be a non-empty string'
+    elif action == 'toggle_positive':
+        if not isinstance(edit.get('label'), str):
+            return 'label must be a string'
+    else:
+        return f'unknown action {action}'
+    return None
+
+
+def _view_args(values):
+    """Get pagination, sorting and filtering options for the grounding table
+
+    Parameters
+    ----------
+    values : py:class:`werkzeug.datastructures.MultiDict`
+        Request args or form containing any of the keys page, per_page,
+        sort, order and filter. Missing or invalid values are replaced with
+        defaults.
+
+    Returns
+    -------
+    view : dict
+        Keyword arguments for _select_rows
+    """
+    default_per_page = current_app.config.get('GROUND_PAGE_SIZE', PAGE_SIZE)
+    try:
+        page = max(int(values.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    try:
+        per_page = min(max(int(values.get('per_page', default_per_page)), 1),
+                       MAX_PAGE_SIZE)
+    except ValueError:
+        per_page = default_per_page
+    sort = values.get('sort', 'score')
+    if sort not in SORT_KEYS:
+        sort = 'score'
+    order = 'asc' if values.get('order') == 'asc' else 'desc'
+    status = values.get('filter', 'all')
+    if status not in ('all', 'grounded', 'ungrounded'):
+        status = 'all'
+    return {'page': page, 'per_page': per_page, 'sort': sort,
+            'order': order, 'status': status}
+
+
+def _row(index):
+    """Get a row of the grounding table by its index in the session"""
+    return {'index': index + 1,
+            'longform': session['longforms'][index],
+            'score': session['scores'][index],
+            'name': session['names'][index],
+            'grounding': session['groundings'][index]}
+
+
+def _select_rows(page, per_page, sort, order, status):
+    """Get one page of rows of the grounding table
+
+    Returns
+    -------
+    rows : list of dict
+        Rows on the requested page. The index of each row is its 1-based
+        position in the unsorted table and is used to refer to it in edits.
+
+    total : int
+        Number of rows matching the filter across all pages
+    """
+    groundings = session['groundings']
+    indices = range(len(groundings))
+    if status == 'grounded':
+        indices = [index for index in indices if groundings[index]]
+    elif status == 'ungrounded':
+        indices = [index for index in indices if not groundings[index]]
+    key = session[SORT_KEYS[sort]]
+    # scores are stored in descending order so this is usually a no-op
+    indices = sorted(indices, key=key.__getitem__, reverse=order == 'desc')
+    start = (page - 1) * per_page
+    return ([_row(index) for index in indices[start:start + per_page]],
+            len(indices))
+
+
+def _labels():
+    return sorted(set(grounding for grounding in session['groundings']
+                      if grounding))
+
+
+def _render_input(view):
+    rows, total = _select_rows(**view)
+    pages = max((total + view['per_page'] - 1) // view['per_page'], 1)
+    return render_template('input.jinja2', rows=rows, total=total,
+                           pages=pages, labels=_labels(),
+                           pos_labels=session['pos_labels'], **view)
+
+
+def _wants_json():
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'text/html'])
+    return best == 'application/json'
+
+
+def _edit_response(changed):
+    """Respond to an edit with only the changed rows or the whole page
+
+    Requests that accept JSON, such as those sent by scripts.js, get the
+    changed rows along with the current labels. Plain form posts get the
+    page re-rendered with the view options posted along with the form.
+    """
+    if _wants_json():
+        return jsonify(rows=[_row(index) for index in changed],
+                       labels=_labels(), pos_labels=session['pos_labels'])
+    return _render_input(_view_args(request.form))
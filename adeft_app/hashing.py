@@ -0,0 +1,104 @@
+"""TF-IDF features of hashed terms for models trained out of core
+
+TfidfVectorizer needs every text in memory to build its vocabulary. This
+vectorizer maps terms to a fixed number of columns with the same hashing as
+scikit-learn's HashingVectorizer, so texts can be vectorized one chunk at a
+time. Document frequencies are accumulated chunk by chunk with partial_fit
+and weighted and normalized as TfidfTransformer does by default.
+
+Hashing loses the terms themselves. vocabulary_ maps terms to columns only
+for the columns whose terms have been looked up with name_features, usually
+those with the largest coefficients, so that important terms can be shown.
+"""
+from collections import Counter, defaultdict
+
+import numpy as np
+import scipy.sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import normalize
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer
+
+
+class HashingTfidfVectorizer(TransformerMixin, BaseEstimator):
+    """TF-IDF vectorizer over hashed unigrams and ngrams
+
+    Parameters
+    ----------
+    ngram_range : Optional[tuple of int]
+        Range of ngram lengths. Default: (1, 2)
+
+    n_features : Optional[int]
+        Number of columns terms are hashed to. Default: 2**18
+
+    stop_words : Optional[str]
+        Stop word list as for TfidfVectorizer. Default: english
+    """
+    def __init__(self, ngram_range=(1, 2), n_features=2**18,
+                 stop_words='english'):
+        self.ngram_range = ngram_range
+        self.n_features = n_features
+        self.stop_words = stop_words
+
+    def _hasher(self):
+        return HashingVectorizer(ngram_range=tuple(self.ngram_range),
+                                 n_features=self.n_features,
+                                 stop_words=self.stop_words,
+                                 alternate_sign=False, norm=None)
+
+    def counts(self, texts):
+        """Matrix of term counts with a row for each text"""
+        return self._hasher().transform(texts)
+
+    def partial_fit(self, texts, y=None):
+        """Add the document frequencies of a chunk of texts"""
+        if not hasattr(self, 'document_counts_'):
+            self.document_counts_ = np.zeros(self.n_features, dtype=np.int64)
+            self.n_documents_ = 0
+            self.vocabulary_ = {}
+        counts = self.counts(texts).tocsc()
+        self.document_counts_ += np.diff(counts.indptr)
+        self.n_documents_ += counts.shape[0]
+        # smoothed as in TfidfTransformer
+        self.idf_ = np.log((1 + self.n_documents_) /
+                           (1 + self.document_counts_)) + 1
+        return self
+
+    def fit(self, texts, y=None):
+        for attribute in ('document_counts_', 'n_documents_', 'idf_'):
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        return self.partial_fit(texts)
+
+    def transform(self, texts):
+        counts = self.counts(texts)
+        return normalize(counts @ scipy.sparse.diags(self.idf_))
+
+    def name_features(self, texts, indices):
+        """Record the terms of columns in vocabulary_
+
+        Parameters
+        ----------
+        texts : iterable of str
+            Texts in which to look for terms
+
+        indices : iterable of int
+            Columns to name. When several terms hash to the same column, it
+            is named after the most frequent one.
+        """
+        indices = set(int(index) for index in indices)
+        analyzer = self._hasher().build_analyzer()
+        hasher = FeatureHasher(n_features=self.n_features,
+                               input_type='string', alternate_sign=False)
+        frequencies = defaultdict(Counter)
+        for text in texts:
+            terms = Counter(analyzer(text))
+            if not terms:
+                continue
+            columns = hasher.transform([[term] for term in terms]).indices
+            for (term, count), column in zip(terms.items(), columns):
+                if column in indices:
+                    frequencies[int(column)][term] += count
+        self.vocabulary_ = {counter.most_common(1)[0][0]: index
+                            for index, counter in frequencies.items()}
+        return self.vocabulary_
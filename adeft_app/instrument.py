@@ -0,0 +1,215 @@
+"""Opt-in timing and profiling instrumentation for the Flask app
+
+Instrumentation is enabled by setting INSTRUMENT = True in the app config.
+Code in the blueprints marks expensive operations with the span context
+manager. When instrumentation is enabled the durations of spans and of whole
+requests are aggregated into histograms that are served in the Prometheus
+text format at /metrics. When it is disabled span does nothing.
+
+Requests slower than PROFILE_SLOW_REQUESTS seconds can additionally have
+cProfile output dumped to PROFILE_DIR. Profiling every request is costly so
+this is disabled unless PROFILE_SLOW_REQUESTS is set.
+
+Each process keeps its own metrics. Under a multiprocess server each worker
+reports only the requests it handled.
+"""
+import os
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import (Response, current_app, g, has_app_context, request,
+                   before_render_template, template_rendered)
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """Cumulative histogram of observed durations
+
+    Parameters
+    ----------
+    buckets : Optional[tuple of float]
+        Upper bounds of histogram buckets in seconds, in increasing order.
+        Default: DEFAULT_BUCKETS
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Thread safe collection of labeled histograms
+
+    Attributes
+    ----------
+    histograms : dict
+        Maps (metric name, label name, label value) to Histogram
+    """
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, label, value, seconds):
+        key = (metric, label, value)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def to_prometheus(self):
+        """Render all histograms in the Prometheus text exposition format"""
+        help_text = {'adeft_app_request_seconds':
+                     'Time spent handling requests by endpoint',
+                     'adeft_app_span_seconds':
+                     'Time spent in named operations'}
+        lines = []
+        with self._lock:
+            items = sorted(self.histograms.items())
+            for metric in sorted({metric for metric, _, _ in
+                                  self.histograms}):
+                lines.append(f'# HELP {metric} {help_text.get(metric, "")}')
+                lines.append(f'# TYPE {metric} histogram')
+                for (name, label, value), histogram in items:
+                    if name != metric:
+                        continue
+                    labels = f'{label}="{_escape_label(value)}"'
+                    cumulative = 0
+                    bounds = [repr(bound) for bound in histogram.buckets]
+                    for bound, count in zip(bounds + ['+Inf'],
+                                            histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},'
+                                     f'le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{labels}}}'
+                                 f' {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _get_metrics():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('adeft_instrument')
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as a named span
+
+    Does nothing unless called within an app with instrumentation enabled,
+    so it is safe to use in code that also runs outside of the app.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span, used as the value of the span label
+    """
+    metrics = _get_metrics()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('adeft_app_span_seconds', 'span', name,
+                        time.perf_counter() - start)
+
+
+class _TimedSessionInterface(object):
+    """Wraps a session interface to time session loading and saving"""
+    def __init__(self, interface):
+        self._interface = interface
+
+    def __getattr__(self, name):
+        return getattr(self._interface, name)
+
+    def open_session(self, app, request):
+        with span('session_open'):
+            return self._interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with span('session_save'):
+            return self._interface.save_session(app, session, response)
+
+
+def _before_render(sender, template, context, **extra):
+    g._instrument_render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    metrics = _get_metrics()
+    start = g.pop('_instrument_render_start', None)
+    if metrics is not None and start is not None:
+        metrics.observe('adeft_app_span_seconds', 'span',
+                        f'render:{template.name}',
+                        time.perf_counter() - start)
+
+
+def init_app(app):
+    """Register instrumentation hooks and the /metrics endpoint on app
+
+    Parameters
+    ----------
+    app : py:class:`flask.Flask`
+    """
+    metrics = Metrics()
+    app.extensions['adeft_instrument'] = metrics
+    app.session_interface = _TimedSessionInterface(app.session_interface)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    threshold = app.config.get('PROFILE_SLOW_REQUESTS')
+    profile_dir = app.config.get('PROFILE_DIR',
+                                 os.path.join(app.instance_path, 'profiles'))
+
+    @app.before_request
+    def start_timer():
+        g._instrument_start = time.perf_counter()
+        if threshold is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is already active in this process
+                return
+            g._instrument_profiler = profiler
+
+    @app.teardown_request
+    def stop_timer(exc):
+        start = g.pop('_instrument_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe('adeft_app_request_seconds', 'endpoint', endpoint,
+                        elapsed)
+        profiler = g.pop('_instrument_profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        if elapsed > threshold:
+            os.makedirs(profile_dir, exist_ok=True)
+            filename = (f'{endpoint}-{time.strftime("%Y%m%d-%H%M%S")}'
+                        f'-{os.getpid()}-{int(elapsed * 1000)}ms.prof')
+            profiler.dump_stats(os.path.join(profile_dir, filename))
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.to_prometheus(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,222 @@
+"""Local queue for running slow tasks outside of request handlers
+
+Jobs run in a pool of worker processes owned by the app process, so no
+external broker is needed. The state of each job (status, progress, result
+or error) is written to a small JSON file in JOBS_PATH, which defaults to
+jobs in the instance folder. This lets any worker of a multiprocess server
+report on a job, not only the one that submitted it. The files of jobs
+that finished or failed more than JOB_EXPIRY_HOURS ago (default 24) are
+deleted when the app starts and whenever a job is submitted.
+
+Functions run as jobs must be importable top level functions taking
+picklable arguments. They are passed a progress keyword argument, a callable
+taking a fraction between 0 and 1 and an optional message, and their return
+value must be JSON serializable.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import (Blueprint, current_app, jsonify, render_template,
+                   request, abort)
+
+
+logger = logging.getLogger(__file__)
+
+bp = Blueprint('jobs', __name__)
+
+
+def _write_state(jobs_path, job_id, **updates):
+    path = os.path.join(jobs_path, f'{job_id}.json')
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except EnvironmentError:
+        state = {'id': job_id}
+    state.update(updates)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+def _run_job(jobs_path, job_id, func, args, kwargs):
+    """Run func in a worker process, recording its progress and outcome"""
+    def progress(fraction, message=None):
+        _write_state(jobs_path, job_id, progress=fraction, message=message)
+
+    _write_state(jobs_path, job_id, status='running', started=time.time())
+    try:
+        result = func(*args, progress=progress, **kwargs)
+    except Exception as err:
+        logger.exception('Job %s failed', job_id)
+        _write_state(jobs_path, job_id, status='failed', error=str(err),
+                     traceback=traceback.format_exc(), finished=time.time())
+        return
+    _write_state(jobs_path, job_id, status='finished', progress=1.0,
+                 result=result, finished=time.time())
+
+
+class JobQueue(object):
+    """Runs functions in background worker processes
+
+    Parameters
+    ----------
+    jobs_path : str
+        Directory in which job state is stored
+
+    max_workers : Optional[int]
+        Number of worker processes. Default: 2
+
+    expiry : Optional[float]
+        Seconds after which the state of a finished or failed job is
+        deleted. Default: 24 hours
+    """
+    def __init__(self, jobs_path, max_workers=2, expiry=24*3600):
+        self.jobs_path = jobs_path
+        self.max_workers = max_workers
+        self.expiry = expiry
+        self._executor = None
+        os.makedirs(jobs_path, exist_ok=True)
+
+    def prune(self):
+        """Delete the state of jobs that finished before the expiry time
+
+        Returns
+        -------
+        removed : int
+            Number of jobs deleted
+        """
+        cutoff = time.time() - self.expiry
+        removed = 0
+        for filename in os.listdir(self.jobs_path):
+            path = os.path.join(self.jobs_path, filename)
+            try:
+                # state is last written when a job finishes, so recently
+                # written files need not be read
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if not filename.endswith('.json'):
+                    # left by a process that died while writing
+                    os.remove(path)
+                    continue
+                with open(path, 'r') as f:
+                    state = json.load(f)
+                if state.get('status') in ('finished', 'failed') and \
+                        state.get('finished', 0) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except (EnvironmentError, ValueError):
+                # removed or being replaced by another process
+                continue
+        return removed
+
+    def _get_executor(self):
+        # worker processes are only started once a job is submitted
+        if self._executor is None:
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=context)
+        return self._executor
+
+    def submit(self, func, *args, name=None, **kwargs):
+        """Queue func(*args, **kwargs) to run in a worker process
+
+        Parameters
+        ----------
+        func : function
+            Top level function accepting a progress keyword argument
+
+        name : Optional[str]
+            Human readable description of the job. Default: name of func
+
+        Returns
+        -------
+        job_id : str
+            Identifier for looking up the job's state
+        """
+        self.prune()
+        job_id = uuid.uuid4().hex
+        _write_state(self.jobs_path, job_id, status='queued', progress=0.0,
+                     message=None, name=name or func.__name__,
+                     created=time.time())
+        future = self._get_executor().submit(_run_job, self.jobs_path, job_id,
+                                             func, args, kwargs)
+
+        def check_crash(future):
+            # _run_job records failures itself. An exception here means the
+            # worker process died or the job could not be sent to it.
+            if future.exception() is not None:
+                _write_state(self.jobs_path, job_id, status='failed',
+                             error=str(future.exception()),
+                             finished=time.time())
+        future.add_done_callback(check_crash)
+        return job_id
+
+    def status(self, job_id):
+        """Get the state of a job or None if there is no such job"""
+        # job ids are generated with uuid4().hex
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.jobs_path, f'{job_id}.json'),
+                      'r') as f:
+                return json.load(f)
+        except EnvironmentError:
+            return None
+
+
+def init_app(app):
+    """Attach a JobQueue to app and register the jobs blueprint"""
+    jobs_path = app.config.get('JOBS_PATH',
+                               os.path.join(app.instance_path, 'jobs'))
+    queue = JobQueue(jobs_path, app.config.get('JOB_WORKERS', 2),
+                     app.config.get('JOB_EXPIRY_HOURS', 24)*3600)
+    queue.prune()
+    app.extensions['adeft_jobs'] = queue
+    app.register_blueprint(bp)
+
+
+def get_queue():
+    return current_app.extensions['adeft_jobs']
+
+
+def background_enabled():
+    """True if slow UI actions should run as background jobs"""
+    return bool(current_app.config.get('BACKGROUND_JOBS'))
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def status(job_id):
+    state = get_queue().status(job_id)
+    if state is None:
+        abort(404)
+    # results can be large and are fetched by the page that needs them
+    state.pop('result', None)
+    return jsonify(state)
+
+
+def _is_local_url(url):
+    """True if browsers will read url as a path within the app"""
+    # browsers read backslashes as slashes and drop tabs and newlines, so
+    # /\host and /<tab>/host are read as //host, a url on another host
+    url = url.replace('\\', '/')
+    url = ''.join(char for char in url if char not in '\t\n\r')
+    return url.startswith('/') and not url.startswith('//')
+
+
+@bp.route('/jobs/<job_id>/wait', methods=['GET'])
+def wait(job_id):
+    """Page that polls a job and moves on to the next url once it finishes"""
+    state = get_queue().status(job_id)
+    if state is None:
+        abort(404)
+    next_url = request.args.get('next', '')
+    if not _is_local_url(next_url):
+        next_url = ''
+    return render_template('job.jinja2', job=state, next=next_url)
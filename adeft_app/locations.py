@@ -2,4 +2,5 @@ import os
 
 ADEFT_APP_PATH = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(ADEFT_APP_PATH, 'data')
+TRIPS_CACHE_PATH = os.path.join(DATA_PATH, 'cached_results', 'trips')
 S3_BUCKET = 'deft-models'
@@ -0,0 +1,258 @@
+"""Offline index of ontology names for grounding suggestions
+
+Name tables are tab separated files in the names directory of the data
+directory, one per namespace, named {NAMESPACE}_names.tsv. Each line holds
+an identifier and a name for it, optionally followed by the word preferred.
+The first name given for an identifier and any marked preferred are its
+preferred names, such as both the symbol and the full name of a gene, and
+any others are synonyms. The first name is the one shown. Groundings are
+formed as NAMESPACE:identifier, as for groundings from TRIPS.
+adeft_app.scripts.name_tables writes tables for HGNC, FamPlex, GO, ChEBI and
+MeSH from INDRA's resource files.
+
+Names are normalized by case folding and collapsing everything other than
+letters and digits to single spaces. The index is a sorted list of
+normalized names with a parallel array of entry numbers, which serves as a
+prefix trie: the names with a given prefix are a contiguous range found by
+binary search. When no name starts with a query, prefixes one edit away
+from it are searched instead.
+"""
+import os
+import re
+import bisect
+import logging
+from array import array
+from functools import lru_cache
+
+from flask import Blueprint, current_app, jsonify, request
+
+
+logger = logging.getLogger(__file__)
+
+bp = Blueprint('names', __name__)
+
+# same order of preference as groundings from TRIPS
+NAMESPACE_PRIORITY = ['HGNC', 'FPLX', 'UP', 'GO', 'CHEBI', 'MESH']
+MAX_SUGGESTIONS = 50
+# most prefix matches ranked for a query
+_MAX_SCAN = 200
+_NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+_SUFFIX = '_names.tsv'
+
+
+def normalize(text):
+    return _NON_ALPHANUMERIC.sub(' ', text.casefold()).strip()
+
+
+def _priority(grounding):
+    namespace = grounding.split(':', 1)[0]
+    try:
+        return NAMESPACE_PRIORITY.index(namespace)
+    except ValueError:
+        return len(NAMESPACE_PRIORITY)
+
+
+class NameIndex(object):
+    """Prefix and fuzzy lookup of groundings by name
+
+    Parameters
+    ----------
+    tables : dict
+        Maps namespaces to lists of (identifier, name) pairs, or of
+        (identifier, name, 'preferred') for names marked preferred. The
+        first name for an identifier is also preferred.
+    """
+    def __init__(self, tables):
+        # one entry per grounding
+        self.groundings = []
+        self.names = []
+        entry_of = {}
+        keyed = set()
+        for namespace, rows in tables.items():
+            priority = _priority(namespace)
+            for identifier, name, *marks in rows:
+                grounding = f'{namespace}:{identifier}'
+                entry = entry_of.get(grounding)
+                synonym = entry is not None and 'preferred' not in marks
+                if entry is None:
+                    entry = entry_of[grounding] = len(self.groundings)
+                    self.groundings.append(grounding)
+                    self.names.append(name)
+                key = normalize(name)
+                if key:
+                    # ties broken so preferred namespaces come first
+                    keyed.add((key, priority, entry, synonym))
+        keyed = sorted(keyed)
+        self.keys = [key for key, _, _, _ in keyed]
+        self.entries = array('I', (entry for _, _, entry, _
+                                   in keyed))
+        # 1 where the name is a preferred name of its entry
+        self.preferred = array('B', (not synonym for _, _, _, synonym
+                                     in keyed))
+        self.alphabet = ''.join(sorted(set().union(*set(self.keys))))
+
+    def __len__(self):
+        return len(self.groundings)
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', start)
+        return start, end
+
+    def exact(self, text):
+        """(name, grounding) of the only entry named text, or None
+
+        Names are used for automatic grounding, so a match is only returned
+        if text is a preferred name of one entry and no other entry has it
+        as a name or synonym. Aliases such as common English words used as
+        gene symbols are never matched.
+        """
+        key = normalize(text)
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, start)
+        if end == start or \
+                len({self.entries[position]
+                     for position in range(start, end)}) > 1 or \
+                not any(self.preferred[start:end]):
+            return None
+        entry = self.entries[start]
+        return self.names[entry], self.groundings[entry]
+
+    def _next_chars(self, prefix, start, end):
+        """Characters following prefix in the names from start to end"""
+        if end - start > 256:
+            return self.alphabet
+        return {self.keys[position][len(prefix)]
+                for position in range(start, end)
+                if len(self.keys[position]) > len(prefix)}
+
+    def _edits(self, key):
+        """Prefixes of names one deletion, transposition, substitution or
+        insertion away from key"""
+        edits = set()
+        for i in range(len(key) + 1):
+            left, right = key[:i], key[i:]
+            start, end = self._range(left)
+            # the part of key before the edit must begin some name
+            if start == end:
+                break
+            chars = self._next_chars(left, start, end)
+            if right:
+                edits.add(left + right[1:])
+                edits.update(left + char + right[1:] for char in chars)
+            if len(right) > 1:
+                edits.add(left + right[1] + right[0] + right[2:])
+            edits.update(left + char + right for char in chars)
+        edits.discard(key)
+        return edits
+
+    def suggest(self, query, k=10, fuzzy=True):
+        """Groundings whose names start with query
+
+        Parameters
+        ----------
+        query : str
+            Beginning of a name
+
+        k : Optional[int]
+            Largest number of suggestions. Default: 10
+
+        fuzzy : Optional[bool]
+            If no names start with a query of at least three characters,
+            suggest names starting with strings one edit away from it.
+            Default: True
+
+        Returns
+        -------
+        suggestions : list of dict
+            name, grounding, the matching name and whether the match was
+            fuzzy for each suggestion. Exact matches come first, then
+            shorter names, then names from preferred namespaces.
+        """
+        key = normalize(query)
+        if not key:
+            return []
+        ranges = [(False, *self._range(key))]
+        if fuzzy and ranges[0][1] == ranges[0][2] and len(key) >= 3:
+            for edit in sorted(self._edits(key)):
+                start, end = self._range(edit)
+                if start < end:
+                    ranges.append((True, start, end))
+        candidates = []
+        for is_fuzzy, start, end in ranges:
+            limit = k if is_fuzzy else _MAX_SCAN
+            for position in range(start, min(end, start + limit)):
+                match = self.keys[position]
+                entry = self.entries[position]
+                candidates.append(((is_fuzzy, match != key, len(match),
+                                    _priority(self.groundings[entry]),
+                                    match), entry))
+        candidates.sort()
+        suggestions = []
+        seen = set()
+        for (is_fuzzy, _, _, _, match), entry in candidates:
+            if entry in seen:
+                continue
+            seen.add(entry)
+            suggestions.append({'name': self.names[entry],
+                                'grounding': self.groundings[entry],
+                                'match': match, 'fuzzy': is_fuzzy})
+            if len(suggestions) == k:
+                break
+        return suggestions
+
+
+def names_path(data_path):
+    return os.path.join(data_path, 'names')
+
+
+def read_tables(path):
+    """Name tables in a directory, as taken by NameIndex"""
+    tables = {}
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith(_SUFFIX):
+            continue
+        with open(os.path.join(path, filename), 'r') as f:
+            tables[filename[:-len(_SUFFIX)]] = \
+                [tuple(line.rstrip('\n').split('\t')) for line in f
+                 if '\t' in line]
+    return tables
+
+
+def _table_mtimes(path):
+    try:
+        return tuple((filename, os.path.getmtime(os.path.join(path,
+                                                              filename)))
+                     for filename in sorted(os.listdir(path))
+                     if filename.endswith(_SUFFIX))
+    except FileNotFoundError:
+        return ()
+
+
+@lru_cache(maxsize=2)
+def _build_index(path, mtimes):
+    index = NameIndex(read_tables(path) if mtimes else {})
+    logger.info('Indexed %d names for %d groundings', len(index.keys),
+                len(index))
+    return index
+
+
+def get_index(data_path):
+    """Name index for a data directory, rebuilt when its tables change"""
+    path = names_path(data_path)
+    return _build_index(path, _table_mtimes(path))
+
+
+@bp.route('/names', methods=['GET'])
+def suggest():
+    """Suggest groundings for the beginning of a name
+
+    Takes the query in q and the number of suggestions in k. Returns a JSON
+    list of suggestions.
+    """
+    try:
+        k = min(int(request.args.get('k', 10)), MAX_SUGGESTIONS)
+    except ValueError:
+        k = 10
+    index = get_index(current_app.config['DATA'])
+    return jsonify(index.suggest(request.args.get('q', ''), k=k))
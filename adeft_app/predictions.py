@@ -0,0 +1,155 @@
+"""Cached predictions of a model on the texts of its text store
+
+train saves {name}_predictions.npz to the model directory with a row for
+each text: the predicted probability of each class, the predicted label,
+the grounding the text's defining patterns match if they match exactly one,
+and the number of statements drawn from the text. Labels are stored as
+indices into a labels array holding the model's classes, in the order of
+the probability columns, followed by any other matched groundings.
+
+The fix pages use the cache to show how fixes change the counts saved in
+{name}_stats.json without predicting again. Labels are mapped through the
+transition from model labels to new groundings. When several classes are
+merged into one grounding their probabilities are summed, and each text is
+predicted as the grounding with the largest sum.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+def predictions_path(data_path, model_name):
+    return os.path.join(data_path, 'models', model_name,
+                        f'{model_name}_predictions.npz')
+
+
+def _write(path, arrays):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def save_predictions(path, classes, proba, num_stmts, matched):
+    """Save predictions of a model
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to write
+
+    classes : list of str
+        Classes of the model in the order of the columns of proba
+
+    proba : numpy.ndarray
+        Predicted probabilities with a row for each text
+
+    num_stmts : list of int
+        Number of statements drawn from each text
+
+    matched : list of str|None
+        Grounding uniquely matched by each text's defining patterns, or
+        None if the text matches no grounding or several
+    """
+    labels = [str(label) for label in classes]
+    index = {label: position for position, label in enumerate(labels)}
+    for grounding in matched:
+        if grounding is not None and grounding not in index:
+            index[grounding] = len(labels)
+            labels.append(grounding)
+    proba = np.asarray(proba)
+    _write(path, {'labels': np.array(labels, dtype=str),
+                  'proba': proba.astype(np.float32),
+                  'pred': np.argmax(proba, axis=1).astype(np.int32),
+                  'matched': np.array([-1 if grounding is None
+                                       else index[grounding]
+                                       for grounding in matched],
+                                      dtype=np.int32),
+                  'num_stmts': np.asarray(num_stmts, dtype=np.int32)})
+
+
+@lru_cache(maxsize=8)
+def _load(path, mtime):
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def load_predictions(path):
+    """Arrays saved by save_predictions, or None if there is no file
+
+    Cached per file modification time.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    return _load(path, mtime)
+
+
+def relabel_predictions(path, transition):
+    """Map the labels of saved predictions through a transition
+
+    Used when fixes are submitted so the cache keeps the model's labels.
+    Does nothing if no predictions have been saved.
+    """
+    predictions = load_predictions(path)
+    if predictions is None:
+        return
+    predictions = dict(predictions)
+    predictions['labels'] = np.array([transition.get(label, label)
+                                      for label in
+                                      predictions['labels'].tolist()],
+                                     dtype=str)
+    _write(path, predictions)
+
+
+def preview(predictions, transition):
+    """Counts of texts and statements after fixing groundings
+
+    Parameters
+    ----------
+    predictions : dict
+        Arrays returned by load_predictions
+
+    transition : dict
+        Maps model labels to new groundings. Labels missing from it are
+        kept.
+
+    Returns
+    -------
+    counts : dict
+        preds_on_unlabeled maps each grounding to the number of texts
+        predicted as it, and groundings maps each grounding to the texts
+        uniquely matching it by defining patterns and their statements, in
+        the form of the model stats.
+    """
+    labels = predictions['labels'].tolist()
+    proba = predictions['proba']
+    groundings = sorted({transition.get(label, label) for label in labels})
+    column = {grounding: position
+              for position, grounding in enumerate(groundings)}
+    mapping = np.array([column[transition.get(label, label)]
+                        for label in labels], dtype=np.int32)
+    merged = mapping[:proba.shape[1]]
+    if len(set(merged.tolist())) == proba.shape[1]:
+        pred = mapping[predictions['pred']]
+    else:
+        merge = np.zeros((proba.shape[1], len(groundings)),
+                         dtype=proba.dtype)
+        merge[np.arange(proba.shape[1]), merged] = 1
+        pred = np.argmax(proba @ merge, axis=1)
+    predicted = np.bincount(pred, minlength=len(groundings))
+
+    has_match = predictions['matched'] >= 0
+    matched = mapping[predictions['matched'][has_match]]
+    matched_texts = np.bincount(matched, minlength=len(groundings))
+    matched_stmts = np.bincount(matched,
+                                weights=predictions['num_stmts'][has_match],
+                                minlength=len(groundings))
+    return {'preds_on_unlabeled': {grounding: int(predicted[position])
+                                   for grounding, position
+                                   in column.items()},
+            'groundings': {grounding: {'stmts': int(matched_stmts[position]),
+                                       'texts': int(matched_texts[position])}
+                           for grounding, position in column.items()}}
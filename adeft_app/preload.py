@@ -0,0 +1,194 @@
+"""Read-only data loaded once before a server forks its workers
+
+With PRELOAD set in the app config, create_app builds an index of every
+shortform's mined longforms, tables of the saved groundings of every
+shortform, the ontology name index and the model data for the models in
+PRELOAD_MODELS. Run under a preforking server that creates the app before
+forking, such as gunicorn with --preload, the workers then share these
+pages with the master process instead of each reading the files again.
+
+Pages stay shared only while no worker writes to them, and in CPython even
+reading an object writes to its reference count. The data is therefore
+kept in a few large objects, a bytes buffer of all longforms and an array
+of all scores, rather than as millions of small strings and floats.
+Groundings are kept as JSON bytes and decoded on use. Finally gc.freeze()
+moves everything allocated so far out of the garbage collector's reach so
+collections in the workers do not touch it.
+
+Each entry remembers the modification time of the file it was read from
+and is ignored once the file has changed, so the app falls back to reading
+files that are rewritten while it runs, such as saved groundings.
+"""
+import os
+import gc
+import json
+import logging
+from array import array
+
+from .filenames import unescape_filename
+
+
+logger = logging.getLogger(__file__)
+
+_SEPARATOR = b'\x00'
+_LONGFORMS_SUFFIX = '_longforms.json'
+_GROUNDING_FILES = ('grounding_map', 'names', 'pos_labels')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class LongformIndex(object):
+    """Scored longforms for every shortform in a data directory
+
+    Parameters
+    ----------
+    data_path : str
+        Data directory containing mined longforms
+    """
+    def __init__(self, data_path):
+        self.longforms_path = os.path.join(data_path, 'longforms')
+        chunks = []
+        scores = array('d')
+        # shortform -> (path, mtime, byte start, byte end, score start,
+        # score end)
+        self._entries = {}
+        position = 0
+        filenames = os.listdir(self.longforms_path) \
+            if os.path.isdir(self.longforms_path) else []
+        for filename in sorted(filenames):
+            if not filename.endswith(_LONGFORMS_SUFFIX):
+                continue
+            path = os.path.join(self.longforms_path, filename)
+            mtime = _mtime(path)
+            with open(path, 'r') as f:
+                scored_longforms = json.load(f)
+            encoded = _SEPARATOR.join(longform.encode('utf-8')
+                                      for longform, _ in scored_longforms)
+            start = len(scores)
+            scores.extend(score for _, score in scored_longforms)
+            shortform = unescape_filename(filename[:-len(_LONGFORMS_SUFFIX)])
+            self._entries[shortform] = (path, mtime, position,
+                                        position + len(encoded), start,
+                                        len(scores))
+            chunks.append(encoded)
+            position += len(encoded)
+        self._buffer = b''.join(chunks)
+        self._scores = scores
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, shortform):
+        """List of [longform, score] for a shortform, as in its file
+
+        Returns None if the shortform is not indexed or its file has
+        changed since it was indexed.
+        """
+        entry = self._entries.get(shortform)
+        if entry is None:
+            return None
+        path, mtime, start, end, score_start, score_end = entry
+        if _mtime(path) != mtime:
+            return None
+        if score_start == score_end:
+            return []
+        longforms = self._buffer[start:end].decode('utf-8').split('\x00')
+        return [[longform, score] for longform, score
+                in zip(longforms, self._scores[score_start:score_end])]
+
+
+class GroundingTables(object):
+    """Saved grounding maps, names and positive labels for every shortform
+
+    Parameters
+    ----------
+    data_path : str
+        Data directory containing saved groundings
+    """
+    def __init__(self, data_path):
+        groundings_path = os.path.join(data_path, 'groundings')
+        # shortform -> (paths, mtimes, JSON of the three files)
+        self._entries = {}
+        dirnames = os.listdir(groundings_path) \
+            if os.path.isdir(groundings_path) else []
+        for cased_shortform in sorted(dirnames):
+            paths = tuple(os.path.join(groundings_path, cased_shortform,
+                                       f'{cased_shortform}_{end}.json')
+                          for end in _GROUNDING_FILES)
+            mtimes = tuple(_mtime(path) for path in paths)
+            if None in mtimes:
+                continue
+            contents = []
+            for path in paths:
+                with open(path, 'r') as f:
+                    contents.append(json.load(f))
+            self._entries[unescape_filename(cased_shortform)] = \
+                (paths, mtimes, json.dumps(contents).encode('utf-8'))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, shortform):
+        """(grounding_map, names, pos_labels) for a shortform
+
+        Returns None if the shortform has no saved groundings or they have
+        changed since they were loaded.
+        """
+        entry = self._entries.get(shortform)
+        if entry is None:
+            return None
+        paths, mtimes, encoded = entry
+        if tuple(_mtime(path) for path in paths) != mtimes:
+            return None
+        return tuple(json.loads(encoded))
+
+
+class Preloaded(object):
+    """Read-only data shared by the workers of a preforking server"""
+    def __init__(self, longforms=None, groundings=None, models=()):
+        self.longforms = longforms
+        self.groundings = groundings
+        self.models = tuple(models)
+
+
+def init_app(app):
+    """Build preloaded data for app and freeze it for sharing with workers
+
+    Should be called once everything else has been set up.
+    """
+    from . import trips, fix
+    from .names import get_index
+
+    data_path = app.config['DATA']
+    # imported modules are shared too
+    trips.preload()
+    fix.preload()
+    get_index(data_path)
+    longforms = LongformIndex(data_path)
+    groundings = GroundingTables(data_path)
+    models = []
+    with app.app_context():
+        for model_name in app.config.get('PRELOAD_MODELS', []):
+            try:
+                fix.preload_model(model_name, data_path)
+            except EnvironmentError:
+                logger.warning('Could not preload model %s', model_name)
+                continue
+            models.append(model_name)
+    app.extensions['adeft_preload'] = Preloaded(longforms, groundings,
+                                                models)
+    logger.info('Preloaded longforms for %d shortforms, groundings for %d'
+                ' and %d models', len(longforms), len(groundings),
+                len(models))
+    gc.collect()
+    gc.freeze()
+
+
+def get_preloaded(app):
+    """Preloaded data for app, or None if PRELOAD is not set"""
+    return app.extensions.get('adeft_preload')
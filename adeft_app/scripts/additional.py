@@ -0,0 +1,82 @@
+"""Gather additional training texts from the text stores of other agents
+
+A model can be given extra examples of a grounding from the texts of a
+related agent text, for example texts about INSR for the insulin receptor
+grounding of IR. Text stores can be large, so each one is streamed rather
+than loaded, and a text is only kept if no earlier source, including the
+main text store, has already provided its text ref.
+"""
+import random
+import logging
+
+from adeft_app.scripts.text_store import iter_corpus
+
+
+logger = logging.getLogger(__file__)
+
+
+def gather_additional(additional, data_path, seen, max_per_source=None,
+                      random_state=0):
+    """Stream and deduplicate additional labeled texts
+
+    Parameters
+    ----------
+    additional : list of tuple
+        (grounding, name, agent_text) for each source of additional texts
+
+    data_path : str
+        Data directory containing a text store for each agent text
+
+    seen : set
+        Text refs that should not be used. Refs of texts taken from each
+        source are added so later sources cannot repeat them.
+
+    max_per_source : Optional[int]
+        Largest number of texts to take from a source. If a source has more
+        new texts, a uniform random sample of them is taken. Default: None
+
+    random_state : Optional[int]
+        Seed for sampling. Default: 0
+
+    Returns
+    -------
+    corpus : list of tuple
+        (text, grounding) pairs
+
+    report : list of dict
+        For each source, its grounding and agent text, the number of texts
+        it has, how many were skipped as already seen or empty, and how
+        many were used
+    """
+    rng = random.Random(random_state)
+    corpus = []
+    report = []
+    for grounding, name, agent_text in additional:
+        counts = {'grounding': grounding, 'agent_text': agent_text,
+                  'total': 0, 'duplicates': 0, 'empty': 0, 'used': 0}
+        # reservoir sample of (text ref, text) pairs not seen before
+        sample = []
+        new = 0
+        for text_ref, text in iter_corpus(agent_text, data_path):
+            counts['total'] += 1
+            if text_ref in seen:
+                counts['duplicates'] += 1
+                continue
+            if not text:
+                counts['empty'] += 1
+                continue
+            new += 1
+            if max_per_source is None or len(sample) < max_per_source:
+                sample.append((text_ref, text))
+            else:
+                index = rng.randrange(new)
+                if index < max_per_source:
+                    sample[index] = (text_ref, text)
+        for text_ref, text in sample:
+            seen.add(text_ref)
+            corpus.append((text, grounding))
+            counts['used'] += 1
+        logger.info('%d of %d texts used from %s for %s', counts['used'],
+                    counts['total'], agent_text, grounding)
+        report.append(counts)
+    return corpus, report
@@ -6,6 +6,32 @@ from adeft.discover import DeftMiner
 
 from adeft_app.locations import DATA_PATH
 from adeft_app.filenames import escape_filename
+from adeft_app.scripts.text_store import iter_corpus
+
+
+def mine_longforms(shortforms, texts):
+    """Mine longforms for each shortform from a list of texts
+
+    Parameters
+    ----------
+    shortforms : list of str
+        Shortforms to mine longforms for
+
+    texts : list of str
+        Texts to search for defining patterns
+
+    Returns
+    -------
+    results : dict
+        Maps each shortform to a tuple containing the list of scored
+        longforms and the top 100 scoring candidates
+    """
+    results = {}
+    for shortform in shortforms:
+        dm = DeftMiner(shortform)
+        dm.process_texts(texts)
+        results[shortform] = (dm.get_longforms(), dm.top(100))
+    return results
 
 
 if __name__ == '__main__':
@@ -16,16 +42,9 @@ if __name__ == '__main__':
     shortforms = args.vars
     agg_name = ':'.join(sorted([escape_filename(shortform)
                                 for shortform in shortforms]))
-    texts_path = os.path.join(DATA_PATH, 'texts', agg_name,
-                              f'{agg_name}_texts.json')
-    with open(texts_path, 'r') as f:
-        texts = json.load(f)
-    texts = texts.values()
-    texts = [text for text in texts if text]
-    for shortform in shortforms:
-        dm = DeftMiner(shortform)
-        dm.process_texts(texts)
-        longforms = dm.get_longforms()
+    texts = [text for _, text in iter_corpus(agg_name) if text]
+    results = mine_longforms(shortforms, texts)
+    for shortform, (longforms, top) in results.items():
         escaped_shortform = escape_filename(shortform)
         out_path = os.path.join(DATA_PATH, 'longforms',
                                 f'{escaped_shortform}_longforms.json')
@@ -34,4 +53,4 @@ if __name__ == '__main__':
         out_path = os.path.join(DATA_PATH, 'longforms',
                                 f'{escaped_shortform}_top.json')
         with open(out_path, 'w') as f:
-            json.dump(dm.top(100), f)
+            json.dump(top, f)
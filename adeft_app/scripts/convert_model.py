@@ -0,0 +1,77 @@
+"""Convert stored models between adeft's format and the compact format
+
+By default the compact artifact is written next to the existing
+{name}_model.gz with float32 weights and without features that have zero
+weight for every class. --lossless keeps float64 weights and every feature.
+Once it exists the app and disambiguate.py load it in preference to the .gz
+file, and fixing the model in the app updates both.
+
+Example
+-------
+python -m adeft_app.scripts.convert_model IR --lossless
+python -m adeft_app.scripts.convert_model IR --to gz
+"""
+import os
+import argparse
+
+from adeft_app.locations import DATA_PATH
+from adeft_app.filenames import escape_filename
+from adeft_app.artifacts import convert, COMPACT_SUFFIX, GZ_SUFFIX
+
+
+def convert_model(model_name, to='compact', data_path=DATA_PATH, **options):
+    """Convert a model's artifact to the given format
+
+    Parameters
+    ----------
+    model_name : str
+        Name of a model directory in data/models
+
+    to : Optional[str]
+        Either compact or gz. Default: compact
+
+    data_path : Optional[str]
+        Data directory containing models. Default: DATA_PATH
+
+    **options
+        Passed to adeft_app.artifacts.write_compact
+
+    Returns
+    -------
+    out_path : str
+        Path of the converted artifact
+    """
+    model_name = escape_filename(model_name)
+    model_dir = os.path.join(data_path, 'models', model_name)
+    compact_path = os.path.join(model_dir, f'{model_name}{COMPACT_SUFFIX}')
+    gz_path = os.path.join(model_dir, f'{model_name}{GZ_SUFFIX}')
+    if to == 'compact':
+        convert(gz_path, compact_path, **options)
+        return compact_path
+    convert(compact_path, gz_path)
+    return gz_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a model between'
+                                     ' adeft and compact artifact formats')
+    parser.add_argument('model_names', nargs='+')
+    parser.add_argument('--to', choices=['compact', 'gz'], default='compact')
+    parser.add_argument('--lossless', action='store_true',
+                        help='Store coefficients and idf weights as float64'
+                        ' and keep features with zero weight for every'
+                        ' class. By default the model is pruned, which'
+                        ' changes predictions slightly.')
+    parser.add_argument('--dense', action='store_true',
+                        help='Store coefficients as a dense array')
+    args = parser.parse_args()
+    for model_name in args.model_names:
+        if args.to == 'compact':
+            out_path = convert_model(model_name,
+                                     dtype=('float64' if args.lossless
+                                            else 'float32'),
+                                     sparse=not args.dense,
+                                     prune=not args.lossless)
+        else:
+            out_path = convert_model(model_name, to='gz')
+        print(out_path, os.path.getsize(out_path))
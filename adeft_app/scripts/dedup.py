@@ -0,0 +1,271 @@
+"""Find near duplicate texts in a text store with MinHash and LSH
+
+The same abstract or full text is often fetched many times through
+different text refs. Each text is reduced to a MinHash signature over its
+word shingles, signatures are split into bands, and texts sharing a band are
+candidate duplicates. Texts with identical signatures are grouped first.
+Each candidate is then compared with one text from each group already in
+its bucket, so a flood of copies of one text costs a comparison per copy
+rather than per pair. Candidates whose estimated Jaccard similarity is at
+least the threshold are grouped, and every text in a group is mapped to a
+canonical text, the first of the group in the store.
+
+Signatures are computed in parallel. The mapping from each dropped text ref
+to its canonical text ref is written to {name}_dedup.json next to the text
+store, where train can use it, with a hash of the text refs of the store.
+The mapping is not used once the texts of the store have changed.
+
+Example
+-------
+python -m adeft_app.scripts.dedup IR --threshold 0.9 --workers 4
+"""
+import os
+import json
+import zlib
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from adeft_app.locations import DATA_PATH
+from adeft_app.filenames import escape_filename
+from adeft_app.scripts.text_store import iter_corpus, load_text_map
+
+
+logger = logging.getLogger(__file__)
+
+
+def _permutations(num_perm, seed):
+    # multiply-shift hashing of 32 bit values to 32 bits. a must be odd.
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)
+    return a | np.uint64(1), b
+
+
+def shingle_hashes(text, shingle_size=5):
+    """32 bit hashes of the word shingles of a text"""
+    words = text.lower().split()
+    if len(words) < shingle_size:
+        shingles = [' '.join(words)]
+    else:
+        shingles = {' '.join(words[i:i+shingle_size])
+                    for i in range(len(words) - shingle_size + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8'))
+                        for shingle in shingles), dtype=np.uint64)
+
+
+def signatures(texts, num_perm=128, shingle_size=5, seed=1):
+    """MinHash signatures for a list of texts, one row per text"""
+    a, b = _permutations(num_perm, seed)
+    result = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for index, text in enumerate(texts):
+        hashes = shingle_hashes(text, shingle_size)
+        # products wrap modulo 2**64, the high bits are the hash
+        values = (a[:, None]*hashes[None, :] + b[:, None]) >> np.uint64(32)
+        result[index] = values.min(axis=1)
+    return result
+
+
+def lsh_bands(num_perm, threshold):
+    """Number of bands and rows per band for a similarity threshold
+
+    Texts with similarity s share a band with probability
+    1 - (1 - s**rows)**bands. The split is chosen to put the steepest part
+    of this curve, near (1/bands)**(1/rows), at the threshold.
+    """
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1)
+              if num_perm % bands == 0]
+    return min(splits, key=lambda split:
+               abs((1/split[0])**(1/split[1]) - threshold))
+
+
+def _signature_chunk(args):
+    texts, num_perm, shingle_size, seed = args
+    return signatures(texts, num_perm, shingle_size, seed)
+
+
+def find_duplicates(text_dict, threshold=0.9, num_perm=128, shingle_size=5,
+                    n_workers=1, chunk_size=1000, seed=1):
+    """Map each near duplicate text ref to its canonical text ref
+
+    Parameters
+    ----------
+    text_dict : dict
+        Maps text refs to texts. Empty texts are ignored.
+
+    threshold : Optional[float]
+        Estimated Jaccard similarity of word shingles at or above which two
+        texts are duplicates. Default: 0.9
+
+    num_perm : Optional[int]
+        Length of MinHash signatures. Default: 128
+
+    shingle_size : Optional[int]
+        Number of words in each shingle. Default: 5
+
+    n_workers : Optional[int]
+        Number of processes computing signatures. Default: 1
+
+    chunk_size : Optional[int]
+        Number of texts per task sent to a process. Default: 1000
+
+    seed : Optional[int]
+        Seed for the MinHash permutations. Default: 1
+
+    Returns
+    -------
+    canonical : dict
+        Maps each duplicate text ref to the ref of the first text in the
+        store that it duplicates. Canonical texts are not included.
+    """
+    refs = [ref for ref, text in text_dict.items() if text]
+    texts = [text_dict[ref] for ref in refs]
+    tasks = [(texts[start:start+chunk_size], num_perm, shingle_size, seed)
+             for start in range(0, len(texts), chunk_size)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunks = list(executor.map(_signature_chunk, tasks))
+    else:
+        chunks = [_signature_chunk(task) for task in tasks]
+    if not chunks:
+        return {}
+    sigs = np.vstack(chunks)
+
+    bands, rows = lsh_bands(num_perm, threshold)
+    # union find over texts, roots are always the earliest text in a group
+    parent = list(range(len(refs)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    # texts with identical signatures are grouped without comparing them,
+    # and only the first of them takes part in banding
+    first = {}
+    distinct = []
+    for index in range(len(refs)):
+        key = sigs[index].tobytes()
+        if key in first:
+            parent[index] = first[key]
+        else:
+            first[key] = index
+            distinct.append(index)
+
+    for band in range(bands):
+        # each bucket keeps one text for each group found in it, and a
+        # candidate is compared with these rather than with every member
+        buckets = {}
+        band_sigs = np.ascontiguousarray(sigs[:, band*rows:(band+1)*rows])
+        for index in distinct:
+            groups = buckets.setdefault(band_sigs[index].tobytes(), [])
+            for member in groups:
+                root, other = find(member), find(index)
+                if root == other:
+                    break
+                if np.mean(sigs[member] == sigs[index]) >= threshold:
+                    parent[max(root, other)] = min(root, other)
+                    break
+            else:
+                groups.append(index)
+    canonical = {}
+    for index, ref in enumerate(refs):
+        root = find(index)
+        if root != index:
+            canonical[ref] = refs[root]
+    logger.info('%d of %d texts are near duplicates', len(canonical),
+                len(refs))
+    return canonical
+
+
+def apply_dedup(text_dict, ref_dict, canonical):
+    """Drop duplicate texts and point statements at canonical texts
+
+    Parameters
+    ----------
+    text_dict : dict
+        Maps text refs to texts
+
+    ref_dict : dict
+        Maps statement ids to text refs
+
+    canonical : dict
+        Maps duplicate text refs to canonical text refs, as returned by
+        find_duplicates
+
+    Returns
+    -------
+    text_dict : dict
+        Texts without duplicates
+
+    ref_dict : dict
+        Maps statement ids to canonical text refs, so statements drawn from
+        dropped texts are still counted
+    """
+    text_dict = {ref: text for ref, text in text_dict.items()
+                 if ref not in canonical}
+    ref_dict = {stmt: type(ref)(canonical.get(str(ref), ref))
+                for stmt, ref in ref_dict.items()}
+    return text_dict, ref_dict
+
+
+def dedup_path(agg_name, data_path=DATA_PATH):
+    return os.path.join(data_path, 'texts', agg_name,
+                        f'{agg_name}_dedup.json')
+
+
+def _refs_hash(agg_name, data_path):
+    """Hash of the text refs of a text store"""
+    refs = {str(ref) for ref in load_text_map(agg_name, data_path).values()}
+    digest = hashlib.sha1()
+    for ref in sorted(refs):
+        digest.update(ref.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def load_dedup(agg_name, threshold, data_path=DATA_PATH):
+    """Saved duplicates for a text store, or None if not found for threshold
+    or the store has changed since they were found
+    """
+    try:
+        with open(dedup_path(agg_name, data_path), 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    if saved['threshold'] != threshold:
+        return None
+    if saved.get('refs_hash') != _refs_hash(agg_name, data_path):
+        logger.info('The texts of %s have changed since duplicates were'
+                    ' found', agg_name)
+        return None
+    return saved['canonical']
+
+
+def save_dedup(agg_name, canonical, threshold, data_path=DATA_PATH):
+    with open(dedup_path(agg_name, data_path), 'w') as f:
+        json.dump({'threshold': threshold,
+                   'refs_hash': _refs_hash(agg_name, data_path),
+                   'canonical': canonical}, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find near duplicate texts'
+                                     ' in the text store for shortforms')
+    parser.add_argument('shortforms', nargs='+')
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--num-perm', type=int, default=128)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    agg_name = ':'.join(sorted(escape_filename(shortform)
+                               for shortform in args.shortforms))
+    text_dict = dict(iter_corpus(agg_name))
+    canonical = find_duplicates(text_dict, threshold=args.threshold,
+                                num_perm=args.num_perm,
+                                n_workers=args.workers)
+    save_dedup(agg_name, canonical, args.threshold)
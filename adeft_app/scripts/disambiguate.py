@@ -0,0 +1,205 @@
+"""Disambiguate shortforms in a large collection of texts with stored models
+
+Loads a model trained by model.py once in each of a pool of worker processes
+and sends texts to the workers in chunks. Each chunk is checked for defining
+patterns and the texts without a single unambiguous match are vectorized and
+classified together. Results are written as JSON lines in the order of the
+input texts, one line per text with the chosen grounding, its name and the
+predicted probability of every label.
+
+Texts are read from the text store for the model, data/texts/<name>, unless
+other files are given. These can be text store corpus files, JSON files
+mapping text ids to texts, or JSON lines files containing objects with id and
+text keys. When a text store has a text map, the ids of the statements
+drawn from each text are included in the output.
+
+Example
+-------
+python -m adeft_app.scripts.disambiguate IR --workers 8 --output IR.jsonl
+"""
+import os
+import json
+import logging
+import argparse
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from adeft.disambiguate import DeftDisambiguator
+
+from adeft_app.locations import DATA_PATH
+from adeft_app.artifacts import load_model, model_path
+from adeft_app.scripts.text_store import corpus_path, iter_corpus
+
+
+logger = logging.getLogger(__file__)
+
+# set in each worker process by _init_worker
+_disambiguator = None
+
+
+def load_disambiguator(model_name, data_path=DATA_PATH):
+    """Load a model and its grounding files from the models directory
+
+    The compact artifact for the model is used if there is one.
+    """
+    model = load_model(model_path(os.path.join(data_path, 'models'),
+                                  model_name))
+    models_path = os.path.join(data_path, 'models', model_name)
+    with open(os.path.join(models_path,
+                           f'{model_name}_grounding_dict.json'), 'r') as f:
+        grounding_dict = json.load(f)
+    with open(os.path.join(models_path, f'{model_name}_names.json'),
+              'r') as f:
+        names = json.load(f)
+    return DeftDisambiguator(model, grounding_dict, names)
+
+
+def _init_worker(model_name, data_path):
+    global _disambiguator
+    _disambiguator = load_disambiguator(model_name, data_path)
+
+
+def _disambiguate_chunk(texts):
+    return _disambiguator.disambiguate(texts)
+
+
+def default_texts(model_name, data_path=DATA_PATH):
+    """Path to the text store a model was trained from"""
+    path = corpus_path(model_name, data_path)
+    if os.path.exists(path):
+        return path
+    return os.path.join(data_path, 'texts', model_name,
+                        f'{model_name}_texts.json')
+
+
+def iter_texts(path):
+    """Generate (text id, text, statement ids) from a texts file
+
+    Statement ids are None unless path is a text store with a text map.
+    Empty texts are skipped.
+    """
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('text'):
+                    yield entry['id'], entry['text'], None
+        return
+    stmts = None
+    suffix = '_corpus.json'
+    if path.endswith(suffix):
+        agg_name = os.path.basename(path)[:-len(suffix)]
+        data_path = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+        text_dict = iter_corpus(agg_name, data_path)
+    else:
+        suffix = '_texts.json'
+        with open(path, 'r') as f:
+            text_dict = json.load(f).items()
+    if path.endswith(suffix):
+        text_map_path = path[:-len(suffix)] + '_text_map.json'
+        if os.path.exists(text_map_path):
+            with open(text_map_path, 'r') as f:
+                ref_dict = json.load(f)
+            stmts = defaultdict(list)
+            for stmt, ref in ref_dict.items():
+                stmts[str(ref)].append(stmt)
+    for ref, text in text_dict:
+        if text:
+            yield ref, text, stmts.get(ref, []) if stmts is not None else None
+
+
+def _chunks(entries, chunk_size):
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def disambiguate(model_name, text_paths, out, n_workers=4, chunk_size=500,
+                 data_path=DATA_PATH):
+    """Disambiguate texts with a stored model, writing JSON lines to out
+
+    Parameters
+    ----------
+    model_name : str
+        Name of a model directory in data/models
+
+    text_paths : list of str
+        JSON text stores or JSON lines files of texts to disambiguate
+
+    out : file
+        Writable text file for results
+
+    n_workers : Optional[int]
+        Number of worker processes. Default: 4
+
+    chunk_size : Optional[int]
+        Number of texts sent to a worker at a time. Default: 500
+
+    data_path : Optional[str]
+        Data directory containing models. Default: DATA_PATH
+
+    Returns
+    -------
+    count : int
+        Number of texts disambiguated
+    """
+    entries = (entry for path in text_paths for entry in iter_texts(path))
+    count = 0
+    # bound the number of chunks in flight so texts are streamed rather
+    # than all loaded at once, and write results in input order
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_init_worker,
+                             initargs=(model_name, data_path)) as executor:
+        def write_next():
+            chunk, future = pending.popleft()
+            for (ref, _, stmts), (grounding, name, probs) \
+                    in zip(chunk, future.result()):
+                result = {'model': model_name, 'id': ref,
+                          'grounding': grounding, 'name': name,
+                          'probabilities': probs}
+                if stmts is not None:
+                    result['stmts'] = stmts
+                out.write(json.dumps(result) + '\n')
+            return len(chunk)
+
+        for chunk in _chunks(entries, chunk_size):
+            future = executor.submit(_disambiguate_chunk,
+                                     [text for _, text, _ in chunk])
+            pending.append((chunk, future))
+            if len(pending) >= 2*n_workers:
+                count += write_next()
+                logger.info('%d texts disambiguated', count)
+        while pending:
+            count += write_next()
+    logger.info('Finished. %d texts disambiguated with %s', count,
+                model_name)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disambiguate many texts'
+                                     ' with a stored model')
+    parser.add_argument('model_name')
+    parser.add_argument('--texts', nargs='*', default=None,
+                        help='JSON text stores or JSON lines files. Default:'
+                        ' the text store for the model')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--output', default=None,
+                        help='Default: <model_name>_groundings.jsonl')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    text_paths = args.texts or [default_texts(args.model_name)]
+    output = args.output or f'{args.model_name}_groundings.jsonl'
+    with open(output, 'w') as f:
+        disambiguate(args.model_name, text_paths, f, n_workers=args.workers,
+                     chunk_size=args.chunk_size)
@@ -1,8 +1,160 @@
+"""Find statements with genes whose agent text is a common English word
+
+Words from the NLTK word list are first intersected with a vocabulary of
+known agent texts if one is given, so that only words which can match are
+queried. The remaining words are queried in chunks by a pool of threads.
+The result of each chunk is appended to a JSON lines file in DATA_PATH as
+soon as it arrives, and chunks already in the file are skipped, so an
+interrupted scan can be restarted. Once every chunk is done the results are
+combined into genes_with_english_names.json.
+
+Example
+-------
+python -m adeft_app.scripts.genes_with_common_word_alias --workers 4
+"""
+import os
 import json
-from nltk.corpus import words
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from adeft_app.locations import DATA_PATH
+
+
+logger = logging.getLogger(__file__)
+
+
+def load_vocabulary(path):
+    """Set of agent texts from a JSON list or a file with one per line"""
+    with open(path, 'r') as f:
+        if path.endswith('.json'):
+            return set(json.load(f))
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def candidate_words(words, vocabulary=None):
+    """Sorted unique words, restricted to vocabulary if given"""
+    words = set(words)
+    if vocabulary is not None:
+        words &= vocabulary
+    return sorted(words)
+
+
+def _chunk_key(chunk):
+    return hashlib.sha1('\n'.join(chunk).encode('utf-8')).hexdigest()
+
+
+def _load_checkpoint(path):
+    """Results of chunks already in a JSON lines file by chunk key"""
+    done = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                # a partial last line is from an interrupted write
+                if not line.endswith('\n'):
+                    break
+                entry = json.loads(line)
+                done[entry['key']] = entry['results']
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def scan(words, out_path, query=None, chunk_size=1000, n_workers=4):
+    """Query statements with gene agents whose text is one of words
+
+    Parameters
+    ----------
+    words : list of str
+        Agent texts to query
+
+    out_path : str
+        JSON lines file to which the results of each chunk are appended
+
+    query : Optional[function]
+        Takes a list of agent texts and returns a dict mapping agent texts
+        to statement ids. Default: get_stmts_with_agent_text_in from
+        indra_db, filtered to genes
+
+    chunk_size : Optional[int]
+        Number of words in each query. Default: 1000
+
+    n_workers : Optional[int]
+        Number of queries run at once. Default: 4
+
+    Returns
+    -------
+    results : dict
+        Maps agent texts to statement ids, combined over all chunks
+
+    Raises
+    ------
+    RuntimeError
+        If the query failed for any chunk. The results of the other chunks
+        are kept.
+    """
+    if query is None:
+        from indra_db.util.content_scripts import \
+            get_stmts_with_agent_text_in
+
+        def query(chunk):
+            return get_stmts_with_agent_text_in(chunk, filter_genes=True)
+    chunks = [words[start:start+chunk_size]
+              for start in range(0, len(words), chunk_size)]
+    done = _load_checkpoint(out_path)
+    keys = [_chunk_key(chunk) for chunk in chunks]
+    to_run = [(key, chunk) for key, chunk in zip(keys, chunks)
+              if key not in done]
+    logger.info('%d of %d chunks already done', len(chunks) - len(to_run),
+                len(chunks))
+    with open(out_path, 'a') as f, \
+            ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(query, chunk): key
+                   for key, chunk in to_run}
+        failed = 0
+        for count, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            # keep the chunks that succeed so a rerun only retries failures
+            try:
+                done[key] = future.result()
+            except Exception:
+                logger.exception('Query for chunk %s failed', key)
+                failed += 1
+                continue
+            f.write(json.dumps({'key': key, 'results': done[key]}) + '\n')
+            f.flush()
+            logger.info('%d of %d chunks queried', count, len(to_run))
+    if failed:
+        raise RuntimeError(f'Queries for {failed} chunks failed. Run again'
+                           ' to retry them.')
+    results = {}
+    for key in keys:
+        results.update(done[key])
+    return results
+
 
-from indra_db.util.content_scripts import get_stmts_with_agent_text_in
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find statements with gene'
+                                     ' agents whose text is an English word')
+    parser.add_argument('--vocabulary', default=None,
+                        help='Known agent texts, as a JSON list or one per'
+                        ' line. Only words in it are queried.')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    from nltk.corpus import words
 
-bogosity = get_stmts_with_agent_text_in(words.words(), filter_genes=True)
-with open(f'../data/genes_with_english_names.json', 'w') as f:
-    json.dump(bogosity, f)
+    vocabulary = load_vocabulary(args.vocabulary) \
+        if args.vocabulary is not None else None
+    candidates = candidate_words(words.words(), vocabulary)
+    logger.info('Querying %d words', len(candidates))
+    results = scan(candidates,
+                   os.path.join(DATA_PATH,
+                                'genes_with_english_names.jsonl'),
+                   chunk_size=args.chunk_size, n_workers=args.workers)
+    with open(os.path.join(DATA_PATH, 'genes_with_english_names.json'),
+              'w') as f:
+        json.dump(results, f)
@@ -2,17 +2,20 @@ import os
 import json
 import argparse
 
-from indra.literature.adeft_tools import universal_extract_text
 from indra_db.util.content_scripts import get_text_content_from_stmt_ids
 
 from adeft_app.locations import DATA_PATH
 from adeft_app.filenames import escape_filename
+from adeft_app.scripts.text_store import TextStore, save_corpus, store_path
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Get texts for statements'
                                      ' with agent from a list of shortforms')
     parser.add_argument('vars', nargs='*')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Look up text refs and fetch content for'
+                        ' statements already in the text store')
     args = parser.parse_args()
     shortforms = args.vars
     all_stmts = set()
@@ -25,15 +28,21 @@ if __name__ == '__main__':
         with open(path, 'r') as f:
             stmts = json.load(f)
         all_stmts.update(stmts)
-        ref_dict, text_dict = get_text_content_from_stmt_ids(all_stmts)
-    text_dict = {text_ref: universal_extract_text(article,
-                                                  contains=shortforms)
-                 for text_ref, article in text_dict.items() if article}
+    with TextStore(store_path()) as store:
+        known = store.statements
+        # only statements never looked up before are fetched
+        new_stmts = all_stmts if args.refresh else all_stmts - set(known)
+        if new_stmts:
+            ref_dict, text_dict = get_text_content_from_stmt_ids(new_stmts)
+            store.put_many(text_dict, shortforms=shortforms)
+            store.add_statements({stmt: ref_dict.get(stmt)
+                                  for stmt in new_stmts})
+        ref_dict = {stmt: known[stmt] for stmt in all_stmts
+                    if known.get(stmt) is not None}
+        text_refs = sorted({str(ref) for ref in ref_dict.values()
+                            if ref in store})
     agg_name = ':'.join(cased_shortforms)
-    dir_path = os.path.join(DATA_PATH, 'texts', agg_name)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    with open(os.path.join(dir_path, f'{agg_name}_texts.json'), 'w') as f:
-        json.dump(text_dict, f)
-    with open(os.path.join(dir_path, f'{agg_name}_text_map.json'), 'w') as f:
+    save_corpus(agg_name, shortforms, text_refs)
+    with open(os.path.join(DATA_PATH, 'texts', agg_name,
+                           f'{agg_name}_text_map.json'), 'w') as f:
         json.dump(ref_dict, f)
@@ -0,0 +1,98 @@
+"""Report how much memory the workers of a preforking server share
+
+For each process, reads /proc/<pid>/smaps_rollup and reports its resident
+set, its proportional set size (shared pages divided evenly between the
+processes sharing them), the pages it alone has (unique) and the pages it
+shares with other processes (shared). With PRELOAD set, workers forked from
+a master that built the app should show most of the preloaded data as
+shared. Linux only.
+
+Example
+-------
+python -m adeft_app.scripts.memory_report --master $(cat gunicorn.pid)
+"""
+import os
+import json
+import argparse
+
+
+_FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'unique',
+           'Private_Dirty': 'unique', 'Shared_Clean': 'shared',
+           'Shared_Dirty': 'shared', 'Swap': 'swap'}
+
+
+def children(pid):
+    """Process ids of the children of a process"""
+    result = []
+    task_path = f'/proc/{pid}/task'
+    for task in os.listdir(task_path):
+        with open(os.path.join(task_path, task, 'children')) as f:
+            result.extend(int(child) for child in f.read().split())
+    return sorted(result)
+
+
+def process_memory(pid):
+    """Memory of a process in kB
+
+    Returns
+    -------
+    memory : dict
+        rss, pss, unique, shared and swap in kB
+    """
+    memory = dict.fromkeys(_FIELDS.values(), 0)
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            field, _, value = line.partition(':')
+            if field in _FIELDS:
+                memory[_FIELDS[field]] += int(value.split()[0])
+    return memory
+
+
+def memory_report(pids):
+    """Memory of each process, and the total
+
+    Parameters
+    ----------
+    pids : list of int
+        Process ids
+
+    Returns
+    -------
+    report : list of dict
+        For each process, its pid and memory as returned by process_memory.
+        The last entry has pid 'total' and sums the others. Summed pss is
+        the memory used by the processes together.
+    """
+    report = []
+    for pid in pids:
+        entry = {'pid': pid}
+        entry.update(process_memory(pid))
+        report.append(entry)
+    total = {'pid': 'total'}
+    for key in _FIELDS.values():
+        total[key] = sum(entry[key] for entry in report)
+    report.append(total)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report unique and shared'
+                                     ' memory of server processes')
+    parser.add_argument('pids', nargs='*', type=int)
+    parser.add_argument('--master', type=int,
+                        help='Report on this process and its children')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    pids = list(args.pids)
+    if args.master is not None:
+        pids = [args.master] + children(args.master) + pids
+    if not pids:
+        parser.error('no processes given')
+    report = memory_report(pids)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        columns = ['pid', 'rss', 'pss', 'unique', 'shared', 'swap']
+        print(''.join(f'{column:>12}' for column in columns) + '  (kB)')
+        for entry in report:
+            print(''.join(f'{entry[column]:>12}' for column in columns))
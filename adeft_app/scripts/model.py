@@ -1,7 +1,8 @@
 import os
 import json
-import pandas as pd
-from collections import Counter, defaultdict
+import tempfile
+import numpy as np
+from collections import Counter
 
 from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import cross_val_predict
@@ -11,19 +12,102 @@ from adeft.recognize import DeftRecognizer
 from adeft.modeling.classify import DeftClassifier
 from adeft.modeling.corpora import DeftCorpusBuilder
 
+from adeft_app.features import (feature_names_from_vocabulary,
+                                important_terms)
+from adeft_app.hashing import HashingTfidfVectorizer
+from adeft_app.summary import write_summary
+from adeft_app.artifacts import COMPACT_SUFFIX, GZ_SUFFIX, dump_model
 from adeft_app.locations import DATA_PATH
+from adeft_app.predictions import predictions_path, save_predictions
 from adeft_app.filenames import escape_filename
+from adeft_app.scripts.dedup import (apply_dedup, find_duplicates,
+                                     load_dedup, save_dedup)
+from adeft_app.scripts.search import halving_search
+from adeft_app.scripts.additional import gather_additional
+from adeft_app.scripts.streaming import (ShuffledSpool, chunked,
+                                         train_streaming)
+from adeft_app.scripts.text_store import (iter_corpus, load_corpus,
+                                          load_text_map)
 from adeft_app.scripts.consistency import check_grounding_dict
 
 
-def train(shortforms, additional=None, n_jobs=1):
-    """Train a deft model and produce quality statistics"""
+def train(shortforms, additional=None, n_jobs=1, data_path=None,
+          param_grid=None, search='grid', dedup=None, max_per_source=None,
+          streaming=False, chunk_size=2000, epochs=5, n_features=2**18):
+    """Train a deft model and produce quality statistics
+
+    Parameters
+    ----------
+    shortforms : list of str
+        Shortforms to combine into one model
+
+    additional : Optional[list of tuple]
+        (grounding, name, agent_text) for each source of additional texts
+
+    n_jobs : Optional[int]
+        Number of jobs for crossvalidation. Default: 1
+
+    data_path : Optional[str]
+        Data directory. Default: DATA_PATH
+
+    param_grid : Optional[dict]
+        Lists of values to try for C, max_features and ngram_range.
+        Default: C of 100.0 with 10000 features of unigrams and bigrams
+
+    search : Optional[str]
+        grid for an exhaustive grid search or halving for a successive
+        halving search whose trials are saved to {name}_trials.jsonl in the
+        model directory. Default: grid
+
+    dedup : Optional[float]
+        If given, near duplicate texts with at least this similarity are
+        dropped before computing statistics and building the corpus.
+        Statements from dropped texts are counted for their canonical
+        texts. Duplicates are saved to {name}_dedup.json in the text store
+        and reused. Default: None
+
+    max_per_source : Optional[int]
+        Largest number of texts to take from each source of additional
+        texts. Larger sources are sampled. Default: None
+
+    streaming : Optional[bool]
+        If True, train out of core on hashed features with
+        adeft_app.scripts.streaming, reading texts in chunks, and save the
+        model only as a compact artifact. param_grid must then give one
+        value of C and ngram_range, and max_features is ignored. Duplicates
+        are only dropped if they have already been found with
+        adeft_app.scripts.dedup. Default: False
+
+    chunk_size : Optional[int]
+        Number of texts in each chunk when streaming. Default: 2000
+
+    epochs : Optional[int]
+        Number of passes over the corpus to fit the model when streaming.
+        Default: 5
+
+    n_features : Optional[int]
+        Number of columns features are hashed to when streaming.
+        Default: 2**18
+
+    The options given are saved to {name}_training.json in the model
+    directory so the model can be retrained the same way after it is
+    fixed. See load_training_options.
+    """
+    options = {'additional': additional, 'param_grid': param_grid,
+               'search': search, 'dedup': dedup,
+               'max_per_source': max_per_source, 'streaming': streaming,
+               'chunk_size': chunk_size, 'epochs': epochs,
+               'n_features': n_features}
     if additional is None:
         additional = []
+    if param_grid is None:
+        param_grid = {'C': [100.0], 'max_features': [10000],
+                      'ngram_range': [(1, 2)]}
+    if data_path is None:
+        data_path = DATA_PATH
     # gather needed data
-    groundings_path = os.path.join(DATA_PATH, 'groundings')
-    texts_path = os.path.join(DATA_PATH, 'texts')
-    models_path = os.path.join(DATA_PATH, 'models')
+    groundings_path = os.path.join(data_path, 'groundings')
+    models_path = os.path.join(data_path, 'models')
 
     grounding_dict = {}
     names = {}
@@ -54,193 +138,329 @@ def train(shortforms, additional=None, n_jobs=1):
     # model name is built up from shortforms in model
     # (most models only have one shortform)
     agg_name = ':'.join(cased_shortforms)
-    with open(os.path.join(texts_path, agg_name,
-                           f'{agg_name}_texts.json'), 'r') as f:
-        text_dict = json.load(f)
-    with open(os.path.join(texts_path, agg_name,
-                           f'{agg_name}_text_map.json'), 'r') as f:
-        ref_dict = json.load(f)
+    if streaming:
+        deft_cl = _train_streaming(shortforms, agg_name, grounding_dict,
+                                   names, pos_labels, additional, data_path,
+                                   param_grid, dedup, max_per_source, n_jobs,
+                                   chunk_size, epochs, n_features)
+        _save_training_options(agg_name, options, data_path)
+        return deft_cl
+    text_dict, ref_dict = load_corpus(agg_name, data_path)
+
+    canonical = {}
+    if dedup is not None:
+        canonical = load_dedup(agg_name, dedup, data_path)
+        if canonical is None:
+            canonical = find_duplicates(text_dict, threshold=dedup,
+                                        n_workers=n_jobs)
+            save_dedup(agg_name, canonical, dedup, data_path)
+        text_dict, ref_dict = apply_dedup(text_dict, ref_dict, canonical)
 
     # get statistics for matches to standard patterns
     stats = adeft_stats(grounding_dict, names, text_dict, ref_dict)
 
     # build corpus for training models
-    refs, texts = zip(*text_dict.items())
-    texts = [text for text in texts if text is not None]
+    refs, texts = zip(*[(ref, text) for ref, text in text_dict.items()
+                        if text is not None])
     deft_cb = DeftCorpusBuilder(grounding_dict)
     corpus = deft_cb.build_from_texts(texts)
 
     # gather additional texts
-    for grounding, name, agent_text in additional:
+    seen = set(text_dict) | set(canonical)
+    additional_corpus, additional_report = \
+        gather_additional(additional, data_path, seen,
+                          max_per_source=max_per_source)
+    corpus.extend(additional_corpus)
+    for grounding, name, _ in additional:
         names[grounding] = name
-        with open(os.path.join(texts_path, agent_text,
-                               f'{agent_text}_texts.json'), 'r') as f:
-            additional_texts = json.load(f)
-            corpus.extend([(text, grounding)
-                           for text_ref, text in additional_texts.items()
-                           if text_ref not in text_dict])
-            pos_labels.append(grounding)
-
-    pos_labels = sorted(set(pos_labels))
+    pos_labels = sorted(set(pos_labels) |
+                        {grounding for grounding, _, _ in additional})
 
     train, labels = zip(*corpus)
     deft_cl = DeftClassifier(shortforms, pos_labels)
-    params = {'C': [100.0], 'max_features': [10000],
-              'ngram_range': [(1, 2)]}
-    deft_cl.cv(train, labels, params, n_jobs=n_jobs, cv=5)
-    cv = deft_cl.grid_search.cv_results_
+    model_path = os.path.join(models_path, agg_name)
+    os.makedirs(model_path, exist_ok=True)
+    if search == 'halving':
+        result = halving_search(train, labels, pos_labels, param_grid,
+                                n_jobs=n_jobs, cv=5,
+                                trials_path=os.path.join(
+                                    model_path, f'{agg_name}_trials.jsonl'))
+        deft_cl.train(train, labels, **result['best_params'])
+        scores = result['cv_results']
+    else:
+        deft_cl.cv(train, labels, param_grid, n_jobs=n_jobs, cv=5)
+        cv = deft_cl.grid_search.cv_results_
+        best = deft_cl.grid_search.best_index_
+        scores = {metric: {'mean': cv[f'mean_test_{key}'][best],
+                           'std': cv[f'std_test_{key}'][best]}
+                  for metric, key in (('f1', 'f1'), ('precision', 'pr'),
+                                      ('recall', 'rc'))}
 
     preds = cross_val_predict(deft_cl.estimator, train, labels, n_jobs=n_jobs,
                               cv=5)
     conf_matrix = confusion_matrix(labels, preds)
     cv_results = {'labels': sorted(set(labels)),
-                  'conf_matrix': conf_matrix.tolist(),
-                  'f1': {'mean': cv['mean_test_f1'][0],
-                         'std': cv['std_test_f1'][0]},
-                  'precision': {'mean': cv['mean_test_pr'][0],
-                                'std': cv['std_test_pr'][0]},
-                  'recall': {'mean': cv['mean_test_rc'][0],
-                             'std': cv['std_test_rc'][0]}}
+                  'conf_matrix': conf_matrix.tolist()}
+    cv_results.update(scores)
 
     logit = deft_cl.estimator.named_steps['logit']
     coef = logit.coef_
     classes = logit.classes_
 
     # calculate feature importance
-    feature_names = deft_cl.estimator.named_steps['tfidf'].get_feature_names()
-    important_terms = {}
-    # when there are greater than 2 classes, the logistic regression model
-    # will have a row of coefficients for each class. when there are only
-    # two classes, there is only one row of coefficients
-    if len(classes) > 2:
-        for index, label in enumerate(classes):
-            fi = pd.DataFrame({'name': feature_names,
-                               'importance': coef[index, :]})
-            fi.sort_values('importance', ascending=False, inplace=True)
-            top = fi.head(20)
-            bottom = fi.tail(20)
-            important_terms[label] = {'top':
-                                      list(zip(top['name'],
-                                               top['importance'])),
-                                      'bottom':
-                                      list(zip(bottom['name'],
-                                               bottom['importance']))}
-    else:
-        # in case of binary labels, the coefficients correspond to the labels
-        # in LogisticRegression.classes_[1]
-        fi = pd.DataFrame({'name': feature_names,
-                           'importance': coef})
-        fi.sort_values('importance', ascending=False, inplace=True)
-        top = fi.head(20)
-        bottom = fi.tail(20)
-        important_terms[classes[1]] = list(zip(top['name'],
-                                               top['importance']))
-        important_terms[classes[0]] = list(zip(bottom['name'],
-                                               bottom['importance']))
-
-    unlabeled = []
-    recognizers = [DeftRecognizer(shortform, grounding_map)
-                   for shortform, grounding_Map in grounding_dict.items()]
-    for text in texts:
-        for rec in recognizers:
-            if rec.recognize(text):
-                break
-        else:
-            unlabeled.append(text)
-
-    preds = deft_cl.estimator.predict(texts)
-    preds = dict(Counter(preds))
+    vocabulary = deft_cl.estimator.named_steps['tfidf'].vocabulary_
+    feature_names = feature_names_from_vocabulary(vocabulary)
+    terms = important_terms(coef, classes, feature_names, k=20)
+
+    stmt_counts = Counter(str(ref) for ref in ref_dict.values())
+    proba = deft_cl.estimator.predict_proba(texts)
+    predictions = {'classes': deft_cl.estimator.classes_, 'proba': proba,
+                   'num_stmts': [stmt_counts[str(ref)] for ref in refs],
+                   'matched': [_unique_match(deft_cb.recognizers, text)
+                               for text in texts]}
+    preds = dict(Counter(deft_cl.estimator.classes_[proba.argmax(axis=1)]))
     data = {'stats': stats,
             'cv_results': cv_results,
             'preds_on_unlabeled': preds,
-            'important_terms': important_terms}
+            'important_terms': terms,
+            'additional': additional_report}
+    _save_model(deft_cl, data, predictions, grounding_dict, names, agg_name,
+                data_path)
+    _save_training_options(agg_name, options, data_path)
+    return deft_cl
+
+
+def _training_options_path(agg_name, data_path):
+    return os.path.join(data_path, 'models', agg_name,
+                        f'{agg_name}_training.json')
+
+
+def _save_training_options(agg_name, options, data_path):
+    with open(_training_options_path(agg_name, data_path), 'w') as f:
+        json.dump(options, f)
+
+
+def load_training_options(agg_name, data_path=DATA_PATH):
+    """Keyword arguments of train a model was last trained with
+
+    Returns an empty dict for models trained before options were saved.
+    """
     try:
-        os.mkdir(os.path.join(models_path, agg_name))
-    except FileExistsError:
-        pass
-    deft_cl.dump_model(os.path.join(models_path, agg_name,
-                                    f'{agg_name}_model.gz'))
-    with open(os.path.join(models_path, agg_name,
+        with open(_training_options_path(agg_name, data_path), 'r') as f:
+            options = json.load(f)
+    except FileNotFoundError:
+        return {}
+    # JSON has no tuples
+    if options.get('additional') is not None:
+        options['additional'] = [tuple(source)
+                                 for source in options['additional']]
+    if options.get('param_grid') is not None and \
+            'ngram_range' in options['param_grid']:
+        options['param_grid']['ngram_range'] = \
+            [tuple(ngram_range)
+             for ngram_range in options['param_grid']['ngram_range']]
+    return options
+
+
+def _unique_match(recognizers, text):
+    """Grounding matched by a text's defining patterns if there is one"""
+    groundings = set()
+    for recognizer in recognizers:
+        groundings.update(recognizer.recognize(text))
+    return groundings.pop() if len(groundings) == 1 else None
+
+
+def _write_lines(items, f):
+    for item in items:
+        f.write(json.dumps(item) + '\n')
+
+
+def _read_lines(f):
+    f.seek(0)
+    for line in f:
+        yield json.loads(line)
+
+
+def _train_streaming(shortforms, agg_name, grounding_dict, names, pos_labels,
+                     additional, data_path, param_grid, dedup,
+                     max_per_source, n_jobs, chunk_size, epochs, n_features):
+    """Train a model out of core, as train does with streaming=True
+
+    Texts are read from the text store once, while computing statistics,
+    and spooled to a temporary file of JSON lines in the model directory.
+    The labeled corpus built from them and the additional texts are spooled
+    to a ShuffledSpool, which each pass of training reads in a random
+    order.
+    """
+    if any(len(values) > 1 for values in param_grid.values()):
+        raise ValueError('streaming training takes a single value for each'
+                         ' parameter')
+    params = {key: values[0] for key, values in param_grid.items()}
+    canonical = {}
+    if dedup is not None:
+        canonical = load_dedup(agg_name, dedup, data_path)
+        if canonical is None:
+            raise ValueError(f'No duplicates of the current texts of'
+                             f' {agg_name} have been found with threshold'
+                             f' {dedup}. Run adeft_app.scripts.dedup first.')
+    _, ref_dict = apply_dedup({}, load_text_map(agg_name, data_path),
+                              canonical)
+    model_path = os.path.join(data_path, 'models', agg_name)
+    os.makedirs(model_path, exist_ok=True)
+
+    refs = set()
+    with tempfile.TemporaryFile('w+', dir=model_path) as text_file:
+        def spool_texts():
+            for ref, text in iter_corpus(agg_name, data_path):
+                if ref in canonical or text is None:
+                    continue
+                refs.add(ref)
+                _write_lines([[ref, text]], text_file)
+                yield ref, text
+
+        stats = adeft_stats(grounding_dict, names, spool_texts(), ref_dict)
+        additional_corpus, additional_report = \
+            gather_additional(additional, data_path, refs | set(canonical),
+                              max_per_source=max_per_source)
+        for grounding, name, _ in additional:
+            names[grounding] = name
+        pos_labels = sorted(set(pos_labels) |
+                            {grounding for grounding, _, _ in additional})
+        # the labeled corpus and additional texts are mixed so that
+        # training does not end on a run of additional texts
+        deft_cb = DeftCorpusBuilder(grounding_dict)
+        with ShuffledSpool(len(refs) + len(additional_corpus), chunk_size,
+                           directory=model_path) as corpus_spool:
+            for chunk in chunked(_read_lines(text_file), chunk_size):
+                corpus_spool.write(deft_cb.build_from_texts(
+                    [text for _, text in chunk]))
+            corpus_spool.write(additional_corpus)
+            del additional_corpus
+            estimator, cv_results = \
+                train_streaming(corpus_spool.chunks, pos_labels,
+                                ngram_range=params.get('ngram_range',
+                                                       (1, 2)),
+                                C=params.get('C', 100.0),
+                                n_features=n_features, epochs=epochs,
+                                n_jobs=n_jobs)
+        stmt_counts = Counter(str(ref) for ref in ref_dict.values())
+        proba = []
+        predictions = {'classes': estimator.classes_, 'num_stmts': [],
+                       'matched': []}
+        for chunk in chunked(_read_lines(text_file), chunk_size):
+            chunk_refs, texts = zip(*chunk)
+            proba.append(estimator.predict_proba(texts).astype(np.float32))
+            predictions['num_stmts'].extend(stmt_counts[ref]
+                                            for ref in chunk_refs)
+            predictions['matched'].extend(
+                _unique_match(deft_cb.recognizers, text) for text in texts)
+        predictions['proba'] = np.concatenate(proba)
+        preds = Counter(estimator.classes_[
+            predictions['proba'].argmax(axis=1)])
+
+    deft_cl = DeftClassifier(shortforms, pos_labels)
+    deft_cl.estimator = estimator
+    logit = estimator.named_steps['logit']
+    feature_names = feature_names_from_vocabulary(
+        estimator.named_steps['tfidf'].vocabulary_, logit.coef_.shape[1])
+    data = {'stats': stats,
+            'cv_results': cv_results,
+            'preds_on_unlabeled': {str(label): count
+                                   for label, count in preds.items()},
+            'important_terms': important_terms(logit.coef_, logit.classes_,
+                                               feature_names, k=20),
+            'additional': additional_report}
+    _save_model(deft_cl, data, predictions, grounding_dict, names, agg_name,
+                data_path)
+    return deft_cl
+
+
+def _save_model(model, data, predictions, grounding_dict, names, agg_name,
+                data_path):
+    """Write a trained model with its grounding dict, names, stats and
+    cached predictions (see adeft_app.predictions)
+
+    Models with hashed features can only be stored as compact artifacts,
+    and an adeft artifact left by an earlier model is removed. Other models
+    are written as adeft artifacts, and a compact artifact written from an
+    earlier model is rewritten with the options it was written with.
+    """
+    model_path = os.path.join(data_path, 'models', agg_name)
+    gz_path = os.path.join(model_path, f'{agg_name}{GZ_SUFFIX}')
+    compact_path = os.path.join(model_path, f'{agg_name}{COMPACT_SUFFIX}')
+    if isinstance(model.estimator.named_steps['tfidf'],
+                  HashingTfidfVectorizer):
+        dump_model(model, compact_path)
+        if os.path.exists(gz_path):
+            os.remove(gz_path)
+    else:
+        model.dump_model(gz_path)
+        if os.path.exists(compact_path):
+            dump_model(model, compact_path)
+    with open(os.path.join(model_path,
                            f'{agg_name}_grounding_dict.json'), 'w') as f:
         json.dump(grounding_dict, f)
-    with open(os.path.join(models_path, agg_name,
+    with open(os.path.join(model_path,
                            f'{agg_name}_names.json'), 'w') as f:
         json.dump(names, f)
-    with open(os.path.join(models_path, agg_name,
+    with open(os.path.join(model_path,
                            f'{agg_name}_stats.json'), 'w') as f:
         json.dump(data, f)
-    return deft_cl
+    save_predictions(predictions_path(data_path, agg_name), **predictions)
+    write_summary(data_path, agg_name, model=model)
+
 
+def adeft_stats(grounding_dict, names_dict, text_dict, ref_dict,
+                canonical=None):
+    """Output adeft pattern matching stats as dict that can jsonified
 
-def adeft_stats(grounding_dict, names_dict, text_dict, ref_dict):
-    """Output adeft pattern matching stats as dict that can jsonified"""
+    If canonical, a map from duplicate text refs to canonical text refs, is
+    given, duplicate texts are dropped and their statements are counted for
+    the canonical texts. text_dict may also be an iterable of (text ref,
+    text) pairs, which is read once. Counts are accumulated text by text,
+    so memory does not grow with the number of texts.
+    """
+    if isinstance(text_dict, dict):
+        text_dict = text_dict.items()
+    if canonical is not None:
+        text_dict = ((ref, text) for ref, text in text_dict
+                     if ref not in canonical)
+        _, ref_dict = apply_dedup({}, ref_dict, canonical)
     # need to run each recognizer on every text
     recognizers = [DeftRecognizer(shortform, grounding_map)
                    for shortform, grounding_map in grounding_dict.items()]
 
     # given dict mapping stmt ids to text_ref ids, get dict mapping
     # text_ref ids to counts of stmts from those texts
-    stmt_counts = defaultdict(int)
-    for stmt, ref in ref_dict.items():
-        stmt_counts[ref] += 1
-    stmt_counts = dict(stmt_counts)
+    stmt_counts = Counter(int(ref) for ref in ref_dict.values())
 
     # get all groundings from grounding_dict
     groundings = {value for grounding_map in grounding_dict.values()
                   for value in grounding_map.values()}
-    # get stats in pandas dataframe. columns for groundings. 1 if
-    # text has this grounding, 0 if it doesn't. Also stmt count for
-    # each text_ref
-    # start with row template as dict. build up row by row
-    row_template = {grounding: 0
-                    for grounding in groundings}
-    row_template['text_ref'] = None
-    row_template['num_stmts'] = 0
-    df = []
-    for ref, text in text_dict.items():
-        row = row_template.copy()
-        row['text_ref'] = ref
-        row['num_stmts'] = stmt_counts[int(ref)]
+    total = {'stmts': 0, 'texts': 0}
+    match_pattern = {'stmts': 0, 'texts': 0}
+    # texts matching exactly one grounding, or none, are counted for it
+    unique = {grounding: {'stmts': 0, 'texts': 0}
+              for grounding in groundings}
+    for ref, text in text_dict:
+        num_stmts = stmt_counts[int(ref)]
+        matched = set()
         for recognizer in recognizers:
-            ground = recognizer.recognize(text)
-            for g in ground:
-                row[g] = 1
-        df.append(row)
-    df = pd.DataFrame(df)
-
-    # rearrange columns so text_ref is first and num_stmts is
-    # last
-    cols = df.columns.tolist()
-    ref_col = cols.index('text_ref')
-    cols = [cols[ref_col]] + cols[0:ref_col] + cols[ref_col+1:]
-    nstmts_col = cols.index('num_stmts')
-    cols = (cols[0:nstmts_col] + cols[nstmts_col+1:] +
-            [cols[nstmts_col]])
-    df = df[cols]
+            matched.update(recognizer.recognize(text))
+        total['stmts'] += num_stmts
+        total['texts'] += 1
+        if matched:
+            match_pattern['stmts'] += num_stmts
+            match_pattern['texts'] += 1
+        if len(matched) == 1:
+            counts = unique[matched.pop()]
+            counts['stmts'] += num_stmts
+            counts['texts'] += 1
 
     output = {}
     # get shortforms for json
     output['shortforms'] = list(grounding_dict.keys())
-
-    # get total number of statements and total texts
-    nstmts = df.num_stmts.sum()
-    ntexts = len(df)
-    output['total'] = {'stmts': int(nstmts), 'texts': int(ntexts)}
-
-    # get number of texts and matching defining pattern for
-    # one of the shortforms and number of corresponding statements
-    ground_cols = df.drop(['text_ref', 'num_stmts'], axis=1)
-    matched = ground_cols.any(axis=1)
-
-    output['match_pattern'] = {'stmts': int(df[matched].num_stmts.sum()),
-                               'texts': int(matched.sum())}
-    output['groundings'] = {}
-    unique = df[~(ground_cols.sum(axis=1) > 1)]
-    for column in unique.columns:
-        if column in ['text_ref', 'num_stmts']:
-            continue
-        ntexts = unique[column].sum()
-        nstmts = unique[unique[column] == 1]['num_stmts'].sum()
-        output['groundings'][column] = {'stmts': int(nstmts),
-                                        'texts': int(ntexts)}
+    output['total'] = total
+    output['match_pattern'] = match_pattern
+    output['groundings'] = unique
     return output
@@ -7,10 +7,16 @@ import tempfile
 from adeft.download import get_s3_models
 
 from adeft_app.locations import DATA_PATH, S3_BUCKET
+from adeft_app.artifacts import GZ_SUFFIX, model_paths
 from adeft_app.filenames import escape_filename
 
 
-def model_to_s3(model_name):
+def model_to_s3(model_name, compact=False):
+    """Upload a model to S3, as a compact artifact if compact is True
+
+    Models trained out of core only have a compact artifact, which is
+    uploaded whether or not compact is True.
+    """
     model_name = escape_filename(model_name)
     local_models_path = os.path.join(DATA_PATH, 'models', model_name)
     with open(os.path.join(local_models_path,
@@ -26,8 +32,13 @@ def model_to_s3(model_name):
             json.dump(s3_models, f)
         client.upload_file(temp.name, S3_BUCKET, 's3_models.json')
 
-    file_names = [f'{model_name}_{end}' for end in
-                  ('model.gz', 'grounding_dict.json', 'names.json')]
+    # the compact artifact comes first if there is one
+    paths = model_paths(os.path.join(DATA_PATH, 'models'), model_name)
+    if not compact:
+        paths = [path for path in paths if path.endswith(GZ_SUFFIX)] or paths
+    file_names = [os.path.basename(paths[0])]
+    file_names.extend(f'{model_name}_{end}' for end in
+                      ('grounding_dict.json', 'names.json'))
 
     for file_name in file_names:
         client.upload_file(os.path.join(local_models_path,
@@ -38,6 +49,9 @@ def model_to_s3(model_name):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Upload model to S3')
     parser.add_argument('model_name')
+    parser.add_argument('--compact', action='store_true',
+                        help='Upload the compact model artifact instead of'
+                        ' the adeft artifact')
     args = parser.parse_args()
     model_name = args.model_name
-    model_to_s3(model_name)
+    model_to_s3(model_name, compact=args.compact)
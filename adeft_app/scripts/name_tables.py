@@ -0,0 +1,125 @@
+"""Write name tables for the local name index from INDRA's resource files
+
+Writes {NAMESPACE}_names.tsv to data/names for HGNC, FamPlex, GO, ChEBI and
+MeSH, with the preferred name of each identifier first followed by its
+synonyms. The approved names of HGNC genes and the names of FamPlex entries
+with spaces in place of underscores are marked preferred as well. See
+adeft_app.names for how the tables are used.
+
+Example
+-------
+python -m adeft_app.scripts.name_tables HGNC FPLX
+"""
+import os
+import csv
+import logging
+import argparse
+
+from adeft_app.locations import DATA_PATH
+from adeft_app.names import names_path
+
+
+logger = logging.getLogger(__file__)
+
+
+def hgnc_names():
+    """Symbol, name, aliases and previous symbols of approved genes
+
+    The approved name is marked preferred, as longforms are usually names.
+    """
+    from indra.resources import get_resource_path
+
+    with open(get_resource_path('hgnc_entries.tsv'), 'r') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            if row['Status'] != 'Approved':
+                continue
+            identifier = row['HGNC ID'].split(':', 1)[-1]
+            yield identifier, row['Approved symbol']
+            yield identifier, row['Approved name'], 'preferred'
+            for column in ('Alias symbols', 'Previous symbols'):
+                for symbol in row[column].split(','):
+                    if symbol.strip():
+                        yield identifier, symbol.strip()
+
+
+def famplex_names():
+    """FamPlex identifiers, which are their names, also with spaces"""
+    from indra.resources import get_resource_path
+
+    with open(get_resource_path(os.path.join('famplex', 'entities.csv')),
+              'r') as f:
+        for line in f:
+            identifier = line.strip()
+            if identifier:
+                yield identifier, identifier
+                if '_' in identifier:
+                    yield identifier, identifier.replace('_', ' '), \
+                        'preferred'
+
+
+def _obo_names(prefix):
+    from indra.databases.obo_client import OboClient
+
+    for identifier, entry in OboClient(prefix=prefix).entries.items():
+        yield identifier, entry['name']
+        for synonym in entry.get('synonyms', []):
+            yield identifier, synonym
+
+
+def go_names():
+    return _obo_names('go')
+
+
+def chebi_names():
+    return _obo_names('chebi')
+
+
+def mesh_names():
+    """MeSH descriptor names and entry terms"""
+    from indra.resources import get_resource_path
+
+    with open(get_resource_path('mesh_id_label_mappings.tsv'), 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            yield fields[0], fields[1]
+            if len(fields) > 2:
+                for synonym in fields[2].split('|'):
+                    if synonym:
+                        yield fields[0], synonym
+
+
+SOURCES = {'HGNC': hgnc_names, 'FPLX': famplex_names, 'GO': go_names,
+           'CHEBI': chebi_names, 'MESH': mesh_names}
+
+
+def write_table(namespace, rows, data_path=DATA_PATH):
+    """Write a name table, dropping repeated names for an identifier
+
+    rows are (identifier, name) pairs, or (identifier, name, 'preferred')
+    for names marked preferred.
+    """
+    path = names_path(data_path)
+    os.makedirs(path, exist_ok=True)
+    seen = set()
+    temp_path = os.path.join(path, f'{namespace}_names.tsv.tmp')
+    with open(temp_path, 'w') as f:
+        for identifier, name, *marks in rows:
+            name = ' '.join(name.split())
+            if not name or (identifier, name) in seen:
+                continue
+            seen.add((identifier, name))
+            f.write('\t'.join([identifier, name, *marks]) + '\n')
+    os.replace(temp_path, os.path.join(path, f'{namespace}_names.tsv'))
+    logger.info('Wrote %d names for %s', len(seen), namespace)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write name tables for the'
+                                     ' local name index')
+    parser.add_argument('namespaces', nargs='*', default=sorted(SOURCES),
+                        choices=sorted(SOURCES))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    for namespace in args.namespaces:
+        write_table(namespace, SOURCES[namespace]())
@@ -0,0 +1,249 @@
+"""Fill the TRIPS grounding cache for mined longforms ahead of time
+
+Run after adeft_mine.py. Grounds every longform scoring above a cutoff for
+the given shortforms with TRIPS, making calls concurrently subject to a rate
+limit, and stores the results in the same cache used by the grounding app.
+Opening one of these shortforms in the app with the same or a higher cutoff
+then makes no calls to TRIPS.
+
+Progress is checkpointed per shortform, so an interrupted run can simply be
+restarted. Longforms already in the cache are skipped without calling TRIPS.
+
+Example
+-------
+python -m adeft_app.scripts.pre_ground --all --cutoff 1.0 --workers 8
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from adeft_app.locations import DATA_PATH
+from adeft_app.trips import trips_ground, in_cache
+from adeft_app.filenames import escape_filename, unescape_filename
+
+
+logger = logging.getLogger(__file__)
+
+
+class RateLimiter(object):
+    """Thread safe limit on the rate at which calls can be made
+
+    Parameters
+    ----------
+    rate : float
+        Maximum number of calls per second. If None or not positive, calls
+        are not limited.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0/rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until another call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def load_longforms(shortform, cutoff, data_path=DATA_PATH):
+    """Load mined longforms scoring above cutoff, as the grounding app does
+    """
+    cased_shortform = escape_filename(shortform)
+    with open(os.path.join(data_path, 'longforms',
+                           f'{cased_shortform}_longforms.json'), 'r') as f:
+        scored_longforms = json.load(f)
+    return [longform for longform, score in scored_longforms
+            if score > cutoff]
+
+
+def all_shortforms(data_path=DATA_PATH):
+    """Get every shortform that has mined longforms"""
+    suffix = '_longforms.json'
+    return sorted(unescape_filename(filename[:-len(suffix)])
+                  for filename in os.listdir(os.path.join(data_path,
+                                                          'longforms'))
+                  if filename.endswith(suffix))
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except EnvironmentError:
+        return {}
+
+
+def _save_checkpoint(checkpoint, path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+
+def pre_ground(shortforms, cutoff=1.0, n_workers=8, rate=5.0,
+               checkpoint_path=None, data_path=DATA_PATH,
+               report_interval=10.0, checkpoint_interval=10.0):
+    """Ground longforms for many shortforms with TRIPS, filling the cache
+
+    Parameters
+    ----------
+    shortforms : list of str
+        Shortforms whose mined longforms should be grounded
+
+    cutoff : Optional[float]
+        Only longforms with score greater than cutoff are grounded.
+        Default: 1.0
+
+    n_workers : Optional[int]
+        Number of concurrent calls to TRIPS. Default: 8
+
+    rate : Optional[float]
+        Maximum number of calls to TRIPS per second across all workers.
+        Default: 5.0
+
+    checkpoint_path : Optional[str]
+        JSON file recording which shortforms have been completed. Completed
+        shortforms are skipped if they were grounded with the same or a
+        lower cutoff. Default: pre_ground_checkpoint.json in the
+        cached_results directory
+
+    data_path : Optional[str]
+        Data directory containing mined longforms. Default: DATA_PATH
+
+    report_interval : Optional[float]
+        Seconds between progress reports. Default: 10.0
+
+    checkpoint_interval : Optional[float]
+        Shortforms are recorded in the checkpoint as they are completed,
+        at most this many seconds apart, and when the run stops.
+        Default: 10.0
+
+    Returns
+    -------
+    report : dict
+        Counts of longforms that were already cached, newly grounded and
+        that failed, along with the shortforms that were completed
+    """
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(data_path, 'cached_results',
+                                       'pre_ground_checkpoint.json')
+    checkpoint = _load_checkpoint(checkpoint_path)
+    # remaining maps shortforms to longforms that have not yet been grounded
+    remaining = {}
+    for shortform in shortforms:
+        done_cutoff = checkpoint.get(shortform)
+        if done_cutoff is not None and done_cutoff <= cutoff:
+            continue
+        remaining[shortform] = set(load_longforms(shortform, cutoff,
+                                                  data_path))
+    report = {'cached': 0, 'grounded': 0, 'failed': 0, 'completed': []}
+    # the same longform is often mined for several shortforms
+    pending = set()
+    for longforms in remaining.values():
+        pending.update(longforms)
+    to_ground = []
+    for longform in sorted(pending):
+        if in_cache(longform):
+            report['cached'] += 1
+        else:
+            to_ground.append(longform)
+    logger.info('%d shortforms to pre-ground. %d longforms, %d already'
+                ' cached.', len(remaining), len(pending), report['cached'])
+    # outstanding maps shortforms to longforms still being grounded, and a
+    # shortform is completed once none are left and none have failed
+    outstanding = {}
+    by_longform = {}
+    uncached = set(to_ground)
+    for shortform, longforms in remaining.items():
+        outstanding[shortform] = longforms & uncached
+        for longform in outstanding[shortform]:
+            by_longform.setdefault(longform, []).append(shortform)
+    failed_shortforms = set()
+    last_save = time.monotonic()
+
+    def complete(shortform):
+        nonlocal last_save
+        checkpoint[shortform] = cutoff
+        report['completed'].append(shortform)
+        now = time.monotonic()
+        if now - last_save >= checkpoint_interval:
+            _save_checkpoint(checkpoint, checkpoint_path)
+            last_save = now
+
+    for shortform, longforms in outstanding.items():
+        if not longforms:
+            complete(shortform)
+
+    limiter = RateLimiter(rate)
+
+    def ground(longform):
+        limiter.wait()
+        trips_ground(longform, cached=True)
+
+    start = last_report = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(ground, longform): longform
+                       for longform in to_ground}
+            for future in as_completed(futures):
+                longform = futures[future]
+                try:
+                    future.result()
+                    report['grounded'] += 1
+                except Exception as err:
+                    logger.warning('Failed to ground %s: %s', longform, err)
+                    report['failed'] += 1
+                    failed_shortforms.update(by_longform[longform])
+                for shortform in by_longform[longform]:
+                    outstanding[shortform].discard(longform)
+                    if not outstanding[shortform] and \
+                            shortform not in failed_shortforms:
+                        complete(shortform)
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    done = report['grounded'] + report['failed']
+                    speed = done / (now - start)
+                    logger.info('%d/%d done, %d failed, %.1f per second,'
+                                ' about %.0f s remaining', done,
+                                len(to_ground), report['failed'], speed,
+                                (len(to_ground) - done) / speed)
+                    last_report = now
+    finally:
+        _save_checkpoint(checkpoint, checkpoint_path)
+    logger.info('Finished. %d grounded, %d already cached, %d failed.'
+                ' %d/%d shortforms completed.', report['grounded'],
+                report['cached'], report['failed'], len(report['completed']),
+                len(remaining))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-ground mined longforms'
+                                     ' with TRIPS to fill the grounding'
+                                     ' cache')
+    parser.add_argument('shortforms', nargs='*')
+    parser.add_argument('--all', action='store_true',
+                        help='Pre-ground every shortform with mined'
+                        ' longforms')
+    parser.add_argument('--cutoff', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help='Maximum calls to TRIPS per second')
+    parser.add_argument('--checkpoint', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    shortforms = all_shortforms() if args.all else args.shortforms
+    report = pre_ground(shortforms, cutoff=args.cutoff,
+                        n_workers=args.workers, rate=args.rate,
+                        checkpoint_path=args.checkpoint)
+    if report['failed']:
+        raise SystemExit(1)
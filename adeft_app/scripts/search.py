@@ -0,0 +1,300 @@
+"""Hyperparameter search for adeft models by successive halving
+
+Candidates are every combination of values for C, max_features and
+ngram_range. All candidates are crossvalidated on a small random sample of
+the training texts and the best 1/eta of them are kept for the next round,
+which uses eta times as many texts. The last round uses all of the texts, so
+the scores of the best candidate are comparable to those from a full grid
+search.
+
+Vectorizing the texts is the slowest part of fitting a model and only
+depends on the tokenizer settings. In each fold, texts are tokenized once
+for each ngram_range and the counts are reused for every max_features and C
+with that ngram_range. Folds and ngram ranges are spread across a pool of
+worker processes.
+
+Results for every candidate in every round are appended to a JSON lines
+file if one is given. Trials already in the file are not run again, so an
+interrupted search can be restarted. Trials are keyed on a hash of the
+training texts, their labels, the positive labels, the number of folds and
+the random seed, so a search on relabeled texts runs every trial again.
+"""
+import json
+import math
+import time
+import hashlib
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.metrics import f1_score, precision_score, recall_score
+
+
+logger = logging.getLogger(__file__)
+
+# set in each worker process by _init_worker
+_texts = None
+_labels = None
+_pos_labels = None
+_classes = None
+
+
+def _init_worker(texts, labels, pos_labels):
+    global _texts, _labels, _pos_labels, _classes
+    _texts = np.array(texts, dtype=object)
+    _labels = np.array(labels, dtype=object)
+    _pos_labels = pos_labels
+    _classes = sorted(set(labels))
+
+
+def scores(y_true, y_pred, pos_labels, classes):
+    """f1, precision and recall computed as in DeftClassifier.cv
+
+    As there, scores are averaged over pos_labels if there are more than
+    two classes and are those of the first positive label otherwise. This
+    is decided from the classes of all of the training texts, so folds
+    missing a class are scored the same way as the others.
+    """
+    if len(classes) > 2:
+        kwargs = {'labels': list(pos_labels), 'average': 'weighted'}
+    else:
+        kwargs = {'labels': list(classes), 'pos_label': pos_labels[0],
+                  'average': 'binary'}
+    kwargs['zero_division'] = 0
+    return {'f1': f1_score(y_true, y_pred, **kwargs),
+            'precision': precision_score(y_true, y_pred, **kwargs),
+            'recall': recall_score(y_true, y_pred, **kwargs)}
+
+
+def _limit_features(counts, max_features):
+    """Columns of the max_features most frequent terms, in column order"""
+    if max_features is None or max_features >= counts.shape[1]:
+        return np.arange(counts.shape[1])
+    frequencies = np.asarray(counts.sum(axis=0)).ravel()
+    return np.sort(np.argsort(-frequencies, kind='stable')[:max_features])
+
+
+def _evaluate_group(train_index, test_index, ngram_range, settings):
+    """Score candidates sharing an ngram_range on one fold
+
+    Parameters
+    ----------
+    train_index, test_index : numpy.ndarray
+        Indices of the training and test texts for the fold
+
+    ngram_range : tuple of int
+        Tokenizer setting shared by the candidates
+
+    settings : list of tuple
+        (max_features, list of C) for each group of candidates
+
+    Returns
+    -------
+    results : list of tuple
+        (max_features, C, scores) for each candidate
+    """
+    vectorizer = CountVectorizer(ngram_range=tuple(ngram_range),
+                                 stop_words='english')
+    train_counts = vectorizer.fit_transform(_texts[train_index])
+    test_counts = vectorizer.transform(_texts[test_index])
+    y_train, y_test = _labels[train_index], _labels[test_index]
+    results = []
+    for max_features, C_values in settings:
+        columns = _limit_features(train_counts, max_features)
+        tfidf = TfidfTransformer()
+        X_train = tfidf.fit_transform(train_counts[:, columns])
+        X_test = tfidf.transform(test_counts[:, columns])
+        for C in C_values:
+            logit = LogisticRegression(C=C, solver='saga', penalty='l1')
+            logit.fit(X_train, y_train)
+            results.append((max_features, C,
+                            scores(y_test, logit.predict(X_test),
+                                   _pos_labels, _classes)))
+    return results
+
+
+def _candidates(param_grid):
+    keys = ['C', 'max_features', 'ngram_range']
+    values = [param_grid.get(key, [default]) for key, default
+              in zip(keys, [100.0, 10000, (1, 2)])]
+    return [{'C': float(C), 'max_features': max_features,
+             'ngram_range': list(ngram_range)}
+            for C, max_features, ngram_range in itertools.product(*values)]
+
+
+def _data_hash(texts, labels, pos_labels, cv, random_state):
+    """Hash of what the scores of a trial depend on besides parameters"""
+    digest = hashlib.sha1(json.dumps([sorted(pos_labels), cv,
+                                      random_state]).encode('utf-8'))
+    for text, label in zip(texts, labels):
+        digest.update(json.dumps([text, label]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _trial_key(data_hash, n_samples, params):
+    return data_hash, n_samples, json.dumps(params, sort_keys=True)
+
+
+def _load_trials(trials_path):
+    trials = {}
+    if trials_path is None:
+        return trials
+    try:
+        with open(trials_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    trial = json.loads(line)
+                    trials[_trial_key(trial.get('data_hash'),
+                                      trial['n_samples'],
+                                      trial['params'])] = trial
+    except FileNotFoundError:
+        pass
+    return trials
+
+
+def _run_round(index, cv, random_state, candidates, pool):
+    """Crossvalidate candidates on the texts at the given indices"""
+    folds = StratifiedKFold(n_splits=cv, shuffle=True,
+                            random_state=random_state)
+    by_ngram = {}
+    for params in candidates:
+        ngram_range = tuple(params['ngram_range'])
+        by_ngram.setdefault(ngram_range, {}).setdefault(
+            params['max_features'], []).append(params['C'])
+    tasks = [(index[train], index[test], ngram_range, list(settings.items()))
+             for train, test in folds.split(index, _labels[index])
+             for ngram_range, settings in by_ngram.items()]
+    if pool is None:
+        outputs = [_evaluate_group(*task) for task in tasks]
+    else:
+        outputs = pool.map(_evaluate_group, *zip(*tasks))
+    fold_scores = {}
+    for (_, _, ngram_range, _), output in zip(tasks, outputs):
+        for max_features, C, scores in output:
+            fold_scores.setdefault((C, max_features, ngram_range),
+                                   []).append(scores)
+    return fold_scores
+
+
+def halving_search(texts, labels, pos_labels, param_grid, n_jobs=1, cv=5,
+                   eta=3, min_samples=None, trials_path=None,
+                   random_state=0):
+    """Search for the best model parameters by successive halving
+
+    Parameters
+    ----------
+    texts : list of str
+        Training texts
+
+    labels : list of str
+        Labels of the training texts
+
+    pos_labels : list of str
+        Labels scored, as in DeftClassifier
+
+    param_grid : dict
+        Lists of values to try for any of C, max_features and ngram_range
+
+    n_jobs : Optional[int]
+        Number of worker processes. Default: 1
+
+    cv : Optional[int]
+        Number of crossvalidation folds. Default: 5
+
+    eta : Optional[int]
+        Only the best 1/eta of the candidates are kept after each round,
+        which uses eta times as many texts as the last. Default: 3
+
+    min_samples : Optional[int]
+        Smallest number of texts to use in a round. Default: 10 times the
+        number of folds times the number of labels
+
+    trials_path : Optional[str]
+        JSON lines file to which the result of each trial is appended
+
+    random_state : Optional[int]
+        Seed for sampling texts and splitting folds. Default: 0
+
+    Returns
+    -------
+    result : dict
+        best_params holds the best parameters in the form accepted by
+        DeftClassifier.train and cv_results their crossvalidated scores on
+        all texts. trials holds the results of every trial.
+    """
+    candidates = _candidates(param_grid)
+    n_texts = len(texts)
+    if min_samples is None:
+        min_samples = 10*cv*len(set(labels))
+    n_rounds = math.ceil(math.log(len(candidates), eta)) \
+        if len(candidates) > 1 else 0
+    # nested random samples, so survivors are evaluated on supersets of
+    # the texts they were selected on
+    order = np.random.RandomState(random_state).permutation(n_texts)
+    done = _load_trials(trials_path)
+    data_hash = _data_hash(texts, labels, pos_labels, cv, random_state)
+    trials = []
+    _init_worker(texts, labels, pos_labels)
+    pool = None
+    if n_jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=n_jobs,
+                                   initializer=_init_worker,
+                                   initargs=(texts, labels, pos_labels))
+    try:
+        for round_number in range(n_rounds + 1):
+            n_samples = n_texts if round_number == n_rounds else \
+                min(n_texts, max(min_samples,
+                                 int(n_texts*eta**(round_number -
+                                                   n_rounds))))
+            logger.info('Round %d: %d candidates on %d texts', round_number,
+                        len(candidates), n_samples)
+            results = {}
+            to_run = []
+            for params in candidates:
+                trial = done.get(_trial_key(data_hash, n_samples, params))
+                if trial is None:
+                    to_run.append(params)
+                else:
+                    results[_trial_key(data_hash, n_samples, params)] = trial
+            start = time.time()
+            fold_scores = {}
+            if to_run:
+                fold_scores = _run_round(order[:n_samples], cv,
+                                         random_state, to_run, pool)
+            for params in to_run:
+                scores = fold_scores[(params['C'], params['max_features'],
+                                      tuple(params['ngram_range']))]
+                trial = {'round': round_number, 'n_samples': n_samples,
+                         'params': params, 'folds': cv,
+                         'data_hash': data_hash,
+                         'seconds': time.time() - start}
+                for metric in ('f1', 'precision', 'recall'):
+                    values = [fold[metric] for fold in scores]
+                    trial[metric] = {'mean': float(np.mean(values)),
+                                     'std': float(np.std(values))}
+                results[_trial_key(data_hash, n_samples, params)] = trial
+                if trials_path is not None:
+                    with open(trials_path, 'a') as f:
+                        f.write(json.dumps(trial) + '\n')
+            ranked = sorted(candidates, key=lambda params: -results[
+                _trial_key(data_hash, n_samples, params)]['f1']['mean'])
+            trials.extend(results[_trial_key(data_hash, n_samples, params)]
+                          for params in ranked)
+            if round_number < n_rounds:
+                candidates = ranked[:math.ceil(len(ranked)/eta)]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    best = results[_trial_key(data_hash, n_samples, ranked[0])]
+    logger.info('Best f1 score of %s found for parameter values:\n%s',
+                best['f1']['mean'], best['params'])
+    best_params = dict(best['params'])
+    best_params['ngram_range'] = tuple(best_params['ngram_range'])
+    return {'best_params': best_params,
+            'cv_results': {metric: best[metric]
+                           for metric in ('f1', 'precision', 'recall')},
+            'trials': trials}
@@ -0,0 +1,239 @@
+"""Train adeft models on corpora too large to hold in memory
+
+The corpus is read in chunks from a function that starts a new pass over it
+each time it is called. Texts are vectorized with hashed TF-IDF features
+(see adeft_app.hashing), so no vocabulary has to be built first, and a
+logistic regression model is fit by stochastic gradient descent with
+partial_fit, one chunk at a time.
+
+The passes over the corpus are:
+
+1. Count document frequencies and labels.
+2. For each epoch, fit one model per crossvalidation fold on the texts
+   outside the fold, and a final model on every text. Texts are assigned to
+   folds by a hash of their contents, so the folds are the same in every
+   pass.
+3. Score each fold model on the texts in its fold.
+4. Find the terms of the columns with the largest and smallest
+   coefficients in the final model, so important terms can be shown.
+
+Only the model coefficients, document frequencies and the labels and
+predictions of each text are kept in memory.
+
+Stochastic gradient descent follows the labels it has seen last, so a
+corpus read in an order correlated with its labels, such as texts followed
+by additional texts, gives a model that predicts the last labels. Corpora
+are spooled with ShuffledSpool, which spreads the texts over temporary
+files at random and reads the files in a new random order on each pass.
+"""
+import json
+import zlib
+import logging
+import tempfile
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.metrics import confusion_matrix
+from sklearn.linear_model import SGDClassifier
+
+from adeft_app.features import top_bottom_indices
+from adeft_app.hashing import HashingTfidfVectorizer
+from adeft_app.scripts.search import scores
+
+
+logger = logging.getLogger(__file__)
+
+MAX_SPOOL_FILES = 256
+
+
+def chunked(iterable, chunk_size):
+    """Generate lists of up to chunk_size consecutive items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ShuffledSpool(object):
+    """Temporary files of JSON rows read back in a random order
+
+    Each row written goes to a file chosen at random. chunks reads the files
+    in a new random order each time it is called, one file per chunk, so
+    rows written in any order are mixed across chunks.
+
+    Parameters
+    ----------
+    n_rows : int
+        Roughly the number of rows that will be written
+
+    chunk_size : int
+        Rows are spread over enough files for each to hold about this many,
+        but no more than MAX_SPOOL_FILES
+
+    directory : Optional[str]
+        Directory for the temporary files. Default: the system default
+
+    random_state : Optional[int]
+        Seed for choosing files and their order. Default: 0
+    """
+    def __init__(self, n_rows, chunk_size, directory=None, random_state=0):
+        n_files = min(MAX_SPOOL_FILES, max(1, -(-n_rows // chunk_size)))
+        self._rng = np.random.RandomState(random_state)
+        self._files = [tempfile.TemporaryFile('w+', dir=directory)
+                       for _ in range(n_files)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def write(self, rows):
+        """Write a list of rows, each to a file chosen at random"""
+        for row, index in zip(rows, self._rng.randint(len(self._files),
+                                                      size=len(rows))):
+            self._files[index].write(json.dumps(row) + '\n')
+
+    def chunks(self):
+        """Generate the rows of each file as a list, in a random order of
+        files"""
+        for index in self._rng.permutation(len(self._files)):
+            f = self._files[index]
+            f.seek(0)
+            chunk = [json.loads(line) for line in f]
+            if chunk:
+                yield chunk
+
+
+def _folds(texts, cv):
+    return np.array([zlib.crc32(text.encode('utf-8')) % cv
+                     for text in texts])
+
+
+def train_streaming(chunks, pos_labels, ngram_range=(1, 2), C=100.0,
+                    n_features=2**18, epochs=5, cv=5, n_terms=200,
+                    n_jobs=1, random_state=0):
+    """Fit and crossvalidate a model on a corpus streamed in chunks
+
+    Parameters
+    ----------
+    chunks : function
+        Called without arguments, returns an iterator over lists of
+        (text, label) pairs covering the whole corpus. It is called once
+        for each pass. The order of the pairs should not depend on their
+        labels, as with ShuffledSpool.chunks.
+
+    pos_labels : list of str
+        Labels scored, as in DeftClassifier
+
+    ngram_range : Optional[tuple of int]
+        Range of ngram lengths of features. Default: (1, 2)
+
+    C : Optional[float]
+        Inverse of the L1 regularization strength, as for
+        LogisticRegression. Default: 100.0
+
+    n_features : Optional[int]
+        Number of columns features are hashed to. Default: 2**18
+
+    epochs : Optional[int]
+        Number of passes made to fit the models. Default: 5
+
+    cv : Optional[int]
+        Number of crossvalidation folds. Default: 5
+
+    n_terms : Optional[int]
+        Number of columns at each end of the coefficients of each class for
+        which terms are found. Default: 200
+
+    n_jobs : Optional[int]
+        Number of jobs used by SGDClassifier for multiclass models.
+        Default: 1
+
+    random_state : Optional[int]
+        Seed for shuffling chunks and for SGDClassifier. Default: 0
+
+    Returns
+    -------
+    estimator : sklearn.pipeline.Pipeline
+        HashingTfidfVectorizer and SGDClassifier steps named tfidf and
+        logit, as in DeftClassifier
+
+    cv_results : dict
+        Labels, confusion matrix and mean and standard deviation of the f1,
+        precision and recall of the fold models, in the form stored in
+        model stats
+    """
+    tfidf = HashingTfidfVectorizer(ngram_range=tuple(ngram_range),
+                                   n_features=n_features)
+    classes = set()
+    n_samples = 0
+    for chunk in chunks():
+        texts, labels = zip(*chunk)
+        tfidf.partial_fit(texts)
+        classes.update(labels)
+        n_samples += len(chunk)
+    if len(classes) < 2:
+        raise ValueError('training texts must have at least two labels')
+    classes = np.array(sorted(classes))
+    logger.info('Training on %d texts with %d labels', n_samples,
+                len(classes))
+    # alpha is scaled by the number of samples to match the penalty of a
+    # LogisticRegression with the same C
+    models = [SGDClassifier(loss='log_loss', penalty='l1',
+                            alpha=1/(C*n_samples), n_jobs=n_jobs,
+                            random_state=random_state)
+              for _ in range(cv + 1)]
+    final = models[cv]
+    rng = np.random.RandomState(random_state)
+    for epoch in range(epochs):
+        for chunk in chunks():
+            order = rng.permutation(len(chunk))
+            texts = [chunk[index][0] for index in order]
+            labels = np.array([chunk[index][1] for index in order])
+            X = tfidf.transform(texts)
+            folds = _folds(texts, cv)
+            for fold, model in enumerate(models[:cv]):
+                train = folds != fold
+                if train.any():
+                    model.partial_fit(X[train], labels[train],
+                                      classes=classes)
+            final.partial_fit(X, labels, classes=classes)
+        logger.info('Epoch %d of %d finished', epoch + 1, epochs)
+
+    y_true = [[] for _ in range(cv)]
+    y_pred = [[] for _ in range(cv)]
+    for chunk in chunks():
+        texts, labels = zip(*chunk)
+        labels = np.array(labels)
+        X = tfidf.transform(texts)
+        folds = _folds(texts, cv)
+        for fold, model in enumerate(models[:cv]):
+            test = folds == fold
+            if test.any() and hasattr(model, 'coef_'):
+                y_true[fold].extend(labels[test])
+                y_pred[fold].extend(model.predict(X[test]))
+    fold_scores = [scores(true, pred, pos_labels, classes)
+                   for true, pred in zip(y_true, y_pred) if true]
+    all_true = [label for labels in y_true for label in labels]
+    all_pred = [label for labels in y_pred for label in labels]
+    cv_results = {'labels': classes.tolist(),
+                  'conf_matrix': confusion_matrix(all_true, all_pred,
+                                                  labels=classes).tolist()}
+    for metric in ('f1', 'precision', 'recall'):
+        values = [fold[metric] for fold in fold_scores]
+        cv_results[metric] = {'mean': float(np.mean(values)),
+                              'std': float(np.std(values))}
+
+    top, bottom = top_bottom_indices(final.coef_, n_terms)
+    tfidf.name_features((text for chunk in chunks() for text, _ in chunk),
+                        np.union1d(top.ravel(), bottom.ravel()))
+    return Pipeline([('tfidf', tfidf), ('logit', final)]), cv_results
@@ -0,0 +1,480 @@
+"""A single store for the text content of every text ref
+
+Texts used to be fetched and saved separately for each combination of
+shortforms in data/texts/<name>/<name>_texts.json, so texts mentioning
+several shortforms were fetched and stored many times. Now the content of
+each text ref is fetched once and kept in data/text_store, and the text
+store for a combination of shortforms, <name>_corpus.json, lists the text
+refs it uses and the shortforms paragraphs are extracted for.
+
+The store is content addressed. Contents are compressed with zlib and
+appended to segment files, and identical contents are stored once, however
+many text refs have them. index.jsonl maps each text ref to the SHA-256 of
+its content and the segment, offset and length of the compressed content.
+statements.jsonl records the text ref found for every statement fetched,
+so statements are never looked up twice.
+
+Extracting the paragraphs that mention a corpus's shortforms is slow, so
+extracted texts are cached in the same segments. extracts.jsonl maps the
+SHA-256 of a content and a set of shortforms to the SHA-256 and location
+of the extracted text. Texts are extracted when they are stored if the
+shortforms are known, and otherwise the first time a corpus is read.
+
+The JSON lines files are only appended to, and writers hold a lock on the
+store, so an interrupted write loses at most the entry being written.
+Each store instance reads only the entries added since it last read them.
+
+Text stores written before this, with a <name>_texts.json file, are still
+read.
+"""
+import os
+import json
+import zlib
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+
+from adeft_app.locations import DATA_PATH
+
+
+logger = logging.getLogger(__file__)
+
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_object(path, chunk_size=1 << 20):
+    """Generate the (key, value) pairs of a JSON object in a file
+
+    The file is read in chunks so that the whole object is never in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            return not eof
+
+        def skip_whitespace():
+            nonlocal position
+            while True:
+                while position < len(buffer) and \
+                        buffer[position] in _WHITESPACE:
+                    position += 1
+                if position < len(buffer) or not fill():
+                    return
+
+        def expect(chars):
+            nonlocal position
+            skip_whitespace()
+            if position >= len(buffer) or buffer[position] not in chars:
+                raise ValueError(f'{path} is not a JSON object: expected'
+                                 f' one of {chars!r} at character'
+                                 f' {position}')
+            position += 1
+            return buffer[position - 1]
+
+        def decode():
+            nonlocal position
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not fill():
+                        raise
+                    continue
+                # a number could continue into the next chunk
+                if end == len(buffer) and not eof and fill():
+                    continue
+                position = end
+                return value
+
+        expect('{')
+        skip_whitespace()
+        if position < len(buffer) and buffer[position] == '}':
+            return
+        while True:
+            key = decode()
+            expect(':')
+            value = decode()
+            yield key, value
+            if expect(',}') == '}':
+                return
+
+
+def _read_jsonl_from(path, position):
+    """Complete entries of a JSON lines file from a byte position
+
+    Returns
+    -------
+    entries : list
+        Entries from position up to the end of the file, ignoring a partial
+        last line
+
+    position : int
+        Position after the last complete line
+    """
+    entries = []
+    try:
+        with open(path, 'rb') as f:
+            f.seek(position)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                entries.append(json.loads(line))
+                position += len(line)
+    except FileNotFoundError:
+        pass
+    return entries, position
+
+
+def _shortforms_key(shortforms):
+    return '\n'.join(sorted(shortforms))
+
+
+def _iter_jsonl(path):
+    """Generate entries of a JSON lines file, ignoring a partial last line
+    """
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    return
+                yield json.loads(line)
+    except FileNotFoundError:
+        return
+
+
+class TextStore(object):
+    """Compressed, append only store of text content keyed by text ref
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store. Created if it does not exist.
+
+    segment_size : Optional[int]
+        Size in bytes after which a new segment file is started.
+        Default: 1 GiB
+    """
+    def __init__(self, path, segment_size=1 << 30):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'index.jsonl')
+        self._extracts_path = os.path.join(path, 'extracts.jsonl')
+        self._statements_path = os.path.join(path, 'statements.jsonl')
+        # text ref -> SHA-256 of content
+        self._refs = {}
+        # SHA-256 -> (segment, offset, length)
+        self._blobs = {}
+        # (SHA-256 of content, shortforms key) -> SHA-256 of extracted text
+        self._extracts = {}
+        # bytes of index.jsonl and extracts.jsonl read so far
+        self._index_position = 0
+        self._extracts_position = 0
+        self._segment = 0
+        self._files = {}
+        self._refresh()
+        self._statements = None
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, ref):
+        return str(ref) in self._refs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'segment_{segment:05d}.z')
+
+    def _refresh(self):
+        """Read index entries added since they were last read"""
+        entries, self._index_position = \
+            _read_jsonl_from(self._index_path, self._index_position)
+        for ref, sha, segment, offset, length in entries:
+            self._refs[ref] = sha
+            self._blobs[sha] = (segment, offset, length)
+            self._segment = max(self._segment, segment)
+        entries, self._extracts_position = \
+            _read_jsonl_from(self._extracts_path, self._extracts_position)
+        for sha, key, extract_sha, segment, offset, length in entries:
+            self._extracts[(sha, key)] = extract_sha
+            self._blobs[extract_sha] = (segment, offset, length)
+            self._segment = max(self._segment, segment)
+
+    def _read_blob(self, sha):
+        segment, offset, length = self._blobs[sha]
+        f = self._files.get(segment)
+        if f is None:
+            f = self._files[segment] = open(self._segment_path(segment),
+                                            'rb')
+        f.seek(offset)
+        return zlib.decompress(f.read(length)).decode('utf-8')
+
+    def get(self, ref):
+        """Content of a text ref, or None if it is not stored"""
+        sha = self._refs.get(str(ref))
+        if sha is None:
+            return None
+        return self._read_blob(sha)
+
+    def extracted(self, ref, shortforms):
+        """Cached text extracted from a text ref's content for shortforms
+
+        None if the text has not been extracted for these shortforms.
+        """
+        sha = self._refs.get(str(ref))
+        extract_sha = self._extracts.get((sha, _shortforms_key(shortforms)))
+        if extract_sha is None:
+            return None
+        return self._read_blob(extract_sha)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _appending(self):
+        """Lock the store and yield a function storing content
+
+        The function takes the SHA-256 of encoded content and the content,
+        appends the content to the current segment unless it is already
+        stored, and returns whether it was added.
+        """
+        with self._lock():
+            # pick up entries written by other processes
+            self._refresh()
+            data = open(self._segment_path(self._segment), 'ab')
+
+            def store(sha, encoded):
+                nonlocal data
+                if sha in self._blobs:
+                    return False
+                if data.tell() >= self.segment_size:
+                    data.close()
+                    self._segment += 1
+                    data = open(self._segment_path(self._segment), 'ab')
+                compressed = zlib.compress(encoded)
+                offset = data.tell()
+                data.write(compressed)
+                data.flush()
+                self._blobs[sha] = (self._segment, offset, len(compressed))
+                return True
+
+            try:
+                yield store
+            finally:
+                data.close()
+        # segments written to may be open for reading at an old size
+        self.close()
+
+    def put_many(self, contents, shortforms=None):
+        """Store the contents of text refs
+
+        Parameters
+        ----------
+        contents : dict
+            Maps text refs to their contents. Empty contents are skipped.
+
+        shortforms : Optional[list of str]
+            If given, the paragraphs of each new content mentioning these
+            shortforms are extracted and cached. Default: None
+
+        Returns
+        -------
+        added : int
+            Number of contents not already in the store
+        """
+        added = 0
+        # contents of text refs that were added or changed
+        new = {}
+        with self._appending() as store, \
+                open(self._index_path, 'ab') as index:
+            for ref, content in contents.items():
+                ref = str(ref)
+                if not content:
+                    continue
+                encoded = content.encode('utf-8')
+                sha = hashlib.sha256(encoded).hexdigest()
+                if self._refs.get(ref) == sha:
+                    continue
+                added += store(sha, encoded)
+                self._refs[ref] = sha
+                new[ref] = content
+                index.write((json.dumps([ref, sha, *self._blobs[sha]]) +
+                             '\n').encode('utf-8'))
+            self._index_position = index.tell()
+        if shortforms is not None:
+            from indra.literature.adeft_tools import universal_extract_text
+
+            self.put_extracted({ref: universal_extract_text(
+                content, contains=shortforms) for ref, content in new.items()},
+                shortforms)
+        return added
+
+    def put_extracted(self, extracts, shortforms):
+        """Cache texts extracted from the contents of text refs
+
+        Parameters
+        ----------
+        extracts : dict
+            Maps text refs in the store to the text extracted from their
+            contents
+
+        shortforms : list of str
+            Shortforms the texts were extracted for
+        """
+        key = _shortforms_key(shortforms)
+        with self._appending() as store, \
+                open(self._extracts_path, 'ab') as f:
+            for ref, text in extracts.items():
+                sha = self._refs.get(str(ref))
+                if sha is None or (sha, key) in self._extracts:
+                    continue
+                encoded = (text or '').encode('utf-8')
+                extract_sha = hashlib.sha256(encoded).hexdigest()
+                store(extract_sha, encoded)
+                self._extracts[(sha, key)] = extract_sha
+                f.write((json.dumps([sha, key, extract_sha,
+                                     *self._blobs[extract_sha]]) +
+                         '\n').encode('utf-8'))
+            self._extracts_position = f.tell()
+
+    @property
+    def statements(self):
+        """Maps every statement id looked up to its text ref or None"""
+        if self._statements is None:
+            self._statements = {stmt: ref for stmt, ref
+                                in _iter_jsonl(self._statements_path)}
+        return self._statements
+
+    def add_statements(self, ref_dict):
+        """Record the text refs of statements
+
+        Parameters
+        ----------
+        ref_dict : dict
+            Maps statement ids to text refs, or to None for statements
+            without text
+        """
+        statements = self.statements
+        with self._lock():
+            with open(self._statements_path, 'a') as f:
+                for stmt, ref in ref_dict.items():
+                    statements[stmt] = ref
+                    f.write(json.dumps([stmt, ref]) + '\n')
+
+
+def store_path(data_path=DATA_PATH):
+    return os.path.join(data_path, 'text_store')
+
+
+def corpus_path(agg_name, data_path=DATA_PATH):
+    return os.path.join(data_path, 'texts', agg_name,
+                        f'{agg_name}_corpus.json')
+
+
+def save_corpus(agg_name, shortforms, text_refs, data_path=DATA_PATH):
+    """Save the text refs for a combination of shortforms
+
+    Parameters
+    ----------
+    agg_name : str
+        Name of the text store, the escaped shortforms joined by :
+
+    shortforms : list of str
+        Paragraphs of full texts are used only if they contain one of these
+
+    text_refs : list
+        Text refs in the store
+    """
+    path = corpus_path(agg_name, data_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'shortforms': sorted(shortforms),
+                   'text_refs': [str(ref) for ref in text_refs]}, f)
+
+
+def iter_corpus(agg_name, data_path=DATA_PATH, batch_size=1000):
+    """Generate the (text ref, text) pairs of a text store
+
+    Reads <agg_name>_corpus.json and the text content store if it exists,
+    and otherwise streams <agg_name>_texts.json. Texts not yet extracted
+    for the corpus's shortforms are extracted and cached in batches of
+    batch_size.
+    """
+    path = corpus_path(agg_name, data_path)
+    if not os.path.exists(path):
+        yield from iter_json_object(os.path.join(data_path, 'texts',
+                                                 agg_name,
+                                                 f'{agg_name}_texts.json'))
+        return
+    from indra.literature.adeft_tools import universal_extract_text
+
+    with open(path, 'r') as f:
+        corpus = json.load(f)
+    shortforms = corpus['shortforms']
+    with TextStore(store_path(data_path)) as store:
+        extracts = {}
+        for ref in corpus['text_refs']:
+            text = store.extracted(ref, shortforms)
+            if text is None:
+                content = store.get(ref)
+                if content is None:
+                    logger.warning('Text ref %s of %s is not in the store',
+                                   ref, agg_name)
+                    continue
+                text = extracts[ref] = \
+                    universal_extract_text(content, contains=shortforms)
+                if len(extracts) >= batch_size:
+                    store.put_extracted(extracts, shortforms)
+                    extracts = {}
+            yield ref, text
+        if extracts:
+            store.put_extracted(extracts, shortforms)
+
+
+def load_corpus(agg_name, data_path=DATA_PATH):
+    """Texts and text map of a text store
+
+    Returns
+    -------
+    text_dict : dict
+        Maps text refs to texts
+
+    ref_dict : dict
+        Maps statement ids to text refs
+    """
+    text_dict = dict(iter_corpus(agg_name, data_path))
+    return text_dict, load_text_map(agg_name, data_path)
+
+
+def load_text_map(agg_name, data_path=DATA_PATH):
+    """Map from statement ids to text refs of a text store"""
+    with open(os.path.join(data_path, 'texts', agg_name,
+                           f'{agg_name}_text_map.json'), 'r') as f:
+        return json.load(f)
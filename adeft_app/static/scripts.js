@@ -1,11 +1,229 @@
+// suggest names from the local name index while one is typed into input,
+// filling in the grounding input when a suggestion is chosen
+function suggestNames(input) {
+    var url = input.getAttribute('data-names-url');
+    var groundingInput = document.getElementById(
+	input.getAttribute('data-grounding-input'));
+    var list = document.createElement('datalist');
+    list.id = input.id + '-suggestions';
+    input.parentNode.appendChild(list);
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+    var suggestions = [];
+    var timer = null;
+    input.addEventListener('input', function () {
+	var chosen = suggestions.filter(function (suggestion) {
+	    return suggestion.name === input.value;
+	});
+	if (chosen.length) {
+	    groundingInput.value = chosen[0].grounding;
+	    return;
+	}
+	clearTimeout(timer);
+	timer = setTimeout(function () {
+	    var query = input.value;
+	    if (!query.trim()) {
+		return;
+	    }
+	    var params = new URLSearchParams({q: query, k: 10});
+	    fetch(url + '?' + params, {credentials: 'same-origin'})
+		.then(function (response) { return response.json(); })
+		.then(function (result) {
+		    // ignore responses to queries that have been typed over
+		    if (input.value !== query) {
+			return;
+		    }
+		    suggestions = result;
+		    list.innerHTML = '';
+		    result.forEach(function (suggestion) {
+			var option = document.createElement('option');
+			option.value = suggestion.name;
+			option.label = suggestion.grounding;
+			list.appendChild(option);
+		    });
+		});
+	}, 100);
+    });
+}
+
 window.onload = function() {
-    groundings = document.getElementsByClassName('click-grounded');
-    for (var i = 0; i < groundings.length; i++) {
-	groundings[i].addEventListener('click', function (event) {
+    var rowsBody = document.getElementById('rows');
+    var labelsBody = document.getElementById('labels');
+    var groundForm = document.getElementById('ground-form');
+    var viewForm = document.getElementById('view-form');
+    document.querySelectorAll('input[data-names-url]').forEach(suggestNames);
+    if (!rowsBody) {
+	return;
+    }
+
+    // clicking a name or grounding copies it into the input boxes
+    rowsBody.addEventListener('click', function (event) {
+	var target = event.target.closest('.click-grounded');
+	if (target) {
 	    document.getElementById('name-box').value =
-		event.target.getAttribute("data-name");
+		target.getAttribute('data-name');
 	    document.getElementById('grounding-box').value =
-		event.target.getAttribute('data-grounding');
+		target.getAttribute('data-grounding');
+	}
+    });
+
+    function postForJson(url, data) {
+	return fetch(url, {method: 'POST', body: data,
+			   credentials: 'same-origin',
+			   headers: {'Accept': 'application/json'}})
+	    .then(function (response) { return response.json(); });
+    }
+
+    function cell(className) {
+	var td = document.createElement('td');
+	if (className) {
+	    td.className = className;
+	}
+	return td;
+    }
+
+    function groundedCell(row, text) {
+	var td = cell('pad');
+	var div = document.createElement('div');
+	div.className = 'click-grounded';
+	div.setAttribute('data-name', row.name);
+	div.setAttribute('data-grounding', row.grounding);
+	div.textContent = text;
+	td.appendChild(div);
+	return td;
+    }
+
+    // must produce the same markup as the rows in input.jinja2
+    function buildRow(row) {
+	var tr = document.createElement('tr');
+	tr.setAttribute('data-index', row.index);
+	var td = cell();
+	var checkbox = document.createElement('input');
+	checkbox.type = 'checkbox';
+	checkbox.name = 'select';
+	checkbox.value = row.index;
+	td.appendChild(checkbox);
+	tr.appendChild(td);
+	td = cell();
+	var div = document.createElement('div');
+	div.textContent = row.longform;
+	td.appendChild(div);
+	tr.appendChild(td);
+	td = cell('score');
+	td.textContent = row.score;
+	tr.appendChild(td);
+	tr.appendChild(groundedCell(row, row.name));
+	tr.appendChild(groundedCell(row, row.grounding));
+	td = cell();
+	var button = document.createElement('input');
+	button.type = 'submit';
+	button.name = 'delete.' + row.index;
+	button.className = 'delete';
+	button.value = 'X';
+	button.setAttribute('formaction',
+			    rowsBody.getAttribute('data-delete-url'));
+	td.appendChild(button);
+	tr.appendChild(td);
+	return tr;
+    }
+
+    function renderLabels(labels, posLabels) {
+	var url = labelsBody.getAttribute('data-pos-label-url');
+	labelsBody.innerHTML = '';
+	labels.forEach(function (label) {
+	    var tr = document.createElement('tr');
+	    var td = cell('pad filled ' + (posLabels.indexOf(label) >= 0 ?
+					   'positive' : 'blank'));
+	    td.textContent = label;
+	    tr.appendChild(td);
+	    td = cell('blank');
+	    var form = document.createElement('form');
+	    form.action = url;
+	    form.method = 'POST';
+	    var button = document.createElement('input');
+	    button.type = 'submit';
+	    button.name = 'pos-label.' + label;
+	    button.value = '+';
+	    form.appendChild(button);
+	    td.appendChild(form);
+	    tr.appendChild(td);
+	    labelsBody.appendChild(tr);
 	});
     }
+
+    // replace only the rows returned by an edit
+    function applyDelta(delta) {
+	delta.rows.forEach(function (row) {
+	    var old = rowsBody.querySelector('tr[data-index="' + row.index +
+					     '"]');
+	    if (old) {
+		rowsBody.replaceChild(buildRow(row), old);
+	    }
+	});
+	renderLabels(delta.labels, delta.pos_labels);
+    }
+
+    groundForm.addEventListener('submit', function (event) {
+	event.preventDefault();
+	var data = new FormData(groundForm);
+	var url = groundForm.action;
+	var submitter = event.submitter;
+	if (submitter && submitter.getAttribute('formaction')) {
+	    url = submitter.getAttribute('formaction');
+	    data.append(submitter.name, submitter.value);
+	}
+	postForJson(url, data).then(applyDelta);
+    });
+
+    labelsBody.addEventListener('submit', function (event) {
+	event.preventDefault();
+	var data = new FormData();
+	var button = event.target.querySelector('input[type=submit]');
+	data.append(button.name, button.value);
+	postForJson(event.target.action, data).then(applyDelta);
+    });
+
+    function loadPage(page) {
+	var params = new URLSearchParams(new FormData(viewForm));
+	params.set('page', page);
+	fetch(viewForm.getAttribute('data-rows-url') + '?' + params,
+	      {credentials: 'same-origin',
+	       headers: {'Accept': 'application/json'}})
+	    .then(function (response) { return response.json(); })
+	    .then(function (result) {
+		var pages = Math.max(Math.ceil(result.total / result.per_page),
+				     1);
+		rowsBody.innerHTML = '';
+		result.rows.forEach(function (row) {
+		    rowsBody.appendChild(buildRow(row));
+		});
+		renderLabels(result.labels, result.pos_labels);
+		document.getElementById('page-info').textContent =
+		    'Page ' + result.page + ' of ' + pages + ' (' +
+		    result.total + ' longforms)';
+		var prev = document.getElementById('prev-page');
+		var next = document.getElementById('next-page');
+		prev.value = result.page - 1;
+		prev.disabled = result.page <= 1;
+		next.value = result.page + 1;
+		next.disabled = result.page >= pages;
+		['page', 'per_page', 'sort', 'order', 'filter']
+		    .forEach(function (key) {
+			var value = key === 'filter' ? result.status :
+			    result[key];
+			groundForm.querySelector('input[name=' + key + ']')
+			    .value = value;
+		    });
+	    });
+    }
+
+    viewForm.addEventListener('submit', function (event) {
+	event.preventDefault();
+	var submitter = event.submitter;
+	var page = 1;
+	if (submitter && submitter.name === 'page') {
+	    page = submitter.value;
+	}
+	loadPage(page);
+    });
 }
@@ -0,0 +1,181 @@
+"""Per-model summaries used to start fixing a model
+
+Starting to fix a model needs the longforms mapped to each grounding, the
+best scoring longform for each grounding across all of the model's
+shortforms, the names and the model's labels and positive labels. Working
+these out means reading the longforms of every shortform and loading the
+model, so they are saved to {name}_summary.json in the model directory when
+a model is trained or fixed.
+
+The summary records the size, modification time and SHA-256 hash of each
+file it was built from. It is used only if every file still has the same
+contents. Files whose size and modification time are unchanged are assumed
+to be unchanged, so usually no file is read beyond the summary itself.
+"""
+import os
+import json
+import hashlib
+from collections import defaultdict
+
+from .artifacts import COMPACT_SUFFIX, model_path, read_header
+from .filenames import escape_filename
+from .instrument import span
+
+
+VERSION = 1
+
+
+def summary_path(data_path, model_name):
+    return os.path.join(data_path, 'models', model_name,
+                        f'{model_name}_summary.json')
+
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _source(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': _file_hash(path)}
+
+
+def _is_current(path, source):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != source['size']:
+        return False
+    if stat.st_mtime_ns == source['mtime_ns']:
+        return True
+    return _file_hash(path) == source['sha256']
+
+
+def _model_labels(path, load_model, model=None):
+    """Labels and positive labels of a model artifact"""
+    if model is None and path.endswith(COMPACT_SUFFIX):
+        header = read_header(path)
+        return header['classes'], header['pos_labels']
+    if model is None:
+        with span('load_model'):
+            model = load_model(path)
+    return (model.estimator.named_steps['logit'].classes_.tolist(),
+            model.pos_labels)
+
+
+def build_summary(data_path, model_name, load_model=None, model=None):
+    """Work out the summary of a model from its files
+
+    Parameters
+    ----------
+    data_path : str
+        Data directory
+
+    model_name : str
+        Escaped name of the model
+
+    load_model : Optional[function]
+        Function loading a DeftClassifier from an artifact. Only used if the
+        model has no compact artifact. Default:
+        adeft_app.artifacts.load_model
+
+    model : Optional[adeft.modeling.classify.DeftClassifier]
+        The model, if it has already been loaded. Default: None
+
+    Returns
+    -------
+    summary : dict
+        longforms lists [grounding, newline separated longforms] for each
+        grounding, top_longforms maps groundings to their highest scoring
+        longform, along with names, labels and pos_labels. sources records
+        the files the summary was built from.
+    """
+    if load_model is None:
+        from .artifacts import load_model
+    models_path = os.path.join(data_path, 'models', model_name)
+    grounding_dict_path = os.path.join(models_path,
+                                       f'{model_name}_grounding_dict.json')
+    names_path = os.path.join(models_path, f'{model_name}_names.json')
+    with open(grounding_dict_path) as f:
+        grounding_dict = json.load(f)
+    with open(names_path) as f:
+        names = json.load(f)
+    sources = [grounding_dict_path, names_path]
+    longforms = defaultdict(list)
+    longform_scores = defaultdict(int)
+    for shortform, grounding_map in grounding_dict.items():
+        cased_shortform = escape_filename(shortform)
+        longforms_path = os.path.join(data_path, 'longforms',
+                                      f'{cased_shortform}_longforms.json')
+        with span('read_longforms'):
+            with open(longforms_path, 'r') as f:
+                lf_scores = json.load(f)
+        sources.append(longforms_path)
+        for lf, score in lf_scores:
+            longform_scores[lf] += score
+        for longform, grounding in grounding_map.items():
+            if grounding != 'ungrounded':
+                longforms[grounding].append(longform)
+    top_longforms = {grounding: max(longform_list,
+                                    key=lambda x: longform_scores[x])
+                     for grounding, longform_list in longforms.items()}
+    longforms = [[grounding, '\n'.join(longform)] for grounding, longform
+                 in longforms.items()]
+
+    artifact_path = model_path(os.path.join(data_path, 'models'), model_name)
+    labels, pos_labels = _model_labels(artifact_path, load_model, model)
+    sources.append(artifact_path)
+    labels = [label for label in labels if label != 'ungrounded']
+    return {'version': VERSION,
+            'sources': {os.path.relpath(path, data_path): _source(path)
+                        for path in sources},
+            'longforms': longforms,
+            'top_longforms': top_longforms,
+            'names': names,
+            'labels': labels,
+            'pos_labels': pos_labels}
+
+
+def write_summary(data_path, model_name, load_model=None, model=None):
+    """Build and save the summary of a model"""
+    summary = build_summary(data_path, model_name, load_model, model)
+    path = summary_path(data_path, model_name)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(summary, f)
+    os.replace(temp_path, path)
+    return summary
+
+
+def load_summary(data_path, model_name):
+    """Load the saved summary of a model if it is up to date, else None"""
+    try:
+        with open(summary_path(data_path, model_name)) as f:
+            summary = json.load(f)
+    except FileNotFoundError:
+        return None
+    if summary.get('version') != VERSION:
+        return None
+    # a compact artifact written since the summary is preferred to the one
+    # the summary was built from
+    preferred = os.path.relpath(model_path(os.path.join(data_path, 'models'),
+                                           model_name), data_path)
+    if preferred not in summary['sources']:
+        return None
+    for path, source in summary['sources'].items():
+        if not _is_current(os.path.join(data_path, path), source):
+            return None
+    return summary
+
+
+def get_summary(data_path, model_name, load_model=None):
+    """Load the summary of a model, rebuilding it if it is out of date"""
+    summary = load_summary(data_path, model_name)
+    if summary is None:
+        summary = write_summary(data_path, model_name, load_model)
+    return summary
@@ -1,10 +1,28 @@
 import os
-from joblib import Memory
+import shutil
 
-from indra.sources import trips
+from .locations import TRIPS_CACHE_PATH
 
-trips_cache = os.path.join('.cache')
-memory = Memory(trips_cache, verbose=0)
+# indra and joblib are imported on first use since importing them is slow
+
+trips_cache = TRIPS_CACHE_PATH
+# results were cached here, relative to the working directory, before
+legacy_trips_cache = '.cache'
+_trips_ground_cached = None
+
+
+class _LazyTrips(object):
+    """Stands in for indra.sources.trips, importing it on first use
+
+    joblib keys cached results on the source of _trips_ground, so its body
+    must not change or every cached grounding would be dropped.
+    """
+    def __getattr__(self, name):
+        from indra.sources import trips as trips_module
+        return getattr(trips_module, name)
+
+
+trips = _LazyTrips()
 
 
 def _trips_ground(agent_text):
@@ -72,7 +90,64 @@ def _trips_ground(agent_text):
     return name, grounding
 
 
-_trips_ground_cached = memory.cache(_trips_ground)
+def _move_legacy_cache(func_id):
+    """Move results of a function cached at legacy_trips_cache into
+    trips_cache
+
+    Results already in trips_cache are kept.
+    """
+    legacy_path = os.path.join(legacy_trips_cache, 'joblib', func_id)
+    if not os.path.isdir(legacy_path):
+        return
+    path = os.path.join(trips_cache, 'joblib', func_id)
+    for root, _, files in os.walk(legacy_path):
+        target = os.path.join(path, os.path.relpath(root, legacy_path))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            # the legacy func_code.py matches the current source of the
+            # function, so results cached under either are kept
+            if name == 'func_code.py' or \
+                    not os.path.exists(os.path.join(target, name)):
+                os.replace(os.path.join(root, name),
+                           os.path.join(target, name))
+    shutil.rmtree(legacy_path)
+
+
+def _get_trips_ground_cached():
+    """Return _trips_ground memoized to file, creating it on first use"""
+    global _trips_ground_cached
+    if _trips_ground_cached is None:
+        from joblib import Memory
+        memory = Memory(trips_cache, verbose=0)
+        _trips_ground_cached = memory.cache(_trips_ground)
+        _move_legacy_cache(_trips_ground_cached.func_id)
+    return _trips_ground_cached
+
+
+def in_cache(agent_text):
+    """Check whether a trips grounding for agent_text has been cached
+
+    Parameters
+    ----------
+    agent_text : str
+        An agent text
+
+    Returns
+    -------
+    bool
+        True if trips_ground(agent_text, cached=True) would not need to
+        make a call to TRIPS
+    """
+    return _get_trips_ground_cached().check_call_in_cache(agent_text)
+
+
+def preload():
+    """Import INDRA's TRIPS client and set up the grounding cache
+
+    Otherwise this happens on the first call to trips_ground.
+    """
+    from indra.sources import trips  # noqa: F401
+    _get_trips_ground_cached()
 
 
 def trips_ground(agent_text, cached=False):
@@ -102,7 +177,7 @@ def trips_ground(agent_text, cached=False):
         Indra agent's db_refs
     """
     if cached:
-        output = _trips_ground_cached(agent_text)
+        output = _get_trips_ground_cached()(agent_text)
     else:
         output = _trips_ground(agent_text)
     return output
@@ -0,0 +1,222 @@
+"""Latency and memory benchmarks for the grounding and fix web paths
+
+The app is built with create_app using a temporary DATA directory filled
+with synthetic longforms, groundings and models. TRIPS and model loading are
+replaced with cheap stand-ins so that only the work done inside the request
+handlers is measured. Results are written as JSON so that runs can be
+compared against each other to catch regressions.
+
+Example
+-------
+python -m benchmarks.bench_app --sizes 10 1000 50000 --output bench_app.json
+"""
+import os
+import gzip
+import json
+import time
+import platform
+import argparse
+import tempfile
+import warnings
+import statistics
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+
+from adeft_app import create_app, fix, ground
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 50000]
+GROUND_SHORTFORM = 'BENCH'
+TRIPS_SHORTFORM = 'TRIPSBENCH'
+FIX_SHORTFORM = 'FIXBENCH'
+
+
+def _stub_trips_ground(agent_text, cached=False):
+    """Deterministic stand-in for trips_ground that makes no remote calls"""
+    bucket = sum(map(ord, agent_text)) % 7
+    if bucket == 0:
+        return None, None
+    return f'Name{bucket}', f'HGNC:{bucket}'
+
+
+class _StubModel(object):
+    """Minimal stand-in for a DeftClassifier as used by the fix blueprint"""
+    def __init__(self, shortforms, pos_labels, classes):
+        self.shortforms = shortforms
+        self.pos_labels = pos_labels
+        logit = SimpleNamespace(classes_=np.array(classes, dtype='<U32'),
+                                coef_=np.zeros((len(classes), 1)))
+        self.estimator = SimpleNamespace(named_steps={'logit': logit},
+                                         classes_=logit.classes_)
+
+    def dump_model(self, filepath):
+        model_info = {'shortforms': self.shortforms,
+                      'pos_labels': self.pos_labels,
+                      'classes': self.estimator.classes_.tolist()}
+        with gzip.GzipFile(filepath, 'w') as fout:
+            fout.write(json.dumps(model_info).encode('utf-8'))
+
+
+def _load_stub_model(filepath):
+    with gzip.GzipFile(filepath, 'r') as fin:
+        model_info = json.loads(fin.read().decode('utf-8'))
+    return _StubModel(model_info['shortforms'], model_info['pos_labels'],
+                      model_info['classes'])
+
+
+def _dump(obj, *path):
+    os.makedirs(os.path.dirname(os.path.join(*path)), exist_ok=True)
+    with open(os.path.join(*path), 'w') as f:
+        json.dump(obj, f)
+
+
+def make_data(data_path, n_longforms):
+    """Fill data_path with synthetic longforms, groundings and a model
+
+    Parameters
+    ----------
+    data_path : str
+        Directory to use as the app's DATA
+
+    n_longforms : int
+        Number of longforms mined for each synthetic shortform
+    """
+    n_groundings = max(2, n_longforms // 20)
+    longforms = [f'synthetic longform number {i}' for i in range(n_longforms)]
+    scores = [float(n_longforms - i) for i in range(n_longforms)]
+    scored_longforms = [[lf, score] for lf, score in zip(longforms, scores)]
+    groundings = [f'HGNC:{i % n_groundings}' if i % 3 else 'ungrounded'
+                  for i in range(n_longforms)]
+    grounding_map = dict(zip(longforms, groundings))
+    names = {grounding: f'Name {grounding}' for grounding in groundings
+             if grounding != 'ungrounded'}
+    pos_labels = sorted(names)[:max(1, len(names) // 2)]
+    for shortform in (GROUND_SHORTFORM, TRIPS_SHORTFORM, FIX_SHORTFORM):
+        _dump(scored_longforms, data_path, 'longforms',
+              f'{shortform}_longforms.json')
+    for shortform in (GROUND_SHORTFORM, FIX_SHORTFORM):
+        groundings_path = os.path.join(data_path, 'groundings', shortform)
+        _dump(grounding_map, groundings_path,
+              f'{shortform}_grounding_map.json')
+        _dump(names, groundings_path, f'{shortform}_names.json')
+        _dump(pos_labels, groundings_path, f'{shortform}_pos_labels.json')
+    models_path = os.path.join(data_path, 'models', FIX_SHORTFORM)
+    _dump({FIX_SHORTFORM: grounding_map}, models_path,
+          f'{FIX_SHORTFORM}_grounding_dict.json')
+    _dump(names, models_path, f'{FIX_SHORTFORM}_names.json')
+    classes = sorted(set(groundings))
+    _StubModel([FIX_SHORTFORM], pos_labels,
+               classes).dump_model(os.path.join(models_path,
+                                                f'{FIX_SHORTFORM}_model.gz'))
+
+
+def _post(client, url, data):
+    start = time.perf_counter()
+    response = client.post(url, data=data)
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} returned status {response.status_code}')
+    return elapsed, response
+
+
+def _bench_endpoint(client, url, data, setup=None, repeats=5):
+    """Time repeated posts to url and measure peak memory of one more"""
+    latencies = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        elapsed, response = _post(client, url, data)
+        latencies.append(elapsed)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    _, response = _post(client, url, data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'latency_s': {'min': min(latencies),
+                          'median': statistics.median(latencies),
+                          'mean': statistics.mean(latencies),
+                          'max': max(latencies)},
+            'peak_memory_bytes': peak,
+            'response_bytes': len(response.data),
+            'set_cookie_bytes': len(response.headers.get('Set-Cookie', ''))}
+
+
+def bench_size(n_longforms, repeats=5):
+    """Run all endpoint benchmarks for one synthetic longform count"""
+    with tempfile.TemporaryDirectory() as data_path:
+        make_data(data_path, n_longforms)
+        app = create_app({'TESTING': True, 'DATA': data_path})
+        client = app.test_client()
+        ground_form = {'shortform': GROUND_SHORTFORM, 'cutoff': '0'}
+        trips_form = {'shortform': TRIPS_SHORTFORM, 'cutoff': '0'}
+        fix_form = {'modelname': FIX_SHORTFORM}
+        selected = [str(i) for i in range(1, min(n_longforms, 100) + 1)]
+        add_form = {'name': 'Bench name', 'grounding': 'HGNC:bench',
+                    'select': selected}
+
+        def init_ground():
+            _post(client, '/ground_init', ground_form)
+
+        def init_fix():
+            _post(client, '/fix_init', fix_form)
+
+        results = {}
+        results['ground_init'] = _bench_endpoint(client, '/ground_init',
+                                                 ground_form, repeats=repeats)
+        results['ground_init_trips'] = _bench_endpoint(client,
+                                                       '/ground_init',
+                                                       trips_form,
+                                                       repeats=repeats)
+        results['ground_add'] = _bench_endpoint(client, '/ground_add',
+                                                add_form, setup=init_ground,
+                                                repeats=repeats)
+        results['ground_generate'] = _bench_endpoint(client,
+                                                     '/ground_generate', {},
+                                                     setup=init_ground,
+                                                     repeats=repeats)
+        results['fix_init'] = _bench_endpoint(client, '/fix_init', fix_form,
+                                              repeats=repeats)
+        results['fix_submit'] = _bench_endpoint(client, '/fix_submit',
+                                                {'submit': 'submit'},
+                                                setup=init_fix,
+                                                repeats=repeats)
+    return {'n_longforms': n_longforms, 'endpoints': results}
+
+
+def run(sizes, repeats=5):
+    """Benchmark every size with TRIPS and model loading stubbed out"""
+    ground.trips_ground = _stub_trips_ground
+    fix.load_model = _load_stub_model
+    results = []
+    with warnings.catch_warnings():
+        # large sessions exceed the browser cookie size limit
+        warnings.simplefilter('ignore')
+        for n_longforms in sizes:
+            results.append(bench_size(n_longforms, repeats=repeats))
+    return {'meta': {'benchmark': 'app',
+                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'repeats': repeats},
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the grounding'
+                                     ' and fix request paths')
+    parser.add_argument('--sizes', nargs='*', type=int, default=DEFAULT_SIZES,
+                        help='Numbers of longforms to benchmark with')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default='bench_app.json')
+    args = parser.parse_args()
+    output = run(args.sizes, repeats=args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    for result in output['results']:
+        for endpoint, stats in result['endpoints'].items():
+            print(f"{result['n_longforms']:>7} {endpoint:<18}"
+                  f" median {stats['latency_s']['median'] * 1000:9.2f} ms"
+                  f" peak {stats['peak_memory_bytes'] / 2**20:8.2f} MiB")
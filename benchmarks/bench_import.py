@@ -0,0 +1,83 @@
+"""Import time budget check for app startup
+
+Measures in a fresh interpreter how long it takes to import adeft_app and
+build the app with create_app, and which heavy dependencies were imported
+along the way. Exits with a non-zero status if startup exceeds the budget
+or if any heavy dependency was imported, so it can be run in CI. Results
+are written as JSON.
+
+Example
+-------
+python -m benchmarks.bench_import --budget 1.0
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+
+HEAVY_MODULES = ['indra', 'adeft', 'sklearn', 'joblib', 'pandas', 'numpy']
+DEFAULT_BUDGET = 1.0
+
+_PROBE = '''
+import sys
+import json
+import time
+start = time.perf_counter()
+from adeft_app import create_app
+app = create_app({'TESTING': True})
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed,
+                  'heavy_modules': [name for name in %r
+                                    if name in sys.modules]}))
+'''
+
+
+def measure():
+    """Time importing adeft_app and calling create_app in a new process"""
+    output = subprocess.run([sys.executable, '-c',
+                             _PROBE % (HEAVY_MODULES,)],
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run(repeats=5, budget=DEFAULT_BUDGET):
+    """Measure startup repeatedly and compare the median with the budget"""
+    probes = [measure() for _ in range(repeats)]
+    seconds = [probe['seconds'] for probe in probes]
+    heavy_modules = sorted({name for probe in probes
+                            for name in probe['heavy_modules']})
+    median = statistics.median(seconds)
+    return {'meta': {'benchmark': 'import',
+                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'repeats': repeats},
+            'results': {'create_app_seconds': {'min': min(seconds),
+                                               'median': median,
+                                               'max': max(seconds)},
+                        'heavy_modules': heavy_modules,
+                        'budget_seconds': budget,
+                        'passed': median <= budget and not heavy_modules}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that app startup'
+                                     ' stays within an import time budget')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help='Maximum median startup time in seconds')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default='bench_import.json')
+    args = parser.parse_args()
+    output = run(repeats=args.repeats, budget=args.budget)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    results = output['results']
+    print(f"create_app median {results['create_app_seconds']['median']:.3f} s"
+          f" (budget {args.budget:.3f} s)")
+    if results['heavy_modules']:
+        print(f"heavy modules imported: {', '.join(results['heavy_modules'])}")
+    sys.exit(0 if results['passed'] else 1)
@@ -0,0 +1,239 @@
+"""Benchmarks for the offline pipeline stages
+
+Generates a reproducible synthetic corpus with defining patterns for a
+configurable number of shortforms and times longform mining, adeft_stats,
+corpus building and model training on it. Each configuration runs in a
+fresh process so that the reported peak RSS is not polluted by earlier
+runs. Results are written as JSON.
+
+Example
+-------
+python -m benchmarks.bench_pipeline --texts 10000 100000 --shortforms 1 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import string
+import platform
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_TEXTS = [10000, 100000, 1000000]
+DEFAULT_SHORTFORMS = [1, 5, 20]
+STAGES = ['mining', 'stats', 'corpus', 'train']
+
+
+def _peak_rss():
+    """Peak resident set size of the current process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _random_word(rng):
+    return ''.join(rng.choice(string.ascii_lowercase)
+                   for _ in range(rng.randint(3, 9)))
+
+
+def make_corpus(n_texts, n_shortforms, n_groundings=4, seed=0):
+    """Generate a synthetic corpus with defining patterns
+
+    Parameters
+    ----------
+    n_texts : int
+        Number of texts to generate
+
+    n_shortforms : int
+        Number of shortforms. At most 26 are supported.
+
+    n_groundings : Optional[int]
+        Number of distinct longforms (and groundings) for each shortform.
+        Default: 4
+
+    seed : Optional[int]
+        Seed for the random number generator. Default: 0
+
+    Returns
+    -------
+    shortforms : list of str
+
+    grounding_dict : dict
+        Maps shortforms to grounding maps
+
+    names : dict
+        Maps groundings to names
+
+    pos_labels : list of str
+
+    text_dict : dict
+        Maps text ref ids to texts
+
+    ref_dict : dict
+        Maps statement ids to text ref ids
+    """
+    rng = random.Random(seed)
+    vocabulary = [_random_word(rng) for _ in range(5000)]
+    shortforms = [f'SF{letter}' for letter
+                  in string.ascii_uppercase[:n_shortforms]]
+    grounding_dict = {}
+    names = {}
+    contexts = {}
+    for shortform in shortforms:
+        grounding_map = {}
+        for index in range(n_groundings):
+            longform = ' '.join(letter.lower() + _random_word(rng)
+                                for letter in shortform)
+            grounding = f'HGNC:{shortform}{index}'
+            grounding_map[longform] = grounding
+            names[grounding] = longform.title()
+            # label specific context words make the classifier learnable
+            contexts[grounding] = rng.sample(vocabulary, 20)
+        grounding_dict[shortform] = grounding_map
+    pos_labels = sorted(grounding for grounding in names
+                        if grounding.endswith('0'))
+
+    text_dict = {}
+    ref_dict = {}
+    stmt_id = 0
+    for ref in range(n_texts):
+        shortform = rng.choice(shortforms)
+        longform, grounding = rng.choice(list(grounding_dict[shortform]
+                                              .items()))
+        words = rng.sample(vocabulary, 60) + \
+            rng.sample(contexts[grounding], 10)
+        rng.shuffle(words)
+        if rng.random() < 0.5:
+            words.insert(5, f'{longform} ({shortform})')
+        words.extend([shortform] * rng.randint(1, 3))
+        text_dict[str(ref)] = ' '.join(words) + '.'
+        for _ in range(rng.randint(1, 3)):
+            ref_dict[str(stmt_id)] = ref
+            stmt_id += 1
+    return shortforms, grounding_dict, names, pos_labels, text_dict, ref_dict
+
+
+def write_data(data_path, grounding_dict, names, pos_labels, text_dict,
+               ref_dict):
+    """Lay out a synthetic corpus in data_path as the scripts expect"""
+    for shortform, grounding_map in grounding_dict.items():
+        groundings_path = os.path.join(data_path, 'groundings', shortform)
+        os.makedirs(groundings_path)
+        shortform_names = {grounding: names[grounding]
+                           for grounding in grounding_map.values()}
+        shortform_pos_labels = [label for label in pos_labels
+                                if label in shortform_names]
+        for end, content in (('grounding_map', grounding_map),
+                             ('names', shortform_names),
+                             ('pos_labels', shortform_pos_labels)):
+            with open(os.path.join(groundings_path,
+                                   f'{shortform}_{end}.json'), 'w') as f:
+                json.dump(content, f)
+    agg_name = ':'.join(sorted(grounding_dict))
+    texts_path = os.path.join(data_path, 'texts', agg_name)
+    os.makedirs(texts_path)
+    with open(os.path.join(texts_path, f'{agg_name}_texts.json'), 'w') as f:
+        json.dump(text_dict, f)
+    with open(os.path.join(texts_path, f'{agg_name}_text_map.json'),
+              'w') as f:
+        json.dump(ref_dict, f)
+    os.makedirs(os.path.join(data_path, 'models'))
+
+
+def run_config(n_texts, n_shortforms, stages=None, n_jobs=1, seed=0):
+    """Benchmark pipeline stages for one corpus size and shortform count
+
+    Intended to be run in a fresh process. Returns per-stage wall time,
+    throughput in texts per second and the peak RSS of the process after
+    the stage has completed.
+    """
+    from adeft.modeling.corpora import DeftCorpusBuilder
+
+    from adeft_app.scripts import model
+    from adeft_app.scripts.adeft_mine import mine_longforms
+
+    if stages is None:
+        stages = STAGES
+    start = time.perf_counter()
+    (shortforms, grounding_dict, names, pos_labels,
+     text_dict, ref_dict) = make_corpus(n_texts, n_shortforms, seed=seed)
+    texts = list(text_dict.values())
+    results = {'generate': {'seconds': time.perf_counter() - start,
+                            'peak_rss_bytes': _peak_rss()}}
+
+    def run_stage(name, func):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        results[name] = {'seconds': elapsed,
+                         'texts_per_second': n_texts / elapsed,
+                         'peak_rss_bytes': _peak_rss()}
+
+    with tempfile.TemporaryDirectory() as data_path:
+        if 'mining' in stages:
+            run_stage('mining', lambda: mine_longforms(shortforms, texts))
+        if 'stats' in stages:
+            run_stage('stats', lambda: model.adeft_stats(grounding_dict,
+                                                         names, text_dict,
+                                                         ref_dict))
+        if 'corpus' in stages:
+            builder = DeftCorpusBuilder(grounding_dict)
+            run_stage('corpus', lambda: builder.build_from_texts(texts))
+        if 'train' in stages:
+            write_data(data_path, grounding_dict, names, pos_labels,
+                       text_dict, ref_dict)
+            run_stage('train', lambda: model.train(shortforms, n_jobs=n_jobs,
+                                                   data_path=data_path))
+    return {'n_texts': n_texts, 'n_shortforms': n_shortforms,
+            'stages': results, 'peak_rss_bytes': _peak_rss()}
+
+
+def run(text_counts, shortform_counts, stages=None, n_jobs=1, seed=0):
+    """Benchmark every configuration, each in its own process"""
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for n_texts in text_counts:
+        for n_shortforms in shortform_counts:
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=context) as executor:
+                future = executor.submit(run_config, n_texts, n_shortforms,
+                                         stages=stages, n_jobs=n_jobs,
+                                         seed=seed)
+                results.append(future.result())
+    return {'meta': {'benchmark': 'pipeline',
+                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'seed': seed, 'n_jobs': n_jobs},
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark offline'
+                                     ' pipeline stages on synthetic corpora')
+    parser.add_argument('--texts', nargs='*', type=int,
+                        default=DEFAULT_TEXTS,
+                        help='Corpus sizes to benchmark with')
+    parser.add_argument('--shortforms', nargs='*', type=int,
+                        default=DEFAULT_SHORTFORMS,
+                        help='Numbers of shortforms to benchmark with')
+    parser.add_argument('--stages', nargs='*', choices=STAGES,
+                        default=STAGES)
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_pipeline.json')
+    args = parser.parse_args()
+    output = run(args.texts, args.shortforms, stages=args.stages,
+                 n_jobs=args.n_jobs, seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    for result in output['results']:
+        for stage, stats in result['stages'].items():
+            print(f"{result['n_texts']:>8} texts {result['n_shortforms']:>3}"
+                  f" shortforms {stage:<9} {stats['seconds']:9.2f} s"
+                  f" peak {stats['peak_rss_bytes'] / 2**20:9.1f} MiB")
@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+
+from adeft_app.scripts.streaming import ShuffledSpool, train_streaming
+
+
+def _corpus(n_texts, labels, seed):
+    """Texts with two words specific to their label, two specific to a
+    random label and sixty common words"""
+    rng = random.Random(seed)
+    words = {label: [f'{label.lower()}word{index}' for index in range(30)]
+             for label in 'ABC'}
+    common = [f'common{index}' for index in range(300)]
+    corpus = []
+    for index in range(n_texts):
+        label = labels[index % len(labels)]
+        text = rng.sample(words[label], 2) + \
+            rng.sample(words[rng.choice('ABC')], 2) + rng.sample(common, 60)
+        rng.shuffle(text)
+        corpus.append((' '.join(text), label))
+    return corpus
+
+
+def test_train_streaming_corpus_ordered_by_label(tmp_path):
+    corpus = sorted(_corpus(1800, 'ABC', 0), key=lambda row: row[1])
+    test = _corpus(600, 'ABC', 1)
+    with ShuffledSpool(len(corpus), 200, directory=tmp_path) as spool:
+        spool.write(corpus)
+        estimator, cv_results = train_streaming(spool.chunks, ['A'],
+                                                n_features=2**16)
+    predictions = estimator.predict([text for text, _ in test])
+    accuracy = np.mean(predictions == [label for _, label in test])
+    assert accuracy > 0.5
+    assert cv_results['f1']['mean'] > 0.4
+    # the model does not collapse onto the label read last
+    assert len(set(predictions)) == 3
+
+
+def test_shuffled_spool_chunks_mix_rows():
+    rows = [[index, 'A' if index < 500 else 'B'] for index in range(1000)]
+    with ShuffledSpool(len(rows), 100) as spool:
+        spool.write(rows)
+        first = list(spool.chunks())
+        second = list(spool.chunks())
+    assert sorted(row for chunk in first for row in chunk) == rows
+    assert [chunk[0] for chunk in first] != [chunk[0] for chunk in second]
+    for chunk in first:
+        share = sum(label == 'B' for _, label in chunk) / len(chunk)
+        assert 0.2 < share < 0.8